@@ -7,57 +7,88 @@ from fastvqa.models import DiViDeAddEvaluator
 import torch
 import numpy as np
 import argparse
+import time
+import sys
+import os
 
 class AV1FallbackReader:
-    def __init__(self, path):
+    """
+    PyAV based reader for files decord cannot open (AV1 test clips).
+
+    Frames are decoded forward in a single threaded pass, get_batch returns only
+    the requested indices instead of seeking back to a keyframe for every frame.
+    """
+    def __init__(self, path, threads=0):
         self.container = av.open(path)
         self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"  # Frame and slice threading
+        self.stream.thread_count = threads  # 0 = one per core
+        self._cache = {}  # frame index -> decoded RGB tensor
 
+        fps = self.stream.average_rate
         if self.stream.frames > 0:
             self.total_frames = self.stream.frames
+        elif self.stream.duration is not None and self.stream.time_base is not None and fps is not None:
+            # duration is in time_base units, so real_seconds = duration * time_base
+            self.total_frames = int(float(self.stream.duration) * float(self.stream.time_base) * float(fps))
+        elif self.container.duration is not None and fps is not None:
+            # Matroska keeps only the container duration (in AV_TIME_BASE units)
+            self.total_frames = int(self.container.duration / av.time_base * float(fps))
         else:
-            # Fallback: Calculate from duration * fps if available
-            # We strictly check for None to avoid the TypeError
-            duration = self.stream.duration
-            time_base = self.stream.time_base
-            fps = self.stream.average_rate
-
-            if duration is not None and time_base is not None and fps is not None:
-                # duration is in time_base units, so real_seconds = duration * time_base
-                self.total_frames = int(float(duration) * float(time_base) * float(fps))
-            else:
-                # Final Fallback: Count frames manually (slower but guarantees accuracy)
-                # This is often necessary for MKV files without header stats
-                print(f"Warning: Could not determine frame count from metadata. Counting manually...")
-                self.total_frames = 0
-                for packet in self.container.demux(self.stream):
-                    if packet.dts is not None: # Use packets to estimate count faster than decoding
-                        self.total_frames += 1
-                
-                # Reset container after counting
-                self.container.close()
-                self.container = av.open(path)
-                self.stream = self.container.streams.video[0]
-
-        # Get duration for seeking, defaulting to a high number if unknown
-        # (This prevents crashes in seeking logic if duration is None)
-        self.duration = self.stream.duration if self.stream.duration is not None else 1
-
+            # Final Fallback: Count packets (slower but guarantees accuracy)
+            print(f"Warning: Could not determine frame count from metadata. Counting manually...")
+            self.total_frames = sum(1 for packet in self.container.demux(self.stream) if packet.dts is not None)
+            self.container.seek(0)
 
     def __len__(self):
         return self.total_frames
 
+    def get_batch(self, indices):
+        """
+        Decode the file once from the start and keep only the requested frames.
+
+        Indices past the real end of the stream (frame count estimated from the
+        duration) get the last decoded frame. Decoded frames are cached, so
+        repeated and single index lookups do not decode the file again.
+
+        Returns:
+            dict: frame index -> RGB tensor (H, W, 3)
+
+        Raises:
+            ValueError: If the stream yields no frames at all.
+        """
+        wanted = sorted(set(int(idx) for idx in indices))
+        missing = [idx for idx in wanted if idx not in self._cache]
+        if missing:
+            self._decode(missing)
+        return {idx: self._cache[idx] for idx in wanted}
+
+    def _decode(self, wanted):
+        self.container.seek(0)
+        position = 0
+        frame = None
+        index = -1
+        for index, frame in enumerate(self.container.decode(self.stream)):
+            if index == wanted[position]:
+                self._cache[index] = torch.from_numpy(frame.to_ndarray(format='rgb24'))
+                position += 1
+                if position == len(wanted):
+                    return
+
+        if frame is None:
+            raise ValueError(f"PyAV decoded no frames from {self.container.name}")
+        # The stream ended early, fill the rest with its real last frame
+        last = self._cache.get(index)
+        if last is None:
+            last = torch.from_numpy(frame.to_ndarray(format='rgb24'))
+        for idx in wanted[position:]:
+            self._cache[idx] = last
+
     def __getitem__(self, idx):
-        # Calculate timestamp for seeking (approximate based on index)
-        seek_pts = int(idx / self.total_frames * self.duration)
-        self.container.seek(seek_pts, stream=self.stream)
-        
-        # Decode the first frame found after seek
-        # Note: This returns an RGB tensor compatible with the script's expectations
-        for frame in self.container.decode(self.stream):
-            return torch.from_numpy(frame.to_ndarray(format='rgb24'))
-        # Return dummy tensor if seek fails (prevents crash)
-        #return torch.zeros((720, 1280, 3), dtype=torch.uint8)
+        idx = int(idx)
+        if idx not in self._cache:
+            self.get_batch([idx])
+        return self._cache[idx]
 
 def sigmoid_rescale(score, model="FasterVQA"):
     mean, std = mean_stds[model]
@@ -82,6 +113,130 @@ opts = {
     "FAST-VQA-M": "/app/FastVQA-and-FasterVQA/options/fast/fast-m.yml", 
 }
 
+# Traced TorchScript graphs of the accelerated evaluators
+ACCEL_CACHE_DIR = "/app/FastVQA-and-FasterVQA/accel_cache"
+
+def open_video(video_path, threads=0):
+    try:
+        return decord.VideoReader(video_path, num_threads=threads)
+    except Exception as e:
+        print(f"Decord load failed ({e}), falling back to PyAV for AV1 support...")
+        return AV1FallbackReader(video_path, threads)
+
+def load_samples(video_path, opt, device="cpu", decoder_threads=0):
+    """Sample the fragments of a video as the evaluator input dict."""
+    video_reader = open_video(video_path, decoder_threads)
+
+    vsamples = {}
+    t_data_opt = opt["data"]["val-kv1k"]["args"]
+    s_data_opt = opt["data"]["val-kv1k"]["args"]["sample_types"]
+    for sample_type, sample_args in s_data_opt.items():
+        ## Sample Temporally
+        if t_data_opt.get("t_frag",1) > 1:
+            sampler = FragmentSampleFrames(fsize_t=sample_args["clip_len"] // sample_args.get("t_frag",1),
+                                           fragments_t=sample_args.get("t_frag",1),
+                                           num_clips=sample_args.get("num_clips",1),
+                                          )
+        else:
+            sampler = SampleFrames(clip_len = sample_args["clip_len"], num_clips = sample_args["num_clips"])
+        
+        num_clips = sample_args.get("num_clips",1)
+        frames = sampler(len(video_reader))
+        print("Sampled frames are", frames)
+        if isinstance(video_reader, AV1FallbackReader):
+            frame_dict = video_reader.get_batch(np.unique(frames))
+        else:
+            frame_dict = {idx: video_reader[idx] for idx in np.unique(frames)}
+        imgs = [frame_dict[idx] for idx in frames]
+        video = torch.stack(imgs, 0)
+        video = video.permute(3, 0, 1, 2)
+
+        ## Sample Spatially
+        sampled_video = get_spatial_fragments(video, **sample_args)
+        mean, std = torch.FloatTensor([123.675, 116.28, 103.53]), torch.FloatTensor([58.395, 57.12, 57.375])
+        sampled_video = ((sampled_video.permute(1, 2, 3, 0) - mean) / std).permute(3, 0, 1, 2)
+        
+        sampled_video = sampled_video.reshape(sampled_video.shape[0], num_clips, -1, *sampled_video.shape[2:]).transpose(0,1)
+        vsamples[sample_type] = sampled_video.to(device)
+        print(sampled_video.shape)
+    return vsamples
+
+def load_evaluator(opt, device="cpu"):
+    ### Model Definition
+    evaluator = DiViDeAddEvaluator(**opt["model"]["args"]).to(device)
+    evaluator.load_state_dict(torch.load(opt["test_load_path"], map_location=device)["state_dict"])
+    return evaluator.eval()
+
+def accelerate(evaluator, model, accel, vsamples, cache_dir=ACCEL_CACHE_DIR):
+    """
+    Return a faster CPU version of the evaluator.
+
+    accel:
+        "int8"        dynamic int8 quantization of the Linear layers (Swin blocks, head)
+        "script"      TorchScript graph traced on vsamples
+        "int8-script" both, the quantized model is traced
+
+    Traced graphs are specialized to the input shapes, so they are cached on disk per
+    model, mode, input shape and torch version. Quantization alone is cheap and is
+    not cached. ONNX export is not supported by the Swin3D window attention.
+    """
+    if accel == "none":
+        return evaluator
+
+    if "script" in accel:
+        shapes = "_".join(f"{key}-{'x'.join(map(str, value.shape))}" for key, value in sorted(vsamples.items()))
+        cache_file = os.path.join(cache_dir, f"{model}_{accel}_{shapes}_torch{torch.__version__.split('+')[0]}.pt")
+        if os.path.isfile(cache_file):
+            print(f"Loading cached graph {cache_file}")
+            return torch.jit.load(cache_file)
+
+    if "int8" in accel:
+        evaluator = torch.quantization.quantize_dynamic(evaluator, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if "script" in accel:
+        with torch.no_grad():
+            evaluator = torch.jit.freeze(torch.jit.trace(evaluator, (vsamples,), strict=False).eval())
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.jit.save(evaluator, cache_file)
+        print(f"Saved traced graph to {cache_file}")
+
+    return evaluator
+
+def evaluate(evaluator, vsamples, model):
+    with torch.no_grad():
+        result = evaluator(vsamples)
+    return sigmoid_rescale(result.mean().item(), model=model)
+
+def check_accuracy(video_paths, model, accel, opt):
+    """
+    Score reference clips with the eager and the accelerated evaluator on identical
+    samples and print the score drift and speedup.
+    """
+    eager = load_evaluator(opt)
+    accelerated = None
+    drifts = []
+    eager_time = accel_time = 0.0
+    for video_path in video_paths:
+        vsamples = load_samples(video_path, opt)
+        if accelerated is None:
+            accelerated = accelerate(load_evaluator(opt), model, accel, vsamples)
+
+        start = time.perf_counter()
+        eager_score = evaluate(eager, vsamples, model)
+        eager_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        accel_score = evaluate(accelerated, vsamples, model)
+        accel_time += time.perf_counter() - start
+
+        drifts.append(accel_score - eager_score)
+        print(f"{video_path}: eager {eager_score:.5f}, {accel} {accel_score:.5f}, drift {drifts[-1]:+.5f}")
+
+    drifts = np.abs(np.array(drifts))
+    print(f"Accuracy check [{model}/{accel}] on {len(video_paths)} clips: "
+          f"mean abs drift {drifts.mean():.5f}, max abs drift {drifts.max():.5f}, "
+          f"speedup {eager_time / max(accel_time, 1e-9):.2f}x")
+
 if __name__ == "__main__":
     
     parser = argparse.ArgumentParser()
@@ -109,54 +264,52 @@ if __name__ == "__main__":
         default="cpu", 
         help="the running device"
     )
+
+    parser.add_argument(
+        "-a", "--accel", type=str,
+        default="none", choices=["none", "int8", "script", "int8-script"],
+        help="CPU inference acceleration, see accelerate()"
+    )
+
+    parser.add_argument(
+        "-t", "--threads", type=int,
+        default=0,
+        help="torch intra-op threads, 0 = torch default (one per core)"
+    )
+
+    parser.add_argument(
+        "--decoder_threads", type=int,
+        default=0,
+        help="video decoder threads, 0 = one per core"
+    )
+
+    parser.add_argument(
+        "-c", "--check", type=str, nargs="+",
+        default=None,
+        help="reference clips, compare --accel scores against eager scores instead of scoring --video_path"
+    )
     
     
     args = parser.parse_args()
 
-    try:
-        video_reader = decord.VideoReader(args.video_path)
-    except Exception as e:
-        print(f"Decord load failed ({e}), falling back to PyAV for AV1 support...")
-        video_reader = AV1FallbackReader(args.video_path)
-    
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+        torch.set_num_interop_threads(1)
+
     opt = opts.get(args.model, opts["FAST-VQA"])
     with open(opt, "r") as f:
         opt = yaml.safe_load(f)
 
-    ### Model Definition
-    evaluator = DiViDeAddEvaluator(**opt["model"]["args"]).to(args.device)
-    evaluator.load_state_dict(torch.load(opt["test_load_path"], map_location=args.device)["state_dict"])
+    if args.check:
+        check_accuracy(args.check, args.model, args.accel, opt)
+        sys.exit(0)
 
     ### Data Definition
-    vsamples = {}
-    t_data_opt = opt["data"]["val-kv1k"]["args"]
-    s_data_opt = opt["data"]["val-kv1k"]["args"]["sample_types"]
-    for sample_type, sample_args in s_data_opt.items():
-        ## Sample Temporally
-        if t_data_opt.get("t_frag",1) > 1:
-            sampler = FragmentSampleFrames(fsize_t=sample_args["clip_len"] // sample_args.get("t_frag",1),
-                                           fragments_t=sample_args.get("t_frag",1),
-                                           num_clips=sample_args.get("num_clips",1),
-                                          )
-        else:
-            sampler = SampleFrames(clip_len = sample_args["clip_len"], num_clips = sample_args["num_clips"])
-        
-        num_clips = sample_args.get("num_clips",1)
-        frames = sampler(len(video_reader))
-        print("Sampled frames are", frames)
-        frame_dict = {idx: video_reader[idx] for idx in np.unique(frames)}
-        imgs = [frame_dict[idx] for idx in frames]
-        video = torch.stack(imgs, 0)
-        video = video.permute(3, 0, 1, 2)
+    vsamples = load_samples(args.video_path, opt, args.device, args.decoder_threads)
 
-        ## Sample Spatially
-        sampled_video = get_spatial_fragments(video, **sample_args)
-        mean, std = torch.FloatTensor([123.675, 116.28, 103.53]), torch.FloatTensor([58.395, 57.12, 57.375])
-        sampled_video = ((sampled_video.permute(1, 2, 3, 0) - mean) / std).permute(3, 0, 1, 2)
-        
-        sampled_video = sampled_video.reshape(sampled_video.shape[0], num_clips, -1, *sampled_video.shape[2:]).transpose(0,1)
-        vsamples[sample_type] = sampled_video.to(args.device)
-        print(sampled_video.shape)
-    result = evaluator(vsamples)
-    score = sigmoid_rescale(result.mean().item(), model=args.model)
+    evaluator = load_evaluator(opt, args.device)
+    if args.device == "cpu":
+        evaluator = accelerate(evaluator, args.model, args.accel, vsamples)
+
+    score = evaluate(evaluator, vsamples, args.model)
     print(f"The quality score of the video (range [0,1]) is {score:.5f}.")
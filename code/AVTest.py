@@ -4,22 +4,31 @@ import json
 from multiprocessing import Pool, Manager
 import time
 import math
-import numpy as np
-import soundfile as sf
-from PIL import Image
 import logging
 import compressor2
 import traceback
-from VideoClass import VideoProcessingConfig
+from VideoClass import VideoProcessingConfig, getDuration
+import scene_analysis
+import workspace_manager
+import metric_store
+import resource_monitor
+import load_controller
 import copy
 import ast
 from typing import Union
 
 #TODO: add cleanup
 
+# numpy, soundfile and PIL are imported inside the tests that use them, so runs and
+# worker processes with those tests disabled do not pay for loading them
+
 # Retrieve the logger once at the module level
 logger = logging.getLogger("AppLogger")
 
+# Scoring models, part of the metric store keys
+VQA_MODEL = "FasterVQA"
+VMAF_MODEL = "vmaf_v0.6.1"  # libvmaf default model
+
 # region singlethread VQA
 #Meassure video using FasterVQA, number of runs for averaging
 def getVQA(video_path: str, num_of_runs: int = 4) -> float:
@@ -83,40 +92,249 @@ def getRes_parallel(VPC: VideoProcessingConfig) -> bool: #enter full path to vid
     """
     res_VPC = VPC.create_copy()
     name = VPC.output_file_name + "_res"
+    res_settings = VPC.test_settings["Resolution_calculation"]
 
-    res_VPC.setWorkspace(os.path.join(VPC.workspace, name))
+    # Scene crop plus one near-lossless clip per testing resolution
+    adaptive = res_settings.get("adaptive_sampling", {})
+    scenes = adaptive.get("max_scenes", 15) if adaptive.get("Enabled", False) else res_settings["num_of_tests"]
+    stage_size = workspace_manager.estimate_bytes(VPC, scenes * res_settings["scene_length"] * (len(res_settings["testing_resolutions"]) + 1), 2.0)
+    with workspace_manager.reserve(VPC, "res", name, stage_size) as workspace:
+        res_VPC.setWorkspace(workspace)
 
-    video_paths, passed = _prepareRes_test(res_VPC)
+        decode_table = ast.literal_eval(VPC.getProfileValue(VPC.profile["test_settings"], "res_decode"))
 
-    if not passed:
-        return False
+        if res_settings.get("adaptive_sampling", {}).get("Enabled", False):
+            average_slope = _adaptiveRes_slope(res_VPC, decode_table)
+            if average_slope is None:
+                return False
+
+        else:
+            video_paths, passed = _prepareRes_test(res_VPC)
+
+            if not passed:
+                return False
+
+            result_dict = _runVQA_pool(video_paths, res_settings["Threads"], res_settings.get("vqa_acceleration", "none"), metric_store.database(VPC))
+
+            if len(result_dict) < 2:
+                logger.error("result us empty")
+                return False
+
+            regression_slope = _getRegressionSlopes(result_dict)
+            average_slope = _trimmedMeanSlope(regression_slope, res_settings["keep_best_slopes"])
+
+        logger.debug(f"average slope is: {average_slope}")
+
+        #Assign res to average slope
+        target_res = _decodeResolution(average_slope, decode_table, VPC.orig_h_res)
 
+        logger.info(f"Original resolution: {VPC.orig_h_res}, Target resolution: {target_res}")
+        VPC.setOutputRes(target_res)
+        compressor2.delete_file(VPC, res_VPC.workspace)
+        return True
+
+def _adaptiveRes_slope(VPC: VideoProcessingConfig, decode_table: dict) -> Union[float, None]:
     """
-    video_paths = list()
-    files = [f for f in os.listdir(video_folder) 
-         if os.path.isfile(os.path.join(video_folder, f)) and f.lower().endswith('.mkv')]
+    Sequential variant of the resolution test. Scenes are encoded and scored one batch at a time
+    and sampling stops as soon as the confidence interval of the trimmed-mean slope falls into
+    a single res_decode bucket, or when max_scenes is reached.
+
+        Args:
+            VPC (VideoProcessingConfig): Video processing configuration (resolution test copy)
+            decode_table (dict): Resolution -> minimal slope table from the profile
 
-    for file in files:
-        for _ in range(num_of_VQA_runs):
-            video_paths.append(os.path.join(video_folder, file))
+        Returns:
+            float: Trimmed-mean regression slope, or None if the test failed
     """
+    res_settings = VPC.test_settings["Resolution_calculation"]
+    adaptive = res_settings["adaptive_sampling"]
+    min_scenes = adaptive.get("min_scenes", 3)
+    max_scenes = max(adaptive.get("max_scenes", res_settings["num_of_tests"]), min_scenes)
+    batch_size = max(adaptive.get("batch_size", 2), 1)
+    confidence = adaptive.get("confidence", 1.0)
+
+    # Scenes are placed on the same grid as the fixed test would use for max_scenes,
+    # but visited in an order that keeps every prefix spread over the whole title
+    pending = _spreadOrder(_sampleScenes(VPC, max_scenes, res_settings["scene_length"]))
+    result_dict = dict()
+    average_slope = None
+
+    while pending:
+        batch_size_now = batch_size if result_dict else max(batch_size, min_scenes)
+        batch, pending = pending[:batch_size_now], pending[batch_size_now:]
+
+        video_paths, passed = _prepareRes_test(VPC, batch)
+        if not passed:
+            return None
+
+        result_dict.update(_runVQA_pool(video_paths, res_settings["Threads"], res_settings.get("vqa_acceleration", "none"), metric_store.database(VPC)))
+        if len(result_dict) < 2:
+            logger.error("result us empty")
+            return None
+
+        regression_slope = _getRegressionSlopes(result_dict)
+        average_slope = _trimmedMeanSlope(regression_slope, res_settings["keep_best_slopes"])
+
+        if len(regression_slope) < min_scenes:
+            continue
+
+        to_keep = _bestSlopes(regression_slope, res_settings["keep_best_slopes"])
+        if len(to_keep) < 2:
+            continue
+
+        variance = sum((value - average_slope)**2 for value in to_keep)/(len(to_keep) - 1)
+        margin = confidence * math.sqrt(variance/len(to_keep))
+
+        lower_res = _decodeResolution(average_slope - margin, decode_table, VPC.orig_h_res)
+        upper_res = _decodeResolution(average_slope + margin, decode_table, VPC.orig_h_res)
+        logger.debug(f"Adaptive resolution test: {len(regression_slope)} scenes, slope {average_slope} +- {margin}, "
+                     f"resolution bracket {lower_res}-{upper_res}")
+
+        if lower_res == upper_res:
+            logger.info(f"Resolution test converged after {len(regression_slope)} of {max_scenes} scenes")
+            break
+    else:
+        logger.info(f"Resolution test used all {max_scenes} scenes without converging")
+
+    return average_slope
+
+def _runVQA_pool(video_paths: list, threads: int, accel: str = "none", memo: Union[str, None] = None) -> dict:
+    """
+    Scores test files in parallel using FasterVQA.
+
+    The available cores are split between the pool processes, every vqa.py gets an explicit
+    torch/OpenMP and decoder thread count instead of one thread per core each.
+
+    With a metric store, files whose content was scored before are not scored again.
+    FasterVQA samples frames at random, so a file listed several times gets one stored
+    sample per occurrence.
+
+        Args:
+            video_paths (list): Paths of the files to score
+            threads (int): Number of pool processes
+            accel (str, optional): CPU inference acceleration of vqa.py (none, int8, script, int8-script)
+            memo (str, optional): Path of the metric store database
+
+        Returns:
+            dict: File name (without extension) -> list of VQA scores
+    """
+    memo_dict = dict()
+    if memo is not None:
+        video_paths, memo_dict, pending = _lookupVQA(video_paths, accel, memo)
+        if not video_paths:
+            logger.info(f"All {len(memo_dict)} VQA scores taken from the metric store")
+            return memo_dict
+
+    # With load control the pool has room for the largest limit and files are handed out
+    # only while fewer than the current limit are being scored
+    workers = load_controller.bound("vqa", threads)
+    logger.debug(f"VQA pool of {workers} workers")
+
      # Manager for sharing dictionary and lock between processes
     with Manager() as manager:
         shared_dict = manager.dict()  # Shared dictionary to store outputs
+        timings = manager.dict()  # Worker PID -> (scored files, seconds)
         lock = manager.Lock()  # Manager's Lock to prevent overwriting
 
-        with Pool(processes=VPC.test_settings["Resolution_calculation"]["Threads"]) as pool:
-                pool.starmap(_run_VQA_process, [(video_path, shared_dict, lock) for video_path in video_paths])
+        with resource_monitor.track_children("vqa.py"), Pool(processes=workers) as pool:
+            jobs = list()
+            for video_path in video_paths:
+                load_controller.acquire("vqa")
+                thread_budget = _vqaThreadBudget(load_controller.limit("vqa", threads))
+                jobs.append(pool.apply_async(
+                    _run_VQA_process, (video_path, shared_dict, lock, accel, thread_budget, timings),
+                    callback=lambda _: load_controller.release("vqa"),
+                    error_callback=lambda _: load_controller.release("vqa")
+                ))
+            for job in jobs:
+                job.wait()
 
         result_dict = dict(shared_dict)
-    
-    #make output dict more readable and average the VQA values for each res
+        timings = dict(timings)
+
+    for pid, (count, seconds) in timings.items():
+        logger.info(f"VQA worker {pid}: {count} scores in {seconds:.1f}s ({count / max(seconds, 1e-9):.3f} scores/s)")
+
+    if memo is not None:
+        _recordVQA(result_dict, pending, accel, memo)
+        for name, scores in memo_dict.items():
+            result_dict[name] = scores + result_dict.get(name, [])
+
     logger.debug("VQA process finished sucefully")
+    return result_dict
 
-    if len(result_dict) < 2:
-        logger.error("result us empty")
-        return False
-    
+def _lookupVQA(video_paths: list, accel: str, memo: str) -> tuple:
+    """
+    Splits the files to score into stored and missing VQA scores.
+
+        Returns:
+            tuple: (paths to score, file name -> list of stored scores,
+                    file name -> (content hash, list of sample indices to score))
+    """
+    memo_dict = dict()
+    pending = dict()
+    to_score = list()
+    hashes = dict()
+    occurrence = dict()
+    params = {"accel": accel}
+
+    for video_path in video_paths:
+        name = os.path.basename(video_path)[:-4]
+        if video_path not in hashes:
+            hashes[video_path] = metric_store.content_hash(video_path)
+        sample = occurrence.get(video_path, 0)
+        occurrence[video_path] = sample + 1
+
+        score = metric_store.lookup(memo, hashes[video_path], "vqa", VQA_MODEL, params, sample)
+        if score is not None:
+            memo_dict.setdefault(name, []).append(score)
+        else:
+            to_score.append(video_path)
+            pending.setdefault(name, (hashes[video_path], []))[1].append(sample)
+
+    logger.debug(f"VQA metric store: {len(video_paths) - len(to_score)} stored, {len(to_score)} to score")
+    return to_score, memo_dict, pending
+
+def _recordVQA(result_dict: dict, pending: dict, accel: str, memo: str) -> None:
+    """
+    Stores new VQA scores under the sample indices reserved by _lookupVQA.
+    """
+    for name, (clip, samples) in pending.items():
+        for sample, score in zip(samples, result_dict.get(name, [])):
+            metric_store.record(memo, clip, "vqa", VQA_MODEL, {"accel": accel}, score, sample)
+
+def _vqaThreadBudget(workers: int) -> tuple:
+    """
+    Splits the cores available to this process between VQA workers.
+
+    Frame decoding and inference run one after the other inside vqa.py, so both
+    get the full per-worker share.
+
+        Args:
+            workers (int): Number of pool processes
+
+        Returns:
+            tuple: (compute threads, decoder threads) per worker
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+
+    per_worker = max(1, cores // max(1, workers))
+    return per_worker, per_worker
+
+def _getRegressionSlopes(result_dict: dict) -> list:
+    """
+    Averages the VQA values for each scene and resolution and computes the VQA/resolution slope of every scene.
+
+        Args:
+            result_dict (dict): File name -> list of VQA scores, as returned by _runVQA_pool
+
+        Returns:
+            list: Regression slope of each scene
+    """
+    #make output dict more readable and average the VQA values for each res
     sorted_dict = dict()
     for key in result_dict.keys():
         matches = re.findall(r"\d*", key)
@@ -140,6 +358,9 @@ def getRes_parallel(VPC: VideoProcessingConfig) -> bool: #enter full path to vid
     logger.debug("regression slope:")
     for scene in sorted_dict.keys():
         res = sorted_dict[scene].keys()
+        if len(res) < 2:
+            logger.warning(f"Scene {scene} is missing a resolution, skipping")
+            continue
         res_min = int(sorted(res)[1])
         res_max = int(sorted(res)[0])
         VQA_res_min = float(sorted_dict[scene][str(res_min)])
@@ -148,39 +369,104 @@ def getRes_parallel(VPC: VideoProcessingConfig) -> bool: #enter full path to vid
         regression_slope.append(slope)
         logger.debug(f"{scene}: {slope}")
 
+    return regression_slope
+
+def _trimmedMeanSlope(regression_slope: list, keep_best_slopes: float) -> float:
+    """
+    Removes the worst scenes and averages the rest.
+
+        Args:
+            regression_slope (list): Regression slope of each scene
+            keep_best_slopes (float): Fraction of the best slopes to keep
+
+        Returns:
+            float: Average of the kept slopes
+    """
     logger.debug("average:")
     logger.debug(regression_slope)
 
     #remove worst scenes and make average
-    regression_slope = sorted(regression_slope, reverse=True)
-    to_keep = math.ceil(len(regression_slope)*VPC.test_settings["Resolution_calculation"]["keep_best_slopes"])
-    regression_slope = regression_slope[:to_keep]
-    
+    regression_slope = _bestSlopes(regression_slope, keep_best_slopes)
+
     average_slope = 0
     for value in regression_slope:
         average_slope = average_slope + value
     average_slope = average_slope/len(regression_slope)
 
-    logger.debug(f"average slope is: {average_slope}")
+    return average_slope
+
+def _bestSlopes(regression_slope: list, keep_best_slopes: float) -> list:
+    """
+    Returns the best keep_best_slopes fraction of the slopes, highest first.
+    """
+    regression_slope = sorted(regression_slope, reverse=True)
+    to_keep = math.ceil(len(regression_slope)*keep_best_slopes)
+    return regression_slope[:to_keep]
+
+def _decodeResolution(average_slope: float, decode_table: dict, orig_h_res: int) -> int:
+    """
+    Assigns a target resolution to a slope using the profile res_decode table.
+
+        Args:
+            average_slope (float): Averaged regression slope
+            decode_table (dict): Resolution -> minimal slope table
+            orig_h_res (int): Horizontal resolution of the source, upper limit of the result
 
-    #Assign res to average slope
+        Returns:
+            int: Target horizontal resolution
+    """
     target_res = 854
-    decode_table = ast.literal_eval(VPC.getProfileValue(VPC.profile["test_settings"], "res_decode"))
 
     for key in decode_table:
         if average_slope >= decode_table[key]:
             if key > target_res:
                 target_res = key
 
-    if target_res > VPC.orig_h_res:
-        target_res = VPC.orig_h_res
+    if target_res > orig_h_res:
+        target_res = orig_h_res
+
+    return target_res
+
+def _sampleScenes(VPC: VideoProcessingConfig, number_of_scenes: int, scene_length: float = 0) -> list:
+    """
+    Picks test scenes. With scene analysis available the scenes are stratified by complexity,
+    otherwise they are taken at regular intervals through the title.
+
+        Args:
+            VPC (VideoProcessingConfig): Video processing configuration
+            number_of_scenes (int): Number of scenes to pick
+            scene_length (float, optional): Length of the test segment in seconds
+
+        Returns:
+            list: (scene id, start time in seconds) tuples
+    """
+    if VPC.scene_list:
+        scenes = scene_analysis.select_scenes(VPC, number_of_scenes, scene_length)
+        if scenes is not None:
+            return scenes
+        logger.info("Falling back to evenly spaced test scenes")
 
-    logger.info(f"Original resolution: {VPC.orig_h_res}, Target resolution: {target_res}")
-    VPC.setOutputRes(target_res)
-    compressor2.delete_file(VPC, res_VPC.workspace)
-    return True
+    timestep = int(VPC.orig_duration/(number_of_scenes+1))
+    return [(timestamp, timestamp * timestep) for timestamp in range(1, number_of_scenes + 1)]
 
-def _run_VQA_process(video_path: str, shared_dict: dict, lock) -> int:
+def _spreadOrder(items: list) -> list:
+    """
+    Reorders items so that every prefix of the result is spread evenly over the original list
+    (middle first, then the middles of both halves, ...).
+    """
+    ordered = list()
+    queue = [(0, len(items))]
+    while queue:
+        low, high = queue.pop(0)
+        if low >= high:
+            continue
+        middle = (low + high) // 2
+        ordered.append(items[middle])
+        queue.append((low, middle))
+        queue.append((middle + 1, high))
+    return ordered
+
+def _run_VQA_process(video_path: str, shared_dict: dict, lock, accel: str = "none", thread_budget: Union[tuple, None] = None, timings: Union[dict, None] = None) -> int:
 
     """
     Runs the VQA process on a given video file and stores the results in a shared dictionary.
@@ -189,6 +475,9 @@ def _run_VQA_process(video_path: str, shared_dict: dict, lock) -> int:
     - video_path (str): Full path to the video file.
     - shared_dict (dict): A multiprocessing manager dictionary to store results.
     - lock: A multiprocessing lock for thread-safe operations.
+    - accel (str, optional): CPU inference acceleration passed to vqa.py. Default is "none".
+    - thread_budget (tuple, optional): (compute threads, decoder threads) of vqa.py. Default lets vqa.py use every core.
+    - timings (dict, optional): A multiprocessing manager dictionary collecting (scored files, seconds) per worker PID.
 
     Returns:
     - int: Return code of the subprocess execution (0 if successful, non-zero if an error occurs).
@@ -202,12 +491,18 @@ def _run_VQA_process(video_path: str, shared_dict: dict, lock) -> int:
     name = os.path.basename(video_path)[:-4]
 
     # Construct the command for VQA execution
-    command = [sys.executable, "/app/FastVQA-and-FasterVQA/vqa.py", "-v", video_path]
+    command = [sys.executable, "/app/FastVQA-and-FasterVQA/vqa.py", "-m", VQA_MODEL, "-v", video_path, "-a", accel]
+    env = None
+    if thread_budget is not None:
+        command += ["--threads", str(thread_budget[0]), "--decoder_threads", str(thread_budget[1])]
+        # OpenMP/MKL pools are sized when torch is imported, before vqa.py can set them
+        env = dict(os.environ, OMP_NUM_THREADS=str(thread_budget[0]), MKL_NUM_THREADS=str(thread_budget[0]))
     logger.debug(f"Starting VQA calculation on file {name} (Video ID: {video_id}) with PID {os.getpid()}")
 
+    start = time.perf_counter()
     try:
         # Run the command with a timeout of 20 minutes (1200 seconds)
-        result = subprocess.run(command, capture_output=True, text=True, shell=False, timeout=1200)
+        result = resource_monitor.run(command, capture_output=True, text=True, shell=False, timeout=1200, env=env)
     except subprocess.TimeoutExpired:
         logger.error(f"Timeout expired for file {name} after 20 minutes.")
         return 1
@@ -237,21 +532,29 @@ def _run_VQA_process(video_path: str, shared_dict: dict, lock) -> int:
     if VQA is None:
         logger.warning(f"No VQA score found for {name}")
 
+    elapsed = time.perf_counter() - start
+    logger.debug(f"VQA of {name} took {elapsed:.1f}s (PID {os.getpid()})")
+
     # Append the VQA result to the shared dictionary in a thread-safe manner
+    # (values of a manager dict are copies, so the list has to be assigned back)
     with lock:
         if name in shared_dict:
-            shared_dict[name].append(VQA)
+            shared_dict[name] = shared_dict[name] + [VQA]
         else:
             shared_dict[name] = [VQA]
+        if timings is not None:
+            count, seconds = timings.get(os.getpid(), (0, 0.0))
+            timings[os.getpid()] = (count + 1, seconds + elapsed)
 
     return result.returncode
 
-def _prepareRes_test(VPC: VideoProcessingConfig)-> tuple:
+def _prepareRes_test(VPC: VideoProcessingConfig, scenes: Union[list, None] = None)-> tuple:
     """
     Prepares test video files by extracting scenes at specific timestamps and encoding them at different resolutions.
 
         Args:
             VPC (VideoProcessingConfig): Video processing configuration
+            scenes (list, optional): (scene id, start time) tuples to encode. Default is num_of_tests evenly spaced scenes.
 
         Returns:
             list: list of created files
@@ -260,36 +563,42 @@ def _prepareRes_test(VPC: VideoProcessingConfig)-> tuple:
 
     # Calculate timestamps for scene extraction
     res_settings = VPC.test_settings["Resolution_calculation"]
-    timestep = int(VPC.orig_duration/(res_settings["num_of_tests"]+1))
+    if scenes is None:
+        scenes = _sampleScenes(VPC, res_settings["num_of_tests"], res_settings["scene_length"])
 
     VPC.setDuration(res_settings["scene_length"])
     VPC.setOutputCQ(res_settings["cq_value"])
 
     passed = True
 
-    for timestamp in range(res_settings["num_of_tests"]):
-        timestamp = timestamp + 1
+    for timestamp, start in scenes:
+
+        scene_VPC = VPC.create_copy()
+        scene_VPC.setOutputFileName(f"{timestamp}_scene")
+        scene_VPC.setStart(start)
+        variants = list()
 
         for h_resolution in res_settings["testing_resolutions"]:
 
             test_VPC = VPC.create_copy()
             test_VPC.setOutputFileName(f"{timestamp}_{h_resolution}_cq{res_settings["cq_value"]}")
-            test_VPC.setStart(timestamp * timestep)
+            test_VPC.setStart(start)
             test_VPC.setOutputRes(h_resolution)
 
             created_files.append(test_VPC.output_file_path)
-
-            # Perform encoding using the compressor module
+            variants.append(test_VPC)
             logger.debug(f"Creating test file {test_VPC.output_file_path}")
-            if not compressor2.compress(test_VPC):
-                passed = False
+
+        # Perform encoding using the compressor module
+        if not compressor2.compress_variants(scene_VPC, variants):
+            passed = False
 
     return created_files, passed
 
 #endregion
 
 # region Basic Tests  
-def getVMAF(reference_file: str, distorted_file: str, VPC, threads: int = 8) -> Union[float, None]:
+def getVMAF(reference_file: str, distorted_file: str, VPC, threads: int = 8, reference_filter: Union[str, None] = None) -> Union[float, None]:
     """
     Computes VMAF (Video Multi-Method Assessment Fusion) score between a reference video
     and a distorted video using FFmpeg.
@@ -298,28 +607,50 @@ def getVMAF(reference_file: str, distorted_file: str, VPC, threads: int = 8) ->
     - reference_file (str): Path to the reference (original) video file.
     - distorted_file (str): Path to the distorted (compressed) video file.
     - threads (int): Number of threads to use for VMAF computation. Default is 8.
+    - reference_filter (str, optional): Filter chain applied to the reference before scoring, e.g. the
+      encode filter chain from compressor2.video_filter_chain when the reference is the untouched source segment.
 
     Returns:
     - float: VMAF score (higher is better), or None if an error occurs.
     """
+    memo = metric_store.database(VPC)
+    if memo is not None:
+        clip = metric_store.content_hash(distorted_file)
+        params = _vmafParams(reference_file, reference_filter)
+        vmaf_score = metric_store.lookup(memo, clip, "vmaf", VMAF_MODEL, params)
+        if vmaf_score is not None:
+            logger.debug(f"VMAF of {distorted_file} taken from the metric store: {vmaf_score}")
+            return vmaf_score
 
      # Define the ffmpeg command to compute VMAF with multithreading
     output_file = r"VMAFlog.json"
     if "AV1" in VPC.profile["function"][1].upper():
+        distorted_decoder = ['-hwaccel', 'none', '-c:v',  'libdav1d']
+    else:
+        distorted_decoder = []
+
+    if reference_filter is None:
         command = [
             'ffmpeg',
-            '-hwaccel', 'none', '-c:v',  'libdav1d', '-i', reference_file,        # Input reference file
-            '-hwaccel', 'none', '-c:v',  'libdav1d', '-i', distorted_file,        # Input distorted file
+            *distorted_decoder, '-i', reference_file,        # Input reference file
+            *distorted_decoder, '-i', distorted_file,        # Input distorted file
             '-lavfi', f'libvmaf=n_threads={threads}:log_path={output_file}',  # VMAF with multithreading and log output
             '-f', 'null', '-'            # No output file, just compute VMAF
         ]
 
     else:
+        # Source segment as reference: bring it to the encoded geometry and bit depth inside the graph.
+        # libvmaf takes the distorted stream as its first input.
+        filter_graph = (
+            f"[0:v]{reference_filter},format=yuv420p10le,setpts=PTS-STARTPTS[ref];"
+            f"[1:v]format=yuv420p10le,setpts=PTS-STARTPTS[dist];"
+            f"[dist][ref]libvmaf=n_threads={threads}:log_path={output_file}"
+        )
         command = [
             'ffmpeg',
-            '-i', reference_file,        # Input reference file
-            '-i', distorted_file,        # Input distorted file
-            '-lavfi', f'libvmaf=n_threads={threads}:log_path={output_file}',  # VMAF with multithreading and log output
+            '-i', reference_file,                            # Input source segment
+            *distorted_decoder, '-i', distorted_file,        # Input distorted file
+            '-lavfi', filter_graph,
             '-f', 'null', '-'            # No output file, just compute VMAF
         ]
 
@@ -327,7 +658,7 @@ def getVMAF(reference_file: str, distorted_file: str, VPC, threads: int = 8) ->
 
     try:
         # Run the command
-        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=False)
+        process = resource_monitor.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=False)
 
         # Check if the process completed successfully
         if process.returncode != 0:
@@ -351,12 +682,129 @@ def getVMAF(reference_file: str, distorted_file: str, VPC, threads: int = 8) ->
                     if match: vmaf_score = float(match[0])
 
         if vmaf_score is not None:
+            if memo is not None:
+                metric_store.record(memo, clip, "vmaf", VMAF_MODEL, params, vmaf_score)
             return vmaf_score
         else:
             logger.error("VMAF score not found in the output JSON.")
 
     except Exception as e:
         logger.error(f"Unexpected error while computing VMAF: {e}")
+
+def getVMAF_multi(reference_file: str, distorted_files: list, VPC, threads: int = 8, reference_filter: Union[str, None] = None) -> list:
+    """
+    Computes VMAF scores of several distorted videos against one reference in a single FFmpeg pass.
+
+    The reference is decoded (and filtered) once, split and fed to one libvmaf instance per
+    distorted input. Every pair writes its own JSON log next to the distorted file.
+
+    Parameters:
+    - reference_file (str): Path to the reference video file.
+    - distorted_files (list): Paths to the distorted (compressed) video files.
+    - threads (int): Total number of threads shared by the libvmaf instances. Default is 8.
+    - reference_filter (str, optional): Filter chain applied to the reference before scoring, see getVMAF.
+
+    Returns:
+    - list: VMAF score for each distorted file in input order, None where the score is missing.
+    """
+    memo = metric_store.database(VPC)
+    if memo is None:
+        return _computeVMAF_multi(reference_file, distorted_files, VPC, threads, reference_filter)
+
+    # Only files without a stored score are decoded and scored
+    params = _vmafParams(reference_file, reference_filter)
+    clips = [metric_store.content_hash(distorted_file) for distorted_file in distorted_files]
+    vmaf_scores = [metric_store.lookup(memo, clip, "vmaf", VMAF_MODEL, params) for clip in clips]
+    missing = [i for i, score in enumerate(vmaf_scores) if score is None]
+    logger.debug(f"VMAF metric store: {len(distorted_files) - len(missing)} stored, {len(missing)} to score")
+
+    computed = _computeVMAF_multi(reference_file, [distorted_files[i] for i in missing], VPC, threads, reference_filter)
+    for i, score in zip(missing, computed):
+        vmaf_scores[i] = score
+        metric_store.record(memo, clips[i], "vmaf", VMAF_MODEL, params, score)
+    return vmaf_scores
+
+def _vmafParams(reference_file: str, reference_filter: Union[str, None]) -> dict:
+    """
+    Metric store parameters of a VMAF score: the reference content, its filter chain and the pooling.
+    """
+    return {
+        "reference": metric_store.content_hash(reference_file),
+        "reference_filter": reference_filter,
+        "n_subsample": 1,
+        "pool": "harmonic_mean"
+    }
+
+def _computeVMAF_multi(reference_file: str, distorted_files: list, VPC, threads: int = 8, reference_filter: Union[str, None] = None) -> list:
+    """
+    Runs the single pass VMAF of getVMAF_multi without the metric store.
+    """
+    if not distorted_files:
+        return list()
+
+    if "AV1" in VPC.profile["function"][1].upper():
+        distorted_decoder = ['-hwaccel', 'none', '-c:v',  'libdav1d']
+    else:
+        distorted_decoder = []
+
+    count = len(distorted_files)
+    threads_per_pair = max(1, threads // count)
+    log_files = [os.path.splitext(distorted_file)[0] + "_vmaf.json" for distorted_file in distorted_files]
+
+    if reference_filter is None:
+        reference_chain = "setpts=PTS-STARTPTS"
+        distorted_chain = "setpts=PTS-STARTPTS"
+        command = ['ffmpeg', *distorted_decoder, '-i', reference_file]
+    else:
+        reference_chain = f"{reference_filter},format=yuv420p10le,setpts=PTS-STARTPTS"
+        distorted_chain = "format=yuv420p10le,setpts=PTS-STARTPTS"
+        command = ['ffmpeg', '-i', reference_file]
+
+    for distorted_file in distorted_files:
+        command = command + [*distorted_decoder, '-i', distorted_file]
+
+    # Decode the reference once and split it to every libvmaf instance (distorted stream first)
+    filter_graph = [f"[0:v]{reference_chain},split={count}" + "".join(f"[ref{i}]" for i in range(count))]
+    for i, log_file in enumerate(log_files):
+        filter_graph.append(f"[{i+1}:v]{distorted_chain}[dist{i}]")
+        filter_graph.append(f"[dist{i}][ref{i}]libvmaf=n_threads={threads_per_pair}:log_fmt=json:log_path={log_file}[vmaf{i}]")
+
+    command = command + ['-filter_complex', ";".join(filter_graph)]
+    for i in range(count):
+        command = command + ['-map', f'[vmaf{i}]', '-f', 'null', '-']
+
+    logger.debug(f"ffmpeg multi vmaf command: {command}")
+
+    try:
+        process = resource_monitor.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=False)
+
+        if process.returncode != 0:
+            logger.error(f"FFmpeg finished with errors. Exit code: {process.returncode}")
+            logger.error(process.stderr.strip())
+            return [None] * count
+
+    except Exception as e:
+        logger.error(f"Unexpected error while computing VMAF: {e}")
+        return [None] * count
+
+    logger.debug(f"VMAF calculation completed successfully")
+
+    vmaf_scores = list()
+    for log_file in log_files:
+        vmaf_scores.append(_readVMAFlog_json(log_file))
+    return vmaf_scores
+
+def _readVMAFlog_json(log_file: str) -> Union[float, None]:
+    """
+    Reads the pooled harmonic mean VMAF score from a libvmaf JSON log.
+    """
+    try:
+        with open(log_file, 'r') as file:
+            data = json.load(file)
+        return float(data["pooled_metrics"]["vmaf"]["harmonic_mean"])
+    except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        logger.error(f"VMAF score not found in {log_file}: {e}")
+        return None
 #endregion
 
 # region getCQ
@@ -370,72 +818,138 @@ def getCQ(VPC: VideoProcessingConfig) -> bool:
     Returns:
         bool: True if conversion succeeded, False otherwise
     """  
-    cq_values = VPC.test_settings["CQ_calculation"]["cq_values"]
-    if len(cq_values) != 4:
+    cq_settings = VPC.test_settings["CQ_calculation"]
+    search = cq_settings.get("search", {}).get("Enabled", False)
+
+    cq_values = cq_settings["cq_values"]
+    if len(cq_values) != 4 and not search:
         logger.error("cq values list different size")
         return False
     
     cq_values.sort()
     cq_VPC = VPC.create_copy()
     name = VPC.output_file_name + "_cq"
-    cq_VPC.setWorkspace(os.path.join(VPC.workspace, name))
     number_of_scenes = cq_VPC.test_settings["CQ_calculation"]["number_of_scenes"]
+    # Scene crop, reference and the test encodes of every scene
+    stage_size = workspace_manager.estimate_bytes(VPC, number_of_scenes * cq_settings["scene_length"] * (len(cq_values) + 2), 1.5)
+    with workspace_manager.reserve(VPC, "cq", name, stage_size) as workspace:
+        cq_VPC.setWorkspace(workspace)
+
+        scenes = _sampleScenes(cq_VPC, number_of_scenes, cq_settings["scene_length"])
+        reference_files = dict()
+        reference_filter = None
+
+        #genereate reference videos
+        for timestamp, start in scenes:
+
+            cq_VPC.setOutputFileName(f"{timestamp}_reference")
+            cq_VPC.setStart(start)
+            cq_VPC.setDuration(VPC.test_settings["CQ_calculation"]["scene_length"])
+            cq_VPC.setOutputCQ(VPC.test_settings["CQ_calculation"]["cq_reference"])
+
+            if cq_settings.get("source_reference", False):
+                # Stream copy of the source segment, cut exactly like compress() cuts the test encodes
+                cq_VPC.setOutputFileName(f"{timestamp}_source")
+                cq_VPC.setSourcePath(cq_VPC.orig_file_path)
+                cq_VPC.setTargetPath(cq_VPC.output_file_path)
+                logger.debug(f"Cutting source reference {cq_VPC.output_file_name}")
+
+                passed = compressor2.temporal_crop(cq_VPC)
+                reference_filter = compressor2.video_filter_chain(cq_VPC)
+            else:
+                logger.debug(f"Creating reference file {cq_VPC.output_file_name}")
+                _, passed = _createAndTestVMAF(cq_VPC, reference_video=None)
 
-    results = dict()
-    timestep = int(cq_VPC.orig_duration/(number_of_scenes+1))
-    reference_files = list()
+            if not passed:
+                logger.error("Media creation failed")
+                return False
+            reference_files[timestamp] = cq_VPC.output_file_path
+
+        threshold_variable = float(VPC.getProfileValue(VPC.profile["test_settings"], "cq_threashold"))
+
+        base_VMAFs = list()
+        if search:
+            calculated_CQs = list()
+            unbracketed = list()
+            for timestamp, start in scenes:
+                solution, base_VMAF, bracketed, passed = _searchCQ(cq_VPC, timestamp, start, reference_files[timestamp], threshold_variable, reference_filter)
+                if not passed:
+                    logger.error("Media creation failed")
+                    return False
+                if not bracketed:
+                    unbracketed.append(timestamp)
+                if solution is not None:
+                    calculated_CQs.append(solution)
+                    base_VMAFs.append(base_VMAF)
+            if unbracketed:
+                logger.info(f"CQ search did not bracket the threshold for scenes {unbracketed}, their CQ is a clamped lower bound")
+        else:
+            calculated_CQs, base_VMAFs, passed = _gridCQ(cq_VPC, scenes, reference_files, threshold_variable, reference_filter)
+            if not passed:
+                logger.error("Media creation failed")
+                return False
 
-    #genereate reference videos
-    for timestamp in range(number_of_scenes):
-        timestamp = timestamp + 1
+        # Filter worst scenes and compute average CQ
+        calculated_CQs = sorted(calculated_CQs)
+        logger.debug(f"Calculated CQ values: {calculated_CQs}")
 
-        cq_VPC.setOutputFileName(f"{timestamp}_reference")
-        cq_VPC.setStart(timestamp * timestep)
-        cq_VPC.setDuration(VPC.test_settings["CQ_calculation"]["scene_length"])
-        cq_VPC.setOutputCQ(VPC.test_settings["CQ_calculation"]["cq_reference"])
+        to_keep = math.ceil(len(calculated_CQs)*VPC.test_settings["CQ_calculation"]["keep_best_scenes"])
+        calculated_CQs = calculated_CQs[:to_keep]
+        logger.debug(f"Filtered CQ values: {calculated_CQs}")
 
-        logger.debug(f"Creating reference file {cq_VPC.output_file_name}")
-        
-        _, passed = _createAndTestVMAF(cq_VPC, reference_video=None)
-        if not passed:
-            logger.error("Media creation failed")
+        if not calculated_CQs:
+            logger.error("No valid CQ values calculated.")
             return False
-        reference_files.append(cq_VPC.output_file_path)
-    reference_files.sort() #this will break with 9 or more scenes
 
-    results = dict()
+        target_cq = sum(calculated_CQs) / len(calculated_CQs)
+        target_cq = round(target_cq * 2) / 2  # Round to nearest 0.5
+    
+        logger.info(f"Calculated CQ: {target_cq}")
+        VPC.setOutputCQ(target_cq)
 
-    #get VMAF values
-    position_list = [0, 2, 3]
-    for position in position_list:
-        for timestamp in range(number_of_scenes):
-            timestamp = timestamp + 1
+        # The target CQ is chosen to lose threshold_variable VMAF against the base CQ encode
+        if base_VMAFs:
+            VPC.predicted_vmaf = sum(base_VMAFs) / len(base_VMAFs) - threshold_variable
+            logger.debug(f"Predicted VMAF at CQ {target_cq}: {VPC.predicted_vmaf}")
 
-            if not isinstance(results.get(timestamp), dict):
-                results[timestamp] = dict()
+        compressor2.delete_file(VPC, cq_VPC.workspace)
+        return True
 
-            cq_VPC.setOutputFileName(f"{timestamp}_{cq_values[position]}")
-            cq_VPC.setStart(timestamp * timestep)
-            cq_VPC.setOutputCQ(cq_values[position])
+def _gridCQ(cq_VPC: VideoProcessingConfig, scenes: list, reference_files: dict, threshold_variable: float, reference_filter: Union[str, None] = None) -> tuple[list, list, bool]:
+    """
+    Encodes every scene at the fixed cq_values grid and solves a quadratic fit of the VMAF drop for the threshold.
 
-            logger.debug(f"Getting VMAF result for: {cq_VPC.output_file_name}")
-        
-            results[timestamp][cq_values[position]], passed = _createAndTestVMAF(cq_VPC, reference_files[timestamp-1])
-            if not passed:
-                logger.error("Media creation failed")
-                return False
+    Args:
+        cq_VPC (VideoProcessingConfig): Video processing configuration of the CQ test
+        scenes (list): (scene id, start time) tuples
+        reference_files (dict): Scene id -> reference file path
+        threshold_variable (float): Allowed VMAF drop against the lowest CQ value
+        reference_filter (str, optional): Filter chain applied to the references inside the VMAF graph
 
-    # Compute optimized VMAF for CQ 18
-    cq_VPC.setOutputFileName(f"1_{cq_values[1]}")
-    cq_VPC.setStart(1*timestep)
-    cq_VPC.setOutputCQ(cq_values[1])
-    logger.debug(f"Getting VMAF result for: {cq_VPC.output_file_name}")
+    Returns:
+        tuple: (list of calculated CQ values, list of VMAF scores at the lowest CQ value of the solved scenes,
+                True if all media was created)
+    """
+    import numpy as np
 
-    optimization_VMAF, passed = _createAndTestVMAF(cq_VPC, reference_files[0])
-    if not passed:
-        logger.error("Media creation failed")
-        return False
+    cq_values = cq_VPC.test_settings["CQ_calculation"]["cq_values"]
+    results = dict()
+
+    #get VMAF values, one VMAF pass per scene
+    position_list = [0, 2, 3]
+    first_scene = scenes[0][0]
+    for timestamp, start in scenes:
+        scene_cq_values = [cq_values[position] for position in position_list]
 
+        # Compute optimized VMAF for CQ 18 on the first scene only
+        if timestamp == first_scene:
+            scene_cq_values.append(cq_values[1])
+
+        results[timestamp], passed = _createAndTestVMAF_multi(cq_VPC, timestamp, start, scene_cq_values, reference_files[timestamp], reference_filter)
+        if not passed:
+            return list(), list(), False
+
+    optimization_VMAF = results[first_scene][cq_values[1]]
     for key in results.keys():
         results[key][cq_values[1]] = optimization_VMAF
 
@@ -451,52 +965,146 @@ def getCQ(VPC: VideoProcessingConfig) -> bool:
 
     # Calculate CQ values using quadratic regression
     calculated_CQs = list()
+    base_VMAFs = list()
     for key in subtracted_results.keys():
         x = np.array(list(subtracted_results[key].keys()))  # The x-values
         y = np.array(list(subtracted_results[key].values()))  # The y-values
         a, b, c = np.polyfit(x, y, 2)
         logger.debug(f"CQ polynomial: {a}, {b}, {c}")
 
-        threshold_variable = np.float64(VPC.getProfileValue(VPC.profile["test_settings"], "cq_threashold"))
         discriminant = b**2 - 4*a*(c-threshold_variable)
         logger.debug(f"CQ discriminant: {discriminant}")
 
         if discriminant >= 0:
             solution = (-b + np.sqrt(discriminant)) / (2 * a)
             calculated_CQs.append(solution)
+            base_VMAFs.append(results[key][cq_values[0]])
         else:
             logger.error("No valid CQ solution found.")
 
-    # Filter worst scenes and compute average CQ
-    calculated_CQs = sorted(calculated_CQs)
-    logger.debug(f"Calculated CQ values: {calculated_CQs}")
+    return calculated_CQs, base_VMAFs, True
+
+def _searchCQ(cq_VPC: VideoProcessingConfig, timestamp: int, start: int, reference_file: str, threshold_variable: float, reference_filter: Union[str, None] = None) -> tuple[Union[float, None], Union[float, None], bool, bool]:
+    """
+    Searches for the CQ at which the VMAF drop of one scene crosses the threshold.
 
-    to_keep = math.ceil(len(calculated_CQs)*VPC.test_settings["CQ_calculation"]["keep_best_scenes"])
-    calculated_CQs = calculated_CQs[:to_keep]
-    logger.debug(f"Filtered CQ values: {calculated_CQs}")
+    The drop is measured against the lowest cq_values entry of the same scene. The root is
+    bracketed starting from the profile defalut_cq and refined with the Illinois variant of
+    regula falsi until the bracket is narrower than the configured tolerance.
 
-    if not calculated_CQs:
-        logger.error("No valid CQ values calculated.")
-        return False
+    If the drop stays below the threshold up to max_cq (or max_encodes runs out while
+    bracketing), there is no root to refine. The highest measured CQ is returned as an
+    unbracketed result: the crossing lies above it, so it is a lower bound clamped to
+    [lowest cq_values entry, max_cq].
 
-    target_cq = sum(calculated_CQs) / len(calculated_CQs)
-    target_cq = round(target_cq * 2) / 2  # Round to nearest 0.5
-    
-    logger.info(f"Calculated CQ: {target_cq}")
-    VPC.setOutputCQ(target_cq)
+    Args:
+        cq_VPC (VideoProcessingConfig): Video processing configuration of the CQ test
+        timestamp (int): Scene id
+        start (int): Scene start time in seconds
+        reference_file (str): Reference file of the scene
+        threshold_variable (float): Allowed VMAF drop against the lowest CQ value
+        reference_filter (str, optional): Filter chain applied to the reference inside the VMAF graph
 
-    compressor2.delete_file(VPC, cq_VPC.workspace)
-    return True
+    Returns:
+        tuple: (CQ where the drop equals the threshold or None, VMAF score at the base CQ or None,
+                True if the threshold was bracketed (False for a lower bound), True if all media was created)
+    """
+    search_settings = cq_VPC.test_settings["CQ_calculation"]["search"]
+    tolerance = search_settings.get("tolerance", 1)
+    cq_step = search_settings.get("cq_step", 1)
+    bracket_step = search_settings.get("bracket_step", 6)
+    max_cq = search_settings.get("max_cq", 51)
+    max_encodes = search_settings.get("max_encodes", 6)
+
+    measured = dict()
+
+    def measure(cq_list: list) -> bool:
+        missing = [cq for cq in cq_list if cq not in measured]
+        if not missing:
+            return True
+        VMAF_values, passed = _createAndTestVMAF_multi(cq_VPC, timestamp, start, missing, reference_file, reference_filter)
+        if not passed or None in VMAF_values.values():
+            return False
+        measured.update(VMAF_values)
+        return True
+
+    def drop(cq: float) -> Union[float, None]:
+        # VMAF drop against the base CQ minus threshold, positive once the threshold is crossed
+        if not measure([cq]):
+            return None
+        return measured[base_cq] - measured[cq] - threshold_variable
+
+    def snap(cq: float) -> float:
+        return round(cq / cq_step) * cq_step
+
+    base_cq = min(cq_VPC.test_settings["CQ_calculation"]["cq_values"])
+    low, f_low = base_cq, -threshold_variable
+    high = snap(float(cq_VPC.getProfileValue(cq_VPC.profile["test_settings"], "defalut_cq")))
+    if high <= low:
+        high = low + bracket_step
+
+    # Base and default CQ are both known upfront, score them in one VMAF pass
+    if not measure([base_cq, high]):
+        return None, None, False, False
+
+    # Bracket the threshold crossing
+    f_high = drop(high)
+    if f_high is None:
+        return None, None, False, False
+    while f_high < 0:
+        if high >= max_cq or len(measured) >= max_encodes:
+            bound = min(max(high, base_cq), max_cq)
+            logger.warning(f"Scene {timestamp}: VMAF drop stays below threshold up to CQ {high} "
+                           f"({'max_cq' if high >= max_cq else 'max_encodes'} reached), "
+                           f"threshold not bracketed, using CQ {bound} as a lower bound")
+            return bound, measured[base_cq], False, True
+        low, f_low = high, f_high
+        high = min(high + bracket_step, max_cq)
+        f_high = drop(high)
+        if f_high is None:
+            return None, None, False, False
+
+    # Illinois regula falsi inside the bracket
+    retained = 0
+    while high - low > tolerance and len(measured) < max_encodes:
+        candidate = snap(low - f_low * (high - low) / (f_high - f_low))
+        candidate = min(max(candidate, low + cq_step), high - cq_step)
+        if candidate <= low or candidate >= high:
+            break
+
+        f_candidate = drop(candidate)
+        if f_candidate is None:
+            return None, None, False, False
+
+        if f_candidate < 0:
+            low, f_low = candidate, f_candidate
+            if retained == 1:
+                f_high = f_high / 2
+            retained = 1
+        else:
+            high, f_high = candidate, f_candidate
+            if retained == -1:
+                f_low = f_low / 2
+            retained = -1
+
+    # Interpolate the crossing inside the final bracket from the measured values
+    f_low = drop(low)
+    f_high = drop(high)
+    solution = low - f_low * (high - low) / (f_high - f_low)
+    solution = min(max(solution, low), high)
+    logger.debug(f"Scene {timestamp}: CQ search measured {sorted(measured)}, solution {solution}")
+    return solution, measured[base_cq], True, True
 
 #endregion
 
-def _createAndTestVMAF(VPC: VideoProcessingConfig, reference_video: Union[str, None] = None) -> tuple[Union[float, None], bool]:
+def _createAndTestVMAF(VPC: VideoProcessingConfig, reference_video: Union[str, None] = None, reference_filter: Union[str, None] = None) -> tuple[Union[float, None], bool]:
     """
     Compresses a video segment and calculates VMAF if a reference video is provided.
 
     Args:
         VPC (VideoProcessingConfig): Video processing configuration
         reference_video (str, optional): Path to the reference video for VMAF calculation. Default is None.
+        reference_filter (str, optional): Filter chain applied to the reference inside the VMAF graph. Default is None.
 
     Returns:
     - float: VMAF score if reference video is provided, else None.
@@ -504,12 +1112,160 @@ def _createAndTestVMAF(VPC: VideoProcessingConfig, reference_video: Union[str, N
 
     passed = compressor2.compress(VPC)
     if reference_video is not None:
-        VMAF_value = getVMAF(reference_video, VPC.output_file_path, VPC, VPC.test_settings["CQ_calculation"]["threads"])
+        VMAF_value = getVMAF(reference_video, VPC.output_file_path, VPC, load_controller.limit("vmaf", VPC.test_settings["CQ_calculation"]["threads"]), reference_filter)
         logger.debug(f"VMAF Score: {VMAF_value}")
         return VMAF_value, passed
     else:
         return None, passed
 
+def _createAndTestVMAF_multi(VPC: VideoProcessingConfig, timestamp: int, start: int, cq_list: list, reference_video: str, reference_filter: Union[str, None] = None) -> tuple[dict, bool]:
+    """
+    Compresses one scene at several CQ values and scores all of them against the reference in a single VMAF pass.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration of the CQ test
+        timestamp (int): Scene id
+        start (int): Scene start time in seconds
+        cq_list (list): CQ values to encode
+        reference_video (str): Path to the reference video for VMAF calculation
+        reference_filter (str, optional): Filter chain applied to the reference inside the VMAF graph. Default is None.
+
+    Returns:
+    - tuple: (dict of CQ -> VMAF score, True if all media was created)
+    """
+    scene_VPC = VPC.create_copy()
+    scene_VPC.setOutputFileName(f"{timestamp}_scene")
+    scene_VPC.setStart(start)
+    variants = list()
+    distorted_files = list()
+
+    for cq in cq_list:
+        variant = VPC.create_copy()
+        variant.setOutputFileName(f"{timestamp}_{cq}")
+        variant.setStart(start)
+        variant.setOutputCQ(cq)
+        logger.debug(f"Getting VMAF result for: {variant.output_file_name}")
+
+        variants.append(variant)
+        distorted_files.append(variant.output_file_path)
+
+    passed = compressor2.compress_variants(scene_VPC, variants)
+    if not passed:
+        return dict(), False
+
+    VMAF_values = getVMAF_multi(reference_video, distorted_files, VPC, load_controller.limit("vmaf", VPC.test_settings["CQ_calculation"]["threads"]), reference_filter)
+    logger.debug(f"VMAF Scores: {VMAF_values}")
+    return dict(zip(cq_list, VMAF_values)), passed
+
+#region Quality audit
+def auditVMAF(VPC: VideoProcessingConfig) -> bool:
+    """
+    Samples the VMAF of the final output against the source on short segments spread
+    across the title and records the distribution next to the CQ test prediction.
+
+    Both inputs are seeked with -ss before -i, so sources without fast seek support are
+    not audited (their input seek is not reliable). The source gets the filter chain of the
+    encode (profile -vf, crop and scale) and libvmaf scores every n_subsample-th frame only.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration of the finished output
+
+    Returns:
+        bool: True if every segment was scored, False otherwise or when the audit was skipped
+    """
+    if not (VPC.profile.get("FS_enable", [None, False])[1] and VPC.FS_support):
+        logger.warning("VMAF audit skipped, the source does not support fast seek")
+        return False
+
+    audit_settings = VPC.test_settings["Quality_audit"]
+    number_of_segments = audit_settings.get("number_of_segments", 8)
+    segment_length = audit_settings.get("segment_length", 5)
+    n_subsample = audit_settings.get("n_subsample", 5)
+    threads = audit_settings.get("threads", 8)
+
+    audit_folder = os.path.join(VPC.workspace, VPC.output_file_name + "_audit")
+    if not os.path.exists(audit_folder):
+        os.makedirs(audit_folder)
+
+    # Evenly spaced segments, the first and last 5 % (logos, credits) are skipped
+    edge = VPC.orig_duration * 0.05
+    timestep = (VPC.orig_duration - 2 * edge - segment_length) / max(1, number_of_segments - 1)
+    starts = [round(edge + i * timestep, 3) for i in range(number_of_segments)]
+
+    if "AV1" in VPC.profile["function"][1].upper():
+        distorted_decoder = ['-hwaccel', 'none', '-c:v',  'libdav1d']
+    else:
+        distorted_decoder = []
+    reference_filter = compressor2.video_filter_chain(VPC)
+
+    segments = list()
+    passed = True
+    for number, start in enumerate(starts):
+        log_file = os.path.join(audit_folder, f"{number}_vmaf.json")
+        vmaf_threads = load_controller.limit("vmaf", threads)
+        command = [
+            'ffmpeg',
+            *distorted_decoder, '-ss', str(start), '-t', str(segment_length), '-i', VPC.output_file_path,
+            '-ss', str(start), '-t', str(segment_length), '-i', VPC.orig_file_path,
+            '-filter_complex',
+            f"[1:v]{reference_filter},format=yuv420p10le,setpts=PTS-STARTPTS[ref];"
+            f"[0:v]format=yuv420p10le,setpts=PTS-STARTPTS[dist];"
+            f"[dist][ref]libvmaf=n_subsample={n_subsample}:n_threads={vmaf_threads}:log_fmt=json:log_path={log_file}",
+            '-f', 'null', '-'
+        ]
+        logger.debug(f"ffmpeg audit vmaf command: {command}")
+
+        process = resource_monitor.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=False)
+        if process.returncode != 0:
+            logger.error(f"VMAF audit of segment at {start}s failed. Exit code: {process.returncode}")
+            logger.error(process.stderr.strip())
+            passed = False
+            continue
+
+        try:
+            with open(log_file, 'r') as file:
+                pooled = json.load(file)["pooled_metrics"]["vmaf"]
+            segments.append({"start": start, "vmaf": pooled["harmonic_mean"], "min": pooled["min"]})
+            logger.debug(f"Audit segment at {start}s: VMAF {pooled['harmonic_mean']:.2f} (min {pooled['min']:.2f})")
+        except (OSError, json.JSONDecodeError, KeyError) as e:
+            logger.error(f"VMAF score not found in {log_file}: {e}")
+            passed = False
+
+    if not segments:
+        logger.error("VMAF audit produced no scores")
+        return False
+
+    scores = sorted(segment["vmaf"] for segment in segments)
+    report = {
+        "output": VPC.output_file_path,
+        "segments": segments,
+        "mean": sum(scores) / len(scores),
+        "min": scores[0],
+        "median": scores[len(scores) // 2],
+        "worst_frame": min(segment["min"] for segment in segments),
+        "prediction": {
+            "cq": VPC.output_cq,
+            "cq_threshold": float(VPC.getProfileValue(VPC.profile["test_settings"], "cq_threashold")),
+            "vmaf": VPC.predicted_vmaf if VPC.predicted_vmaf is not False else None,
+        },
+    }
+    if report["prediction"]["vmaf"] is not None:
+        report["deviation"] = report["mean"] - report["prediction"]["vmaf"]
+
+    report_file = os.path.join(VPC.workspace, VPC.output_file_name + "_vmaf_audit.json")
+    with open(report_file, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=1)
+
+    logger.info(f"VMAF audit on {len(segments)} segments: mean {report['mean']:.2f}, min {report['min']:.2f}, worst frame {report['worst_frame']:.2f}")
+    if "deviation" in report:
+        logger.info(f"Predicted VMAF {report['prediction']['vmaf']:.2f}, audit deviation {report['deviation']:+.2f}")
+        if report["deviation"] < -audit_settings.get("tolerance", 2):
+            logger.warning("Output quality is below the CQ test prediction")
+
+    compressor2.delete_file(VPC, audit_folder)
+    return passed
+#endregion
+
 #region Num of Channels
 def getNumOfChannels(
     orig_video_path: str, 
@@ -531,6 +1287,9 @@ def getNumOfChannels(
     - int: Number of unique channels (1, 2, 4, or 6).
     """
 
+    import numpy as np
+    import soundfile as sf
+
     name = str(os.path.basename(orig_video_path)[:-4]) + "_channels"
     work_folder = os.path.join(workspace, name)
 
@@ -539,11 +1298,11 @@ def getNumOfChannels(
             os.makedirs(work_folder)
             logger.debug(f'Directory "{work_folder}" created.')
 
-    act_duration = getDuration(orig_video_path)
+    act_duration = getDuration(orig_video_path, None)
 
-    if act_duration is not None and act_duration >= duration:
+    if act_duration:
 
-        audio_file = _extractAudio(orig_video_path, work_folder, duration)
+        audio_file = _extractAudio(orig_video_path, work_folder, min(duration, act_duration))
 
         y, sr = sf.read(audio_file) # Function to load the audio and extract the channels
         num_channels = y.shape[1] if len(y.shape) > 1 else 1  # Determine the number of channels
@@ -644,56 +1403,57 @@ def detectBlackbars(VPC: VideoProcessingConfig) -> bool:
     Returns:
         bool: True if conversion succeeded, False otherwise
     """
+    from PIL import Image
+
     blackbars_VPC = VPC.create_copy()
     name = VPC.output_file_name + "_blackDetection"
-    blackbars_VPC.setWorkspace(os.path.join(VPC.workspace, name))
-
     frames_to_detect = VPC.test_settings["Black_bar_detection"]["frames_to_detect"]
-    timestep = int(VPC.orig_duration/(frames_to_detect+1))
+    stage_size = frames_to_detect * VPC.orig_h_res * VPC.orig_v_res * 3  # uncompressed worst case of the PNGs
+    with workspace_manager.reserve(VPC, "blackDetection", name, stage_size) as workspace:
+        blackbars_VPC.setWorkspace(workspace)
 
-    # Initialize lists to hold the black pixel counts for each sampled frame
-    black_top = [0] * frames_to_detect
-    black_bottom = [0] * frames_to_detect
+        # Initialize lists to hold the black pixel counts for each sampled frame
+        black_top = [0] * frames_to_detect
+        black_bottom = [0] * frames_to_detect
 
-    # Process each frame for black bar detection
-    for timestamp in range(frames_to_detect):
-        timestamp = timestamp + 1
+        # Process each frame for black bar detection
+        for timestamp, frame_time in _sampleScenes(VPC, frames_to_detect):
 
-        # Define output filename and path for the extracted frame
-        picture_name = str(timestamp) + ".png"
-        target_name = os.path.join(blackbars_VPC.workspace, picture_name)
-        exportFrame(blackbars_VPC, target_name, timestamp*timestep)
+            # Define output filename and path for the extracted frame
+            picture_name = str(timestamp) + ".png"
+            target_name = os.path.join(blackbars_VPC.workspace, picture_name)
+            exportFrame(blackbars_VPC, target_name, frame_time)
         
-        # Open the image and load pixel data
-        im = Image.open(target_name, 'r')
-        pix = im.load()
-
-        # Count consecutive black pixels from the top
-        for i in range(0, im.size[1], 1):
-            if all(channel < 10 for channel in pix[im.size[0] // 2, i]):
-                black_top[timestamp-1] += 1
-            else:
-                break
-
-        # Count consecutive black pixels from the bottom
-        for i in range(im.size[1]-1, -1, -1):
-            if all(channel < 10 for channel in pix[im.size[0] // 2, i]):
-                black_bottom[timestamp-1] += 1
-            else:
-                break
-
-    # Use the minimum value across all frames to get a robust estimate
-    black_top_result = min(black_top)
-    black_bottom_result = min(black_bottom)
-
-    if black_bottom_result != 0 or black_top_result != 0:
-        logger.info(f"Black bars detected: {black_top_result}pix from top, {black_bottom_result}pix from bottom")
-    else:
-        logger.info("No black bars detected")
+            # Open the image and load pixel data
+            im = Image.open(target_name, 'r')
+            pix = im.load()
+
+            # Count consecutive black pixels from the top
+            for i in range(0, im.size[1], 1):
+                if all(channel < 10 for channel in pix[im.size[0] // 2, i]):
+                    black_top[timestamp-1] += 1
+                else:
+                    break
+
+            # Count consecutive black pixels from the bottom
+            for i in range(im.size[1]-1, -1, -1):
+                if all(channel < 10 for channel in pix[im.size[0] // 2, i]):
+                    black_bottom[timestamp-1] += 1
+                else:
+                    break
+
+        # Use the minimum value across all frames to get a robust estimate
+        black_top_result = min(black_top)
+        black_bottom_result = min(black_bottom)
+
+        if black_bottom_result != 0 or black_top_result != 0:
+            logger.info(f"Black bars detected: {black_top_result}pix from top, {black_bottom_result}pix from bottom")
+        else:
+            logger.info("No black bars detected")
 
-    VPC.crop = [black_top_result, black_bottom_result]
-    compressor2.delete_file(VPC, blackbars_VPC.workspace)
-    return True
+        VPC.crop = [black_top_result, black_bottom_result]
+        compressor2.delete_file(VPC, blackbars_VPC.workspace)
+        return True
 
 def exportFrame(VPC: VideoProcessingConfig, target_name_path: str, time: int, png_quality: int = 2) -> None:
     """
@@ -767,7 +1527,29 @@ def runTests(VPC: VideoProcessingConfig) -> bool:
     # Get original horizontal resolution of the video
     passed = True
     test_passed = True
+
+    # Scene analysis (if enabled), used by the tests below to pick their samples
+    resource_monitor.set_stage("sceneAnalysis")
+    if VPC.test_settings.get("Scene_analysis", {}).get("Enabled", False):
+        try:
+            VPC.scene_list = scene_analysis.analyze_scenes(VPC)
+        except Exception as e:
+            logger.warning("Scene analysis failed, using evenly spaced samples")
+            logger.debug("Failed due to reason:")
+            logger.debug("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+    # Complexity pre-test (if enabled), may narrow or disable the tests below
+    resource_monitor.set_stage("complexity")
+    if VPC.test_settings.get("Complexity_analysis", {}).get("Enabled", False):
+        try:
+            VPC.complexity = scene_analysis.analyze_complexity(VPC) or False
+        except Exception as e:
+            logger.warning("Complexity analysis failed, running the tests unchanged")
+            logger.debug("Failed due to reason:")
+            logger.debug("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+
     # Black bar detection (if enabled)
+    resource_monitor.set_stage("blackDetection")
     if VPC.test_settings["Black_bar_detection"]["Enabled"]:
         try:
             test_passed = detectBlackbars(VPC)
@@ -785,6 +1567,7 @@ def runTests(VPC: VideoProcessingConfig) -> bool:
         test_passed = True
 
     # Resolution calculation (if enabled)
+    resource_monitor.set_stage("res")
     if VPC.test_settings["Resolution_calculation"]["Enabled"]:
         try:
             test_passed = getRes_parallel(VPC)
@@ -802,6 +1585,7 @@ def runTests(VPC: VideoProcessingConfig) -> bool:
         test_passed = True
         
     # CQ (Constant Quality) calculation (if enabled)
+    resource_monitor.set_stage("cq")
     if VPC.test_settings["CQ_calculation"]["Enabled"]:
         try:
             test_passed = getCQ(VPC)
@@ -816,21 +1600,22 @@ def runTests(VPC: VideoProcessingConfig) -> bool:
     if not test_passed:
         passed = False
         test_passed = True
-    """
+
     # Audio channel detection (if enabled)
+    resource_monitor.set_stage("channels")
     if VPC.test_settings["Channels_calculation"]["Enabled"]:
+        channel_settings = VPC.test_settings["Channels_calculation"]
         try:
-            channels = getNumOfChannels(file, workspace, *settings["Channels_calculation"][1])
+            VPC.channels = getNumOfChannels(VPC.orig_file_path, VPC.workspace, channel_settings["simmilarity_cutoff"], channel_settings["duration"])
         except Exception as e:
             logger.warning("Unable to get number of audio chanels")
             logger.debug("Failed due to reason:")
             logger.debug("".join(traceback.format_exception(type(e), e, e.__traceback__)))
-            channels = 2
+            VPC.channels = 2
     else:
         logger.info("Channels calculation disabled")
-        channels = 2
-    logger.info(f"Export will have {channels} channels")
-    """
+    logger.info(f"Export will have {VPC.channels if VPC.channels else 'original'} channels")
+
     return passed
 #endregion
 
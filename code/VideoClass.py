@@ -2,6 +2,8 @@ from typing import List, Union
 import AVTest
 import os
 import compressor2
+import keyframe_index
+import container_index
 import yaml
 import subprocess
 import json
@@ -27,6 +29,10 @@ class VideoProcessingConfig:
     duration: Union[int, bool] = False
     subtitles: bool = False
     HDR_type: str = "uninit"
+    scene_list: Union[list, bool] = False
+    keyframe_index: Union[dict, bool] = False
+    predicted_vmaf: Union[float, bool] = False
+    complexity: Union[dict, bool] = False
 
     def __init__(self, input_file_path: str, output_file_name: str, workspace: str):
         """
@@ -87,6 +93,8 @@ class VideoProcessingConfig:
         self.orig_framerate = get_framerate(self.orig_file_path, self.tools_path)
         self.orig_duration = getDuration(self.orig_file_path, self.tools_path)
         self.FS_support = get_fast_seek_support(self.orig_file_path)
+        if self.test_settings.get("Keyframe_index", {}).get("Enabled", False) and not (self.profile.get("FS_enable", [None, False])[1] and self.FS_support):
+            self.keyframe_index = keyframe_index.load_index(self.orig_file_path, self.workspace) or False
         self.is_H265 = is_h265(self.orig_file_path)
         if not self.is_H265:
             self.profile["HDR_enable"][1] = False
@@ -441,48 +449,22 @@ def get_framerate(input_file, tools_path):
     logger.error(f"[get_framerate] Framerate detection failed")
     return False
 
-def get_fast_seek_support(file_path: str, scan_bytes: int = 1_048_576) -> bool:
+def get_fast_seek_support(file_path: str) -> bool:
     """
-    Determine whether a media file supports fast seek (HTTP byte‐range seeking).
+    Determine whether a media file has a seek index FFmpeg can use for input seeking.
 
-    For MP4-family files, “moov” atom must precede “mdat” atom.
-    For Matroska (MKV), the EBML “Cues” element (ID 0x1C53BB6B) must precede the first “Cluster” element (ID 0x1F43B675).
+    The container index is located with container_index.read_index: Matroska Cues
+    (directly or through the SeekHead, so Cues at the end of the file count) and the
+    sample tables of MP4-family files.
 
     Args:
         file_path: Path to the media file.
-        scan_bytes: Number of initial bytes to scan (default 1 MB).
 
     Returns:
-        True if the container’s index/meta atom appears before bulk media data; False otherwise.
+        True if the container has an index with at least one keyframe entry; False otherwise.
     """
-    ext = os.path.splitext(file_path)[1].lower()
-    try:
-        with open(file_path, "rb") as f:
-            data = f.read(scan_bytes)
-    except (OSError, IOError):
-        return False
-
-    if ext in (".mp4", ".m4v", ".mov", ".mp4v", ".ismv"):
-        idx_index = data.find(b"moov")
-        idx_data  = data.find(b"mdat")
-    elif ext == ".mkv":
-        # EBML IDs for Matroska:
-        #   Cues    -> 0x1C53BB6B
-        #   Cluster -> 0x1F43B675
-        cues_id    = b"\x1C\x53\xBB\x6B"
-        cluster_id = b"\x1F\x43\xB6\x75"
-        idx_index = data.find(cues_id)
-        idx_data  = data.find(cluster_id)
-    else:
-        # Unsupported container: assume no fast seek
-        return False
-
-    # Both index/meta and data must be present
-    if idx_index == -1 or idx_data == -1:
-        return False
-
-    # Fast‐seek if index/meta precedes bulk media
-    return idx_index < idx_data
+    index = container_index.read_index(file_path)
+    return index is not None and len(index["keyframes"]) > 0
 
 def is_h265(file_path: str, ffprobe_path: str = "ffprobe") -> bool:
     """
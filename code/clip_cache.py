@@ -0,0 +1,168 @@
+import threading
+import hashlib
+import shutil
+import json
+import os
+import logging
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+# Module level lock, VideoProcessingConfig copies are deepcopies and cannot share locks
+_lock = threading.Lock()
+
+
+def _settings(VPC) -> dict:
+    """Return the Clip_cache test settings, or None if the cache is disabled."""
+    settings = VPC.test_settings.get("Clip_cache", {})
+    if not settings.get("Enabled", False):
+        return None
+    return settings
+
+
+def cache_dir(VPC) -> str:
+    """
+    Directory of the cache. Without a configured path the cache lives next to the
+    title workspaces, so it is shared by all titles and survives deleted workspaces.
+    """
+    path = _settings(VPC).get("path")
+    if not path:
+        path = os.path.join(os.path.dirname(os.path.normpath(VPC.workspace)), "clip_cache")
+    return path
+
+
+def clip_key(VPC, cut: list) -> str:
+    """
+    Content address of an encoded test clip.
+
+    The key covers everything the encode depends on: the source file (path, size and
+    modification time), the segment and how it is cut, crop, output resolution, CQ and
+    the encoder profile the commands are built from. The HDR type is not part of it, it
+    follows from the source and is only known after the encode extracted the metadata.
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the clip
+        cut (list): How the segment is cut, see compressor2.segment_cut
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+    stat = os.stat(VPC.orig_file_path)
+    description = {
+        "source": [os.path.abspath(VPC.orig_file_path), stat.st_size, int(stat.st_mtime)],
+        "start": VPC.start,
+        "duration": VPC.duration,
+        "cut": cut,
+        "crop": VPC.crop,
+        "output_res": VPC.output_res,
+        "output_cq": VPC.output_cq,
+        "profile": VPC.profile,
+    }
+    text = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _entry_path(VPC, key: str) -> str:
+    return os.path.join(cache_dir(VPC), key[:2], key + ".mkv")
+
+
+def fetch(VPC, cut: list) -> bool:
+    """
+    Copy a cached clip to VPC.output_file_path.
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the clip
+        cut (list): How the segment is cut, see compressor2.segment_cut
+
+    Returns:
+        bool: True if the clip was found in the cache, False if it has to be encoded
+    """
+    if _settings(VPC) is None:
+        return False
+
+    key = clip_key(VPC, cut)
+    entry = _entry_path(VPC, key)
+    try:
+        shutil.copyfile(entry, VPC.output_file_path)
+        # The modification time orders the entries for LRU eviction
+        os.utime(entry)
+    except FileNotFoundError:
+        logger.debug(f"[fetch] Cache miss for {VPC.output_file_name} ({key[:12]})")
+        return False
+    except OSError as e:
+        logger.warning(f"[fetch] Failed to copy cached clip {entry}: {e}")
+        return False
+
+    logger.info(f"[fetch] Using cached clip for {VPC.output_file_name} ({key[:12]})")
+    return True
+
+
+def store(VPC, cut: list) -> None:
+    """
+    Add the encoded clip at VPC.output_file_path to the cache and evict the least
+    recently used entries above the size limit.
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the encoded clip
+        cut (list): How the segment was cut, see compressor2.segment_cut
+    """
+    settings = _settings(VPC)
+    if settings is None:
+        return
+
+    key = clip_key(VPC, cut)
+    entry = _entry_path(VPC, key)
+    temp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # Entries are copies, a later encode to the same workspace path must not overwrite them
+        shutil.copyfile(VPC.output_file_path, temp)
+        os.replace(temp, entry)
+    except OSError as e:
+        logger.warning(f"[store] Failed to cache {VPC.output_file_path}: {e}")
+        if os.path.exists(temp):
+            os.remove(temp)
+        return
+
+    logger.debug(f"[store] Cached {VPC.output_file_name} as {key[:12]}")
+    evict(cache_dir(VPC), int(settings.get("size_GB", 20) * 1024 ** 3))
+
+
+def evict(path: str, size_limit: int) -> None:
+    """
+    Delete the least recently used entries until the cache fits into size_limit bytes.
+
+    Args:
+        path (str): Cache directory
+        size_limit (int): Maximum total size of the entries in bytes
+    """
+    with _lock:
+        entries = list()
+        for root, _, files in os.walk(path):
+            for name in files:
+                if not name.endswith(".mkv"):
+                    continue
+                file = os.path.join(root, name)
+                try:
+                    stat = os.stat(file)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= size_limit:
+            return
+
+        entries.sort()
+        evicted = 0
+        for _, size, file in entries:
+            if total <= size_limit:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+
+    logger.info(f"[evict] Evicted {evicted} cached clips, cache size {total / 1024 ** 3:.2f}GB")
@@ -1,21 +1,41 @@
-from encodings.punycode import T
 import shutil
+import shlex
 import subprocess, os, json
 import logging
+import collections
+import signal
+import time
 
-from sympy import false
 import AVTest
-from threading import Thread
+from threading import Thread, Event
 import logger_setup
+import keyframe_index
+import clip_cache
+import progress
+import resource_monitor
+import load_controller
+import workspace_manager
 from fractions import Fraction
-from VideoClass import VideoProcessingConfig
+from VideoClass import VideoProcessingConfig, readProfile
+from typing import Union
 
 # Retrieve the logger once at the module level
 logger = logging.getLogger("AppLogger")
 stream_logger = logging.getLogger("FileLogger")
 
+# Audio transcodes per output file path, VideoProcessingConfig copies are deepcopies
+_audio_jobs = dict()        # output file path -> {"transcode": transcode key, "muxed": bool}
+_audio_transcodes = dict()  # transcode key -> {"jobs": [(process, target)], "files": None/list/False, "users": set}
 
-def compress(VPC: VideoProcessingConfig) -> bool:
+# Source file each HDR metadata file was last extracted from, renditions of one title share it
+_hdr_metadata = dict()
+
+# Settings of execute, see configure_execute
+_execution = {"stall_timeout": 0, "last_lines": 20, "kill_grace": 10,
+              "ring_lines": 0, "progress_interval": 60, "success_level": None}
+
+
+def compress(VPC: VideoProcessingConfig, renditions: list = None) -> bool:
     """
     Compress a video file using the specified profile and encoding function.
 
@@ -26,16 +46,30 @@ def compress(VPC: VideoProcessingConfig) -> bool:
     Args:
         VPC (VideoProcessingConfig): Video processing configuration object containing
                                    all necessary parameters for compression
+        renditions (list, optional): Output renditions as dicts with "name", "resolution",
+                                     "cq" and "profile", see rendition_configs. The source is
+                                     then decoded once for all of them (compress_ladder)
+                                     instead of compressing VPC itself.
 
     Returns:
         bool: True if compression succeeded and output file is valid, False otherwise
     """
+    if renditions:
+        return compress_ladder(VPC, rendition_configs(VPC, renditions))
+
     logger.info(f"[compress] Starting compression workflow for file: {VPC.orig_file_path}")
     logger.debug(f"[compress] Compression parameters - Profile: {VPC.profile['function'][1]}, "
                 f"Target resolution: {VPC.output_res}, CQ: {VPC.output_cq}, Crop: {VPC.crop}")
 
+    segment = VPC.start is not False or VPC.duration is not False
+    cut_duration = None
+
+    # Test clips that were encoded before with identical inputs come from the clip cache
+    if segment and clip_cache.fetch(VPC, segment_cut(VPC)):
+        return True
+
     # Handle temporal cropping if start time or duration is specified
-    if VPC.start is not False or VPC.duration is not False:
+    if segment:
         logger.debug(f"[compress] Temporal cropping required - Start: {VPC.start}s, Duration: {VPC.duration}s")
         VPC.setSourcePath(VPC.orig_file_path)
         VPC.setTargetPath(os.path.join(VPC.workspace, VPC.output_file_name + "_time_crop.mkv"))
@@ -44,6 +78,10 @@ def compress(VPC: VideoProcessingConfig) -> bool:
         if not temporal_crop(VPC):
             logger.error("[compress] Temporal cropping failed, aborting compression")
             return False
+
+        # Cuts start on the preceding keyframe, the encode has the length of the cut
+        if _verification_enabled(VPC):
+            cut_duration = _media_duration(VPC.target_path)
         
         # Use the temporally cropped file as input for main compression
         VPC.setSourcePath(VPC.target_path)
@@ -64,29 +102,352 @@ def compress(VPC: VideoProcessingConfig) -> bool:
         logger.error(f"[compress] Available functions: {list(function_mapping.keys())}")
         return False
 
+    # Audio of a full title is transcoded next to the video encode
+    if VPC.start is False and VPC.duration is False:
+        audio_encode_start(VPC)
+
     # Execute the appropriate compression function
     compression_func = function_mapping[compression_function_name]
     logger.debug(f"[compress] Using compression function: {compression_function_name}")
     
-    success = compression_func(VPC)
-    
+    # Pending audio jobs are stopped when the encode raises
+    success = False
+    try:
+        success = _finish_output(VPC, compression_func(VPC), cut_duration)
+    finally:
+        if VPC.output_file_path in _audio_jobs:
+            audio_encode_cancel(VPC)
 
     if success:
+        if segment:
+            clip_cache.store(VPC, segment_cut(VPC))
         logger.info(f"[compress] Compression completed successfully for: {VPC.output_file_path}")
     else:
         logger.error(f"[compress] Compression failed for: {VPC.output_file_path}")
     
     return success
 
-def execute(command: list) -> bool:
+def _verification_enabled(VPC: VideoProcessingConfig) -> bool:
+    """True if Output_verification covers this output (test clips only with verify_segments)."""
+    verification = VPC.test_settings.get("Output_verification", {})
+    return verification.get("Enabled", False) and (VPC.start is False or verification.get("verify_segments", False))
+
+def _finish_output(VPC: VideoProcessingConfig, success: bool, cut_duration: float = None) -> bool:
+    """
+    Add the transcoded audio to an encoded output (or stop the audio jobs after a failed
+    encode) and verify the output if Output_verification is enabled.
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the output
+        success (bool): Result of the video encode
+        cut_duration (float, optional): Length of the cut the output was encoded from, see verify_output
+
+    Returns:
+        bool: True if the output is complete and valid, False otherwise
+    """
+    if VPC.output_file_path in _audio_jobs:
+        if success:
+            success = audio_mux(VPC)
+        else:
+            audio_encode_cancel(VPC)
+
+    if success and _verification_enabled(VPC):
+        success = verify_output(VPC, expected_duration=cut_duration)
+    return success
+
+def compress_variants(VPC: VideoProcessingConfig, variants: list, fanout: bool = None) -> bool:
+    """
+    Compress several variants of the same source segment that differ only in output
+    resolution and/or CQ.
+
+    With Fanout_encode enabled and an FFmpeg backend, the segment is cut and decoded once
+    and every variant is encoded as an additional output of the same process. Otherwise
+    the variants are compressed one by one using compress(). Output file names are the
+    same in both modes.
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the shared source segment
+                                   (start, duration, crop, profile, workspace)
+        variants (list): VideoProcessingConfig copies with their own output_res,
+                         output_cq and output file name
+        fanout (bool, optional): Force fan-out encoding on or off, None to follow Fanout_encode
+
+    Returns:
+        bool: True if every variant was created and is valid, False otherwise
+    """
+    fanout_mapping = {
+    "ffmpeg"      : video_ffmpeg_h265_fanout,
+    "ffmpeg_AV1"  : video_ffmpeg_AV1_fanout
+    }
+
+    compression_function_name = VPC.profile["function"][1]
+    fanout_enabled = VPC.test_settings.get("Fanout_encode", {}).get("Enabled", False) if fanout is None else fanout
+
+    # Variants found in the clip cache are not encoded again
+    if VPC.start is not False or VPC.duration is not False:
+        variants = [variant for variant in variants if not clip_cache.fetch(variant, segment_cut(variant))]
+        if not variants:
+            return True
+
+    if not fanout_enabled or len(variants) < 2 or compression_function_name not in fanout_mapping:
+        logger.debug(f"[compress_variants] Compressing {len(variants)} variants one by one")
+        passed = True
+        for variant in variants:
+            if not compress(variant):
+                passed = False
+        return passed
+
+    logger.info(f"[compress_variants] Fan-out encoding {len(variants)} variants of: {VPC.orig_file_path}")
+
+    # Cut the segment once for all variants
+    cut_duration = None
+    if VPC.start is not False or VPC.duration is not False:
+        VPC.setSourcePath(VPC.orig_file_path)
+        VPC.setTargetPath(os.path.join(VPC.workspace, VPC.output_file_name + "_time_crop.mkv"))
+        logger.debug(f"[compress_variants] Performing temporal crop to: {VPC.target_path}")
+
+        if not temporal_crop(VPC):
+            logger.error("[compress_variants] Temporal cropping failed, aborting compression")
+            return False
+        if _verification_enabled(VPC):
+            cut_duration = _media_duration(VPC.target_path)
+        VPC.setSourcePath(VPC.target_path)
+    else:
+        VPC.setSourcePath(VPC.orig_file_path)
+
+    for variant in variants:
+        variant.setSourcePath(VPC.source_path)
+        # Audio of a full title is transcoded next to the video encode, once for all
+        # variants with the same audio settings
+        if VPC.start is False and VPC.duration is False:
+            audio_encode_start(variant)
+
+    # Pending audio jobs are stopped when an encode raises
+    success = True
+    try:
+        # Under load control one process encodes at most the current encode limit of variants
+        results = list()
+        remaining = variants
+        while remaining:
+            batch_size = load_controller.limit("encode", len(remaining))
+            batch, remaining = remaining[:batch_size], remaining[batch_size:]
+            if len(batch) < len(variants):
+                logger.debug(f"[compress_variants] Encoding a batch of {len(batch)} variants")
+            results += fanout_mapping[compression_function_name](VPC, batch)
+
+        if VPC.source_path != VPC.orig_file_path:
+            delete_file(VPC, VPC.source_path)
+
+        # A failed variant (or batch) does not fail the audio and verification of the others
+        for variant, encoded in zip(variants, results):
+            if not _finish_output(variant, encoded, cut_duration):
+                logger.error(f"[compress_variants] Variant failed: {variant.output_file_name}")
+                success = False
+            elif VPC.start is not False or VPC.duration is not False:
+                clip_cache.store(variant, segment_cut(variant))
+    finally:
+        for variant in variants:
+            if variant.output_file_path in _audio_jobs:
+                audio_encode_cancel(variant)
+
+    if success:
+        logger.info(f"[compress_variants] Fan-out encoding completed successfully")
+    else:
+        logger.error(f"[compress_variants] Fan-out encoding failed")
+    return success
+
+def rendition_configs(VPC: VideoProcessingConfig, renditions: list) -> list:
+    """
+    Build the configuration of every output rendition of a title.
+
+    Each rendition is a dict with:
+        name (str): Suffix of the output file, {output_file_name}_{name}.mkv
+        resolution (int, optional): Output width, default the tested VPC.output_res
+        cq (float, optional): Output CQ, default the tested VPC.output_cq, or the profile
+                              default CQ for renditions with their own profile
+        profile (str, optional): Path to an encoder profile YAML, default the title profile
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the title (tested crop, resolution and CQ)
+        renditions (list): Rendition dicts
+
+    Returns:
+        list: VideoProcessingConfig copy of VPC per rendition
+    """
+    configs = list()
+    for rendition in renditions:
+        config = VPC.create_copy()
+        cq = rendition.get("cq")
+
+        if rendition.get("profile"):
+            config.profile, config.profile_settings = readProfile(rendition["profile"])
+            # The CQ found by the tests belongs to the title profile, other encoders use their default
+            if cq is None:
+                cq = config.getProfileValue(config.profile["test_settings"], "defalut_cq")
+            if not VPC.is_H265 and "HDR_enable" in config.profile:
+                config.profile["HDR_enable"][1] = False
+
+        if cq is None:
+            cq = VPC.output_cq
+        resolution = rendition.get("resolution") or VPC.output_res
+        name = rendition.get("name") or f"{resolution}_cq{cq}"
+        config.setOutputRes(resolution)
+        config.setOutputCQ(cq)
+        config.setOutputFileName(f"{VPC.output_file_name}_{name}")
+        logger.debug(f"[rendition_configs] Rendition {config.output_file_name}: {config.profile['function'][1]}, "
+                     f"resolution {config.output_res}, CQ {config.output_cq}")
+        configs.append(config)
+    return configs
+
+def compress_ladder(VPC: VideoProcessingConfig, renditions: list) -> bool:
+    """
+    Compress one title into several output renditions.
+
+    Renditions are grouped by encoding function and HDR handling. Every group with an
+    FFmpeg backend is encoded with compress_variants in fan-out mode: the source is decoded
+    once, the crop is shared and every rendition gets its own scale branch and encoder.
+    HDR metadata is extracted from the original once for all groups. Groups that cannot
+    share a decode (HandbrakeAV1) are compressed one by one.
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the title
+        renditions (list): VideoProcessingConfig of each rendition, see rendition_configs
+
+    Returns:
+        bool: True if every rendition was created and is valid, False otherwise
+    """
+    logger.info(f"[compress_ladder] Compressing {len(renditions)} renditions of: {VPC.orig_file_path}")
+
+    groups = dict()
+    for rendition in renditions:
+        key = (rendition.profile["function"][1], rendition.profile.get("HDR_enable", [None, False])[1])
+        groups.setdefault(key, list()).append(rendition)
+
+    passed = True
+    for (function_name, HDR), group in groups.items():
+        logger.info(f"[compress_ladder] {function_name} (HDR {HDR}): {', '.join(r.output_file_name for r in group)}")
+        # The shared source gets its own copy, the renditions keep their paths between batches
+        if not compress_variants(group[0].create_copy(), group, fanout=True):
+            passed = False
+
+    for rendition in renditions:
+        if os.path.isfile(rendition.output_file_path):
+            size_GB = os.stat(rendition.output_file_path).st_size / (1024 * 1024 * 1024)
+            logger.info(f"[compress_ladder] {rendition.output_file_name}: {size_GB:.3f}GB")
+
+    if passed:
+        logger.info(f"[compress_ladder] All renditions completed successfully")
+    else:
+        logger.error(f"[compress_ladder] Some renditions failed")
+    return passed
+
+def _fanout_filter_graph(variants: list, input_filter: str = None, branch_filters: list = None) -> str:
+    """
+    Build a filter graph that decodes the input once and splits it into one
+    cropped and scaled branch per variant, labelled [v0], [v1], ...
+
+    Args:
+        variants (list): VideoProcessingConfig of each output
+        input_filter (str, optional): Filter applied before the split (profile -vf)
+        branch_filters (list, optional): Filter of each branch applied before its crop and
+                                         scale (-vf of the variant profiles), None to skip
+
+    Returns:
+        str: Filter graph for -filter_complex
+    """
+    shared = f"{input_filter}," if input_filter else ""
+    graph = [f"[0:v]{shared}split={len(variants)}" + "".join(f"[s{i}]" for i in range(len(variants)))]
+    for i, variant in enumerate(variants):
+        branch = f"{branch_filters[i]}," if branch_filters and branch_filters[i] else ""
+        graph.append(f"[s{i}]{branch}{vfCropComandGenerator(variant)}[v{i}]")
+    return ";".join(graph)
+
+def _split_video_filter(video_profile: list) -> tuple:
+    """Split the profile -vf filter from the other video options, returns (options, filter or None)."""
+    video_profile = video_profile.copy()
+    if "-vf" not in video_profile:
+        return video_profile, None
+    index = video_profile.index("-vf")
+    video_filter = video_profile[index+1]
+    del video_profile[index:index+2]
+    return video_profile, video_filter
+
+def configure_execute(VPC: VideoProcessingConfig) -> None:
+    """
+    Read the settings of execute from the test settings (Stall_watchdog, Stream_log).
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration with test settings loaded
+    """
+    watchdog = VPC.test_settings.get("Stall_watchdog", {})
+    if watchdog.get("Enabled", False):
+        _execution["stall_timeout"] = watchdog.get("timeout", 600)
+        _execution["last_lines"] = watchdog.get("last_lines", 20)
+        _execution["kill_grace"] = watchdog.get("kill_grace", 10)
+        # Captured commands (resource_monitor.run, audio transcodes) are watched by their CPU use
+        resource_monitor.configure_watchdog(_execution["stall_timeout"], _execution["kill_grace"])
+        logger.info(f"[configure_execute] Stall watchdog kills tools without progress for {_execution['stall_timeout']}s")
+
+    stream_log = VPC.test_settings.get("Stream_log", {})
+    if stream_log.get("Enabled", False):
+        _execution["ring_lines"] = max(1, stream_log.get("ring_lines", 200))
+        _execution["progress_interval"] = stream_log.get("progress_interval", 60)
+        success_level = logging.getLevelName(str(stream_log.get("success_level")).upper())
+        _execution["success_level"] = success_level if isinstance(success_level, int) else None
+        logger.info(f"[configure_execute] Tool output kept in a ring buffer of {_execution['ring_lines']} lines per process")
+
+def _kill_group(process: subprocess.Popen, grace: float, finished: Event = None) -> None:
+    """
+    Terminate the process group of a command, killing it after grace seconds.
+    Remaining members of the group (e.g. the other side of a pipe) are always killed.
+    The grace period ends early when finished is set, or without an event when the
+    process exits; the event is for callers whose process is waited in another thread.
+    """
+    if not hasattr(os, "killpg"):
+        process.kill()
+        return
+
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    if finished is None:
+        try:
+            process.wait(grace)
+        except subprocess.TimeoutExpired:
+            pass
+    else:
+        finished.wait(grace)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def execute(command: list, total_frames: float = None) -> bool:
     """
     Execute a command using subprocess with real-time logging of stdout and stderr.
 
     This function runs external commands (like FFmpeg, HandBrake, etc.) and captures
     their output streams in separate threads, logging everything to dedicated file loggers.
+    Progress output of the tools is turned into progress events (see progress module).
+
+    With the stall watchdog enabled, the command runs in its own process group, which is
+    killed when the command produces neither new output nor new progress for the
+    configured timeout. Repeated progress lines without advancing frames do not count.
+    Commands with captured output run through resource_monitor.run instead, which
+    applies the same timeout to the CPU use of the process tree.
+    Without the watchdog the command stays in our process group and receives Ctrl-C
+    from the terminal. Either way the command is stopped when waiting for it is
+    interrupted (KeyboardInterrupt or another exception) before the exception propagates.
+
+    With the Stream_log ring buffer enabled, output lines are not written as they arrive.
+    The last ring_lines lines are kept in memory and written when the command fails (or
+    at success_level when it succeeds); in between only one progress line per
+    progress_interval seconds is written.
 
     Args:
         command (list): Command and arguments to execute as a list
+        total_frames (float, optional): Expected number of encoded frames, enables percent and ETA
 
     Returns:
         bool: True if process finished successfully (exit code 0), False otherwise
@@ -94,12 +455,16 @@ def execute(command: list) -> bool:
     logger.debug(f"[execute] Starting command execution")
     logger.debug(f"[execute] Command: {' '.join(command)}")
     
+    # Only the watchdog needs an own process group, a stalled pipeline is killed as a whole
+    detached = _execution["stall_timeout"] > 0
+
     # Start the process with UTF-8 encoding
     process = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        universal_newlines=False  # Handle decoding manually
+        universal_newlines=False,  # Handle decoding manually
+        start_new_session=detached
     )
 
     # Create a dedicated file logger for stream logging
@@ -108,6 +473,11 @@ def execute(command: list) -> bool:
         stream_logger.debug(f"----------------------------------------------------------------------------------------------")
     stream_logger.debug(f"[execute] Command: {command}")
 
+    tracker = progress.ProgressTracker(command, total_frames)
+    ring_mode = _execution["ring_lines"] > 0
+    recent_lines = collections.deque(maxlen=max(_execution["last_lines"], _execution["ring_lines"]))
+    activity = {"time": time.monotonic(), "position": None, "logged": 0.0}
+    sampler = resource_monitor.Sampler(process.pid, os.path.basename(command[0])).start() if resource_monitor.enabled() else None
 
     def log_stream(stream, stream_type, file_log):
 
@@ -139,9 +509,27 @@ def execute(command: list) -> bool:
                 if not stripped_line:
                     continue
 
+                carried_progress = tracker.feed(stripped_line)
+
+                # A progress line that repeats the last position is no sign of life
+                position = (tracker.event["frames"], tracker.event["percent"])
+                if not carried_progress or position != activity["position"]:
+                    activity["time"] = time.monotonic()
+                    activity["position"] = position
+
                 # Skip consecutive duplicates
                 if stripped_line == last_line:
                     continue
+                recent_lines.append(f"[{stream_type}] {decoded_line}")
+
+                if ring_mode:
+                    # Only a sampled progress line now, the rest is written from the ring buffer
+                    now = time.monotonic()
+                    if carried_progress and now - activity["logged"] >= _execution["progress_interval"]:
+                        activity["logged"] = now
+                        file_log.info(f"[{stream_type}] {decoded_line}")
+                    last_line = stripped_line
+                    continue
 
                 # Log and update last line
                 if stream_type == "STDOUT":
@@ -161,13 +549,69 @@ def execute(command: list) -> bool:
     stdout_thread.start()
     stderr_thread.start()
 
+    finished = Event()
+    stalled = Event()
+
+    def watchdog():
+        timeout = _execution["stall_timeout"]
+        while not finished.wait(min(5, timeout)):
+            idle = time.monotonic() - activity["time"]
+            if idle < timeout:
+                continue
+
+            stalled.set()
+            logger.error(f"[execute] {os.path.basename(command[0])} made no progress for {idle:.0f}s, killing process group {process.pid}")
+            logger.error(f"[execute] Last output lines:")
+            for line in list(recent_lines)[-_execution["last_lines"]:]:
+                logger.error(f"[execute]   {line}")
+            _kill_group(process, _execution["kill_grace"], finished)
+            return
+
+    if detached:
+        Thread(target=watchdog, name="StallWatchdog", daemon=True).start()
+
     # Wait for completion
     logger.debug(f"[execute] Waiting for process completion")
-    process.wait()
+    try:
+        if sampler is not None:
+            usage = resource_monitor.wait(process)
+        else:
+            process.wait()
+    except BaseException:
+        # Do not leave the command running as an orphan (e.g. Ctrl-C with a detached group)
+        if process.poll() is None:
+            logger.error(f"[execute] Interrupted, stopping {os.path.basename(command[0])} (PID {process.pid})")
+            if detached:
+                _kill_group(process, _execution["kill_grace"])
+            else:
+                process.kill()
+                process.wait()
+        if sampler is not None:
+            sampler.stop(process.returncode)
+        tracker.finish(process.returncode)
+        raise
+    finally:
+        finished.set()
     stdout_thread.join()
     stderr_thread.join()
+    tracker.finish(process.returncode)
+    if sampler is not None:
+        sampler.stop(process.returncode, usage)
+
+    if ring_mode:
+        failed = stalled.is_set() or process.returncode != 0
+        level = logging.ERROR if failed else _execution["success_level"]
+        if level is not None:
+            ring = list(recent_lines)[-_execution["ring_lines"]:]
+            stream_logger.log(level, f"[execute] Last {len(ring)} output lines of {command[0]}:")
+            for line in ring:
+                stream_logger.log(level, line)
 
     # Check final status
+    if stalled.is_set():
+        logger.error(f"[execute] Process was killed after stalling")
+        return False
+
     if process.returncode != 0:
         logger.error(f"[execute] Process failed with exit code: {process.returncode}")
         return False
@@ -175,6 +619,21 @@ def execute(command: list) -> bool:
     logger.debug(f"[execute] Command execution finished successfully")
     return True
 
+def expected_frames(VPC: VideoProcessingConfig) -> float:
+    """
+    Number of frames an encode of the source segment will produce.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration
+
+    Returns:
+        float: Segment (or title) duration times the original framerate, None if unknown
+    """
+    duration = VPC.duration if VPC.duration is not False else VPC.orig_duration
+    if not duration or not VPC.orig_framerate:
+        return None
+    return duration * float(VPC.orig_framerate)
+
 def check_output(file_path: str, size_limit=2048) -> bool:
     """
     Validate that an output file exists and meets minimum size requirements.
@@ -210,7 +669,129 @@ def check_output(file_path: str, size_limit=2048) -> bool:
         return False
 
 
-def temporal_crop(VPC: VideoProcessingConfig, NoFS_offset: int = 3) -> bool:
+def _probe_json(command: list) -> Union[dict, None]:
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        return json.loads(result.stdout)
+    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        logger.error(f"[verify_output] FFprobe failed: {e}")
+        return None
+
+def _media_duration(file_path: str) -> Union[float, None]:
+    """Container duration of a file in seconds, None if it cannot be probed."""
+    probe = _probe_json(["ffprobe", "-v", "error", "-show_format", "-of", "json", file_path])
+    try:
+        return float(probe["format"]["duration"])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+def verify_output(VPC: VideoProcessingConfig, file_path: str = None, expected_duration: float = None) -> bool:
+    """
+    Structural check of an encoded file against the source, without decoding the stream.
+
+    The video packets are counted by demuxing the whole file (ffprobe -count_packets) and
+    compared with the expected frame count (duration times orig_framerate); the container
+    duration is compared with the expected duration. For HDR outputs the stream side data
+    and the first frame are checked for the Dolby Vision configuration/RPU or the HDR10+
+    dynamic metadata required by HDR_type.
+
+    Test clips are longer than VPC.duration, their cut starts on the preceding keyframe
+    (or earlier on the slow path). They are compared with the length of the cut; without
+    it only the HDR metadata is checked.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration of the output
+        file_path (str, optional): File to check. Default is VPC.output_file_path
+        expected_duration (float, optional): Length of the cut the clip was encoded from.
+                                             Default is the title duration for full titles
+
+    Returns:
+        bool: True if the file passed every check, False otherwise
+    """
+    file_path = file_path or VPC.output_file_path
+    settings = VPC.test_settings.get("Output_verification", {})
+    logger.debug(f"[verify_output] Verifying: {file_path}")
+
+    probe = _probe_json([
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-count_packets",
+        "-show_streams", "-show_format",
+        "-of", "json",
+        file_path
+    ])
+    if not probe or not probe.get("streams"):
+        logger.error(f"[verify_output] No video stream found in {file_path}")
+        return False
+
+    stream = probe["streams"][0]
+    passed = True
+
+    if expected_duration is None and VPC.start is False and VPC.duration is False:
+        expected_duration = VPC.orig_duration
+
+    duration = float(probe.get("format", {}).get("duration", 0))
+    packets = int(stream.get("nb_read_packets", 0))
+    if expected_duration is None:
+        logger.debug(f"[verify_output] Length of the cut unknown, skipping duration and packet checks")
+    else:
+        duration_tolerance = max(settings.get("duration_tolerance", 1.0), 0.002 * expected_duration)
+        if abs(duration - expected_duration) > duration_tolerance:
+            logger.error(f"[verify_output] Duration {duration:.3f}s differs from expected {expected_duration:.3f}s")
+            passed = False
+
+        frames = expected_duration * float(VPC.orig_framerate) if VPC.orig_framerate else None
+        if frames:
+            frame_tolerance = max(settings.get("frame_tolerance", 2), 0.002 * frames)
+            if abs(packets - frames) > frame_tolerance:
+                logger.error(f"[verify_output] {packets} video packets, expected {frames:.0f}")
+                passed = False
+
+    if VPC.profile.get("HDR_enable", [None, False])[1] and VPC.HDR_type in ("DoVi", "HDR10"):
+        frame_probe = _probe_json([
+            "ffprobe", "-v", "error",
+            "-select_streams", "v:0",
+            "-read_intervals", "%+#1",  # first frame only
+            "-show_frames",
+            "-of", "json",
+            file_path
+        ]) or {}
+        side_data = [entry.get("side_data_type", "") for entry in stream.get("side_data_list", [])]
+        for frame in frame_probe.get("frames", [])[:1]:
+            side_data += [entry.get("side_data_type", "") for entry in frame.get("side_data_list", [])]
+
+        if VPC.HDR_type == "DoVi":
+            required = ("Dolby Vision RPU", "Dolby Vision Metadata")
+            if not any("DOVI configuration" in entry for entry in side_data):
+                logger.warning(f"[verify_output] No Dolby Vision configuration record in {file_path}")
+        else:
+            required = ("HDR10+", "SMPTE2094-40")
+
+        if not any(name in entry for entry in side_data for name in required):
+            logger.error(f"[verify_output] {VPC.HDR_type} metadata missing, side data found: {side_data}")
+            passed = False
+
+    if passed:
+        logger.info(f"[verify_output] {os.path.basename(file_path)} verified: {packets} packets, {duration:.3f}s")
+    return passed
+
+def _fast_seek(VPC: VideoProcessingConfig) -> bool:
+    """True if segments of the source are cut with an input seek (FS_enable and FS_support)."""
+    return bool(VPC.profile.get("FS_enable", [None, False])[1] and VPC.FS_support)
+
+def segment_cut(VPC: VideoProcessingConfig, NoFS_offset: int = 3) -> list:
+    """
+    Describe how temporal_crop cuts the segments of the source: ["fast_seek"],
+    ["keyframe_index"] or ["padded", NoFS_offset]. Differently cut segments start on
+    different frames, so the description is part of the clip cache key.
+    """
+    if _fast_seek(VPC):
+        return ["fast_seek"]
+    if VPC.keyframe_index:
+        return ["keyframe_index"]
+    return ["padded", NoFS_offset]
+
+def temporal_crop(VPC: VideoProcessingConfig, NoFS_offset: int = 3, use_keyframe_index: bool = True) -> bool:
 
     """
     Perform temporal cropping (time-based cutting) of video files using FFmpeg.
@@ -218,9 +799,18 @@ def temporal_crop(VPC: VideoProcessingConfig, NoFS_offset: int = 3) -> bool:
     This function extracts a specific time segment from a video file without
     re-encoding, using stream copying for maximum speed and quality preservation.
 
+    Sources with fast seek support are input-seeked. Other sources with a keyframe index
+    are cut exactly on the keyframe preceding the start: header-less containers
+    (keyframe_index.BYTE_SEEK_FORMATS) are entered at the keyframe's byte offset, all
+    other containers are input-seeked to the keyframe's time, so the demuxer does not
+    have to pick a keyframe from a missing index. When an indexed cut fails, the padded
+    cut is used instead.
+
     Args:
         VPC (VideoProcessingConfig): Video processing configuration containing
                                    source/target paths, start time, and duration
+        NoFS_offset (int, optional): Padding of the cut without fast seek and index, in seconds
+        use_keyframe_index (bool, optional): Cut with the keyframe index when there is one
 
     Returns:
         bool: True if temporal cropping succeeded, False otherwise
@@ -234,7 +824,10 @@ def temporal_crop(VPC: VideoProcessingConfig, NoFS_offset: int = 3) -> bool:
     logger.debug(f"[temporal_crop] Source: {VPC.source_path} -> Target: {VPC.target_path}")
     logger.debug(f"[temporal_crop] Crop parameters - Start: {VPC.start}s, Duration: {VPC.duration}s")
 
-    if VPC.profile["FS_enable"][1] and VPC.FS_support:
+    fast_seek = _fast_seek(VPC)
+    use_index = use_keyframe_index and not fast_seek and VPC.keyframe_index and VPC.source_path == VPC.orig_file_path
+
+    if fast_seek:
         command = [
             "ffmpeg",
             "-y",  # Overwrite output files
@@ -242,6 +835,33 @@ def temporal_crop(VPC: VideoProcessingConfig, NoFS_offset: int = 3) -> bool:
             "-i", VPC.source_path,  # Input file
             "-t", str(VPC.duration),  # Duration
         ]
+    elif use_index:
+        # Start exactly on the preceding keyframe so the stream copy needs no padding
+        keyframe_time, keyframe_pos = keyframe_index.preceding_keyframe(VPC.keyframe_index, VPC.start)
+        duration = VPC.start - keyframe_time + VPC.duration
+
+        logger.debug(f"[temporal_crop] Cutting on keyframe at {keyframe_time}s (byte {keyframe_pos})")
+
+        if VPC.keyframe_index["byte_seek"] and keyframe_pos >= 0:
+            command = [
+                "ffmpeg",
+                "-y",  # Overwrite output files
+                "-skip_initial_bytes", str(keyframe_pos),  # Header-less container, jump straight to the packet
+                "-i", VPC.source_path,  # Input file
+                "-avoid_negative_ts", "make_zero",  # Start output timestamps at zero
+                "-t", str(duration),  # Duration
+            ]
+        else:
+            # Input seek to the keyframe itself, the demuxer lands on it without a guess.
+            # The millisecond keeps rounding from selecting the keyframe before it.
+            command = [
+                "ffmpeg",
+                "-y",  # Overwrite output files
+                "-ss", str(round(keyframe_time + 0.001, 6)),  # Start on the keyframe
+                "-i", VPC.source_path,  # Input file
+                "-avoid_negative_ts", "make_zero",  # Start output timestamps at zero
+                "-t", str(duration),  # Duration
+            ]
     else:
         command = [
             "ffmpeg",
@@ -268,13 +888,19 @@ def temporal_crop(VPC: VideoProcessingConfig, NoFS_offset: int = 3) -> bool:
             return True
         else:
             logger.error(f"[temporal_crop] Output file validation failed")
+            if use_index:
+                logger.warning(f"[temporal_crop] Indexed cut failed, falling back to the padded cut")
+                return temporal_crop(VPC, NoFS_offset, use_keyframe_index=False)
             if NoFS_offset >= 9:
                 return False
             logger.debug(f"[temporal_crop] Atemting to create longer file")
-            return temporal_crop(VPC, NoFS_offset + 1)
+            return temporal_crop(VPC, NoFS_offset + 1, use_keyframe_index=False)
             
     else:
         logger.error(f"[temporal_crop] FFmpeg execution failed")
+        if use_index:
+            logger.warning(f"[temporal_crop] Indexed cut failed, falling back to the padded cut")
+            return temporal_crop(VPC, NoFS_offset, use_keyframe_index=False)
         return False
 
 def video_HandbrakeAV1(VPC: VideoProcessingConfig) -> bool:
@@ -360,6 +986,7 @@ def get_video_metadata_type(VPC: VideoProcessingConfig):
 
         if check_output(VPC.dovi_metadata_file):
             logger.debug("[video_ffmpeg.get_video_metadata_type] DoVi metadata file is valid")
+            _hdr_metadata[VPC.dovi_metadata_file] = VPC.source_path
             VPC.HDR_type = "DoVi"
             return True
         
@@ -375,6 +1002,7 @@ def get_video_metadata_type(VPC: VideoProcessingConfig):
 
             if check_output(VPC.HDR10_metadata_file):
                 logger.debug("HDR10+ metadata file is valid")
+                _hdr_metadata[VPC.HDR10_metadata_file] = VPC.source_path
                 VPC.HDR_type = "HDR10"
                 return True
             else: 
@@ -413,31 +1041,39 @@ def video_HDR_extract(VPC: VideoProcessingConfig):
             return False
 
     if VPC.HDR_type == "DoVi":
+        if _hdr_metadata_extracted(VPC, VPC.dovi_metadata_file):
+            return True
         logger.debug("[video_ffmpeg.video_HDR_extract] Extracting Dolby Vision RPU metadata")
         dovi_tool_path = "dovi_tool"
         dovi = [f"{dovi_tool_path}", "extract-rpu", "-i", f"{VPC.source_path}", "-o", f"{VPC.dovi_metadata_file}"]
         logger.debug(f"[video_ffmpeg.video_HDR_extract] DoVi extraction command: {' '.join(dovi)}")
 
+        _hdr_metadata.pop(VPC.dovi_metadata_file, None)
         if not execute(dovi):
             logger.error("[video_ffmpeg.video_HDR_extract] DoVi extraction failed")
             return False
         if not check_output(VPC.dovi_metadata_file):
             logger.error("[video_ffmpeg.video_HDR_extract] DoVi metadata file validation failed")
             return False
+        _hdr_metadata[VPC.dovi_metadata_file] = VPC.source_path
         return True
     
     elif VPC.HDR_type == "HDR10":
+        if _hdr_metadata_extracted(VPC, VPC.HDR10_metadata_file):
+            return True
         logger.debug("[video_ffmpeg.video_HDR_extract] Extracting HDR10+ dynamic metadata")
         HDR10plus_tool_path = "hdr10plus_tool"
         HDR10plus = [f"{HDR10plus_tool_path}", "extract", f"{VPC.source_path}", "-o", f"{VPC.HDR10_metadata_file}"]
         logger.debug(f"[video_ffmpeg.video_HDR_extract] HDR10+ extraction command: {' '.join(HDR10plus)}")
 
+        _hdr_metadata.pop(VPC.HDR10_metadata_file, None)
         if not execute(HDR10plus):
             logger.error("[video_ffmpeg.video_HDR_extract] HDR10+ extraction failed")
             return False
         if not check_output(VPC.HDR10_metadata_file):
             logger.error("[video_ffmpeg.video_HDR_extract] HDR10+ metadata file validation failed")
             return False
+        _hdr_metadata[VPC.HDR10_metadata_file] = VPC.source_path
 
         logger.debug("[video_ffmpeg.video_HDR_extract] HDR10+ metadata extraction completed successfully")
         return True
@@ -450,6 +1086,19 @@ def video_HDR_extract(VPC: VideoProcessingConfig):
         logger.error("[video_ffmpeg.video_HDR_extract] Ensure get_video_metadata_type() was called successfully before extraction")
         return False
     
+def _hdr_metadata_extracted(VPC: VideoProcessingConfig, metadata_file: str) -> bool:
+    """
+    True if metadata_file already holds the metadata of the original file, e.g. from the
+    type detection or an earlier rendition. Cut segments are always extracted again,
+    their temporary files are reused with different content.
+    """
+    if VPC.source_path != VPC.orig_file_path or _hdr_metadata.get(metadata_file) != VPC.source_path:
+        return False
+    if not check_output(metadata_file):
+        return False
+    logger.debug(f"[video_ffmpeg.video_HDR_extract] Reusing metadata extracted from {VPC.source_path}: {metadata_file}")
+    return True
+
 def elementary_to_mkv(VPC: VideoProcessingConfig):
     """
     Convert IVF elementary stream to MKV container format.
@@ -476,6 +1125,14 @@ def elementary_to_mkv(VPC: VideoProcessingConfig):
         '--clusters-in-meta-seek',
         VPC.source_path         
     ]
+
+    # The final output also gets the transcoded audio tracks
+    audio_files = list()
+    if VPC.target_path in _audio_jobs:
+        audio_files = audio_encode_wait(VPC)
+        if audio_files is None:
+            return False
+        command = command + audio_files
     
     logger.debug(f"[compressor.elementary_to_mkv] FFmpeg command: {' '.join(command)}")
 
@@ -485,16 +1142,85 @@ def elementary_to_mkv(VPC: VideoProcessingConfig):
     if not check_output(VPC.target_path):
         logger.error("[compressor.elementary_to_mkv] Conversion output validation failed")
         return False
+
+    if audio_files:
+        _audio_jobs[VPC.target_path]["muxed"] = True
     
     logger.debug("[compressor.elementary_to_mkv] IVF to MKV conversion completed successfully")
     return True
 
+def video_HDR_inject(VPC: VideoProcessingConfig):
+    """
+    Inject HDR metadata into encoded video files based on the detected metadata type.
+
+    This function takes an encoded video file and re-injects the previously extracted
+    HDR metadata (either Dolby Vision RPU or HDR10+ dynamic metadata) to create
+    the final HDR-capable output file.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration
+
+    Returns:
+        bool: True if metadata injection succeeded and output is valid,
+             False if injection failed or unsupported metadata type
+
+    """
+
+    logger.debug(f"[video_HDR_inject] Starting HDR metadata injection")
+    logger.debug(f"[video_HDR_inject] Source: {VPC.source_path} -> Target: {VPC.target_path}")
+    logger.debug(f"[video_HDR_inject] Metadata type: {VPC.HDR_type}")
+    
+    if VPC.HDR_type == "HDR10":
+        logger.debug("[video_HDR_inject] Injecting HDR10+ dynamic metadata")
+        HDR10plus_tool_path = "hdr10plus_tool"
+        command = [HDR10plus_tool_path, "inject", "-i", VPC.source_path, "-j", VPC.HDR10_metadata_file, "-o", VPC.target_path]
+        logger.debug(f"[video_HDR_inject] HDR10+ injection command: {' '.join(command)}")
+
+    elif VPC.HDR_type == "DoVi":
+        logger.debug("[video_HDR_inject] Injecting Dolby Vision RPU metadata")
+        dovi_tool_path = "dovi_tool"
+        command = [dovi_tool_path, "inject-rpu", "-i", VPC.source_path, "--rpu-in", VPC.dovi_metadata_file, "-o", VPC.target_path]
+        logger.debug(f"[video_HDR_inject] DoVi injection command: {' '.join(command)}")
+
+    elif VPC.HDR_type == "None":
+        logger.debug("[video_HDR_inject] File is not HDR, skipping metadata injection")
+        return True
+    
+    else:
+        logger.error(f"[video_HDR_inject] Unsupported metadata format: {VPC.HDR_type}")
+        logger.error("[video_HDR_inject] Supported formats are 'HDR10' and 'DoVi' only")
+        logger.error("[video_HDR_inject] Ensure get_video_metadata_type() was called successfully before injection")
+        return False
+    
+    if not execute(command):
+        logger.error("[video_HDR_inject] Metadata injection command failed")
+        return False
+
+    if not check_output(VPC.target_path):
+        logger.error("[video_HDR_inject] Injected file validation failed")
+        return False
+    return True
+
 def vfCropComandGenerator(VPC: VideoProcessingConfig) -> str:
     target_v_res = VPC.orig_v_res - VPC.crop[0] - VPC.crop[1]
     command = f"crop={VPC.orig_h_res}:{target_v_res}:0:{VPC.crop[0]},scale={VPC.output_res}:-2"
     logger.debug(f"[video_ffmpeg.video_encode_ffmpeg.vfCropComandGenerator] Generated filter: {command}")
     return command
 
+def video_filter_chain(VPC: VideoProcessingConfig) -> str:
+    """
+    Filter chain the encoder applies to the source, the profile -vf (FFmpeg encodes only)
+    followed by the crop/scale filter. VMAF references filtered with the source use the
+    same chain so the profile filter is not scored as distortion.
+    """
+    resolution_filter = vfCropComandGenerator(VPC)
+    if VPC.profile["function"][1] != "ffmpeg":
+        return resolution_filter
+    _, video_filter = _split_video_filter(VPC.profile["video"])
+    if video_filter is None:
+        return resolution_filter
+    return video_filter + "," + resolution_filter
+
 def video_ffmpeg_h265(VPC: VideoProcessingConfig) -> bool:
     """
     Main FFmpeg-based video encoding function with HDR metadata handling.
@@ -513,60 +1239,7 @@ def video_ffmpeg_h265(VPC: VideoProcessingConfig) -> bool:
     logger.debug(f"[video_ffmpeg] Starting FFmpeg encoding workflow")
     logger.debug(f"[video_ffmpeg] HDR processing enabled: {VPC.profile['HDR_enable'][1]}")
 
-        
-    def video_HDR_inject(VPC: VideoProcessingConfig):
-        """
-        Inject HDR metadata into encoded video files based on the detected metadata type.
-
-        This function takes an encoded video file and re-injects the previously extracted
-        HDR metadata (either Dolby Vision RPU or HDR10+ dynamic metadata) to create
-        the final HDR-capable output file.
-
-        Args:
-            VPC (VideoProcessingConfig): Video processing configuration
-
-        Returns:
-            bool: True if metadata injection succeeded and output is valid,
-                 False if injection failed or unsupported metadata type
-
-        """
-            
-
-        logger.debug(f"[video_ffmpeg.video_HDR_inject] Starting HDR metadata injection")
-        logger.debug(f"[video_ffmpeg.video_HDR_inject] Source: {VPC.source_path} -> Target: {VPC.target_path}")
-        logger.debug(f"[video_ffmpeg.video_HDR_inject] Metadata type: {VPC.HDR_type}")
-        
-        if VPC.HDR_type == "HDR10":
-            logger.debug("[video_ffmpeg.video_HDR_inject] Injecting HDR10+ dynamic metadata")
-            HDR10plus_tool_path = "hdr10plus_tool"
-            command = [HDR10plus_tool_path, "inject", "-i", VPC.source_path, "-j", VPC.HDR10_metadata_file, "-o", VPC.target_path]
-            logger.debug(f"[video_ffmpeg.video_HDR_inject] HDR10+ injection command: {' '.join(command)}")
-
-        elif VPC.HDR_type == "DoVi":
-            logger.debug("[video_ffmpeg.video_HDR_inject] Injecting Dolby Vision RPU metadata")
-            dovi_tool_path = "dovi_tool"
-            command = [dovi_tool_path, "inject-rpu", "-i", VPC.source_path, "--rpu-in", VPC.dovi_metadata_file, "-o", VPC.target_path]
-            logger.debug(f"[video_ffmpeg.video_HDR_inject] DoVi injection command: {' '.join(command)}")
-
-        elif VPC.HDR_type == "None":
-            logger.debug("[video_ffmpeg.video_HDR_inject] File is not HDR, skipping metadata injection")
-            return True
-        
-        else:
-            logger.error(f"[video_ffmpeg.video_HDR_inject] Unsupported metadata format: {VPC.HDR_type}")
-            logger.error("[video_ffmpeg.video_HDR_inject] Supported formats are 'HDR10' and 'DoVi' only")
-            logger.error("[video_ffmpeg.video_HDR_inject] Ensure get_video_metadata_type() was called successfully before injection")
-            return False
-        
-        if not execute(command):
-            logger.error("[video_ffmpeg.video_HDR_inject] Metadata injection command failed")
-            return False
 
-        if not check_output(VPC.target_path):
-            logger.error("[video_ffmpeg.video_HDR_inject] Injected file validation failed")
-            return False
-        return True
-             
     def video_encode_ffmpeg(VPC: VideoProcessingConfig) -> bool:
         
         """
@@ -602,16 +1275,9 @@ def video_ffmpeg_h265(VPC: VideoProcessingConfig) -> bool:
         ]
 
         # Include video profile and resolution filter
-        resolution_filter = vfCropComandGenerator(VPC)
-        video_profile_modified = VPC.profile["video"].copy()
+        video_profile_modified, _ = _split_video_filter(VPC.profile["video"])
+        video_profile_modified = video_profile_modified + ["-vf", video_filter_chain(VPC)]
 
-        try:
-            index = video_profile_modified.index("-vf")
-            video_profile_modified[index+1] = video_profile_modified[index+1] + "," + resolution_filter
-        except ValueError:
-            video_profile_modified.append("-vf")
-            video_profile_modified.append(resolution_filter)
-        
         command = command + video_profile_modified
 
         command_append = [
@@ -627,7 +1293,7 @@ def video_ffmpeg_h265(VPC: VideoProcessingConfig) -> bool:
         logger.debug(f"[video_ffmpeg.video_encode_ffmpeg] Complete FFmpeg command: {' '.join(command)}")
         logger.debug("[video_ffmpeg.video_encode_ffmpeg] Starting FFmpeg encoding process")
 
-        if execute(command):
+        if execute(command, expected_frames(VPC)):
             if check_output(VPC.target_path):
                 logger.debug("[video_ffmpeg.video_encode_ffmpeg] FFmpeg encoding completed successfully")
                 return True
@@ -691,191 +1357,248 @@ def video_ffmpeg_h265(VPC: VideoProcessingConfig) -> bool:
     logger.debug("[video_ffmpeg] FFmpeg encoding workflow completed successfully")
     return True
 
-def video_ffmpeg_AV1(VPC: VideoProcessingConfig) -> bool:
+def svtav1_command(VPC: VideoProcessingConfig, target_path: str, input_name: str = "stdin") -> str:
+    """
+    Build the SvtAv1EncApp part of the ffmpeg | SvtAv1EncApp pipeline.
 
-    def SvtAv1EncApp_encode(VPC: VideoProcessingConfig) -> bool:
-        """
-        Encode video files using SVT-AV1 encoder with cropping, scaling, and quality control.
+    Maps the source VUI to SVT-AV1 numbers and appends profile video settings,
+    dynamic HDR metadata and static HDR side data.
 
-        This function performs video encoding using SVT-AV1 with support for cropping,
-        resolution scaling, and constant quality encoding. It handles video filter
-        chain construction and integrates with profile-based encoding settings.
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration
+        target_path (str): Output IVF file
+        input_name (str, optional): SvtAv1EncApp input, "stdin" when fed through a pipe
 
-        Args:
-            VPC (VideoProcessingConfig): Video processing configuration
+    Returns:
+        str: SvtAv1EncApp command line
+    """
 
-        Returns:
-            bool: True if encoding succeeded and output is valid, False otherwise
-            
-        Note:
-            The function strips audio (-an) and subtitle (-sn) streams, focusing on
-            video-only encoding for HDR workflows.
-            
-        Raises:
-            ValueError: If crop parameters result in invalid dimensions
-            FileNotFoundError: If SVT-AV1 executable is not found
+    def primaries_name_to_num(name: str) -> int:
         """
+        ffprobe stream.color_primaries -> SVT-AV1 --color-primaries number
+        """
+        if name is None:
+            return 2  # unspecified/default
 
-        def primaries_name_to_num(name: str) -> int:
-            """
-            ffprobe stream.color_primaries -> SVT-AV1 --color-primaries number
-            """
-            if name is None:
-                return 2  # unspecified/default
+        n = name.strip().lower()
 
-            n = name.strip().lower()
+        mapping = {
+            "bt709": 1,
+            "unknown": 2,
+            "unspecified": 2,
 
-            mapping = {
-                "bt709": 1,
-                "unknown": 2,
-                "unspecified": 2,
+            "bt470m": 4,
+            "bt470bg": 5,
 
-                "bt470m": 4,
-                "bt470bg": 5,
+            # ffprobe may return bt601 or its historical aliases
+            "bt601": 6,
+            "smpte170m": 6,
+            "bt470bg": 5,
 
-                # ffprobe may return bt601 or its historical aliases
-                "bt601": 6,
-                "smpte170m": 6,
-                "bt470bg": 5,
+            "smpte240m": 7,
+            "smpte240": 7,
 
-                "smpte240m": 7,
-                "smpte240": 7,
+            "film": 8,
+            "bt2020": 9,
 
-                "film": 8,
-                "bt2020": 9,
+            "smpte428": 10,   # XYZ / SMPTE 428
+            "xyz": 10,
 
-                "smpte428": 10,   # XYZ / SMPTE 428
-                "xyz": 10,
+            "smpte431": 11,
+            "smpte432": 12,
 
-                "smpte431": 11,
-                "smpte432": 12,
+            "ebu3213": 22,
+        }
+        return mapping.get(n, 2)
 
-                "ebu3213": 22,
-            }
-            return mapping.get(n, 2)
+    def transfer_name_to_num(name: str) -> int:
+        """
+        ffprobe stream.color_transfer -> SVT-AV1 --transfer-characteristics number
+        """
+        if name is None:
+            return 2  # unspecified/default
 
-        def transfer_name_to_num(name: str) -> int:
-            """
-            ffprobe stream.color_transfer -> SVT-AV1 --transfer-characteristics number
-            """
-            if name is None:
-                return 2  # unspecified/default
+        n = name.strip().lower()
 
-            n = name.strip().lower()
+        mapping = {
+            "bt709": 1,
+            "unknown": 2,
+            "unspecified": 2,
 
-            mapping = {
-                "bt709": 1,
-                "unknown": 2,
-                "unspecified": 2,
+            "bt470m": 4,
+            "bt470bg": 5,
 
-                "bt470m": 4,
-                "bt470bg": 5,
+            "bt601": 6,
+            "smpte170m": 6,
 
-                "bt601": 6,
-                "smpte170m": 6,
+            "smpte240m": 7,
+            "smpte240": 7,
 
-                "smpte240m": 7,
-                "smpte240": 7,
+            "linear": 8,
+            "log100": 9,
+            "log100-sqrt10": 10,
 
-                "linear": 8,
-                "log100": 9,
-                "log100-sqrt10": 10,
+            "iec61966-2-4": 11,
+            "iec61966": 11,
 
-                "iec61966-2-4": 11,
-                "iec61966": 11,
+            "bt1361": 12,
 
-                "bt1361": 12,
+            "iec61966-2-1": 13,  # ffprobe usually reports 'iec61966-2-1' for sRGB-ish
+            "srgb": 13,
 
-                "iec61966-2-1": 13,  # ffprobe usually reports 'iec61966-2-1' for sRGB-ish
-                "srgb": 13,
+            "bt2020-10": 14,
+            "bt2020-12": 15,
 
-                "bt2020-10": 14,
-                "bt2020-12": 15,
+            "smpte2084": 16,     # PQ
+            "pq": 16,
 
-                "smpte2084": 16,     # PQ
-                "pq": 16,
+            "smpte428": 17,
 
-                "smpte428": 17,
+            # ffprobe uses 'arib-std-b67' for HLG
+            "arib-std-b67": 18,
+            "hlg": 18,
+        }
+        return mapping.get(n, 2)
 
-                # ffprobe uses 'arib-std-b67' for HLG
-                "arib-std-b67": 18,
-                "hlg": 18,
-            }
-            return mapping.get(n, 2)
+    def matrix_name_to_num(name: str) -> int:
+        """
+        ffprobe stream.color_space -> SVT-AV1 --matrix-coefficients number
+        """
+        if name is None:
+            return 2  # unspecified/default
 
-        def matrix_name_to_num(name: str) -> int:
-            """
-            ffprobe stream.color_space -> SVT-AV1 --matrix-coefficients number
-            """
-            if name is None:
-                return 2  # unspecified/default
+        n = name.strip().lower()
 
-            n = name.strip().lower()
+        mapping = {
+            "rgb": 0,          # ffprobe sometimes reports rgb for identity
+            "identity": 0,
 
-            mapping = {
-                "rgb": 0,          # ffprobe sometimes reports rgb for identity
-                "identity": 0,
+            "bt709": 1,
+            "unknown": 2,
+            "unspecified": 2,
 
-                "bt709": 1,
-                "unknown": 2,
-                "unspecified": 2,
+            "fcc": 4,
+            "bt470bg": 5,
 
-                "fcc": 4,
-                "bt470bg": 5,
+            "bt601": 6,
+            "smpte170m": 6,
 
-                "bt601": 6,
-                "smpte170m": 6,
+            "smpte240m": 7,
+            "smpte240": 7,
 
-                "smpte240m": 7,
-                "smpte240": 7,
+            "ycgco": 8,
 
-                "ycgco": 8,
+            # ffprobe uses these spellings
+            "bt2020nc": 9,
+            "bt2020-ncl": 9,
 
-                # ffprobe uses these spellings
-                "bt2020nc": 9,
-                "bt2020-ncl": 9,
+            "bt2020c": 10,
+            "bt2020-cl": 10,
 
-                "bt2020c": 10,
-                "bt2020-cl": 10,
+            "smpte2085": 11,
+            "chroma-ncl": 12,
+            "chroma-cl": 13,
 
-                "smpte2085": 11,
-                "chroma-ncl": 12,
-                "chroma-cl": 13,
+            "ictcp": 14,
+        }
+        return mapping.get(n, 2)
+    
+    def chroma_sample_position_name_to_num(name: str) -> int:
+        """
+        ffprobe stream.chroma_location -> SVT-AV1 --chroma-sample-position number
 
-                "ictcp": 14,
-            }
-            return mapping.get(n, 2)
-        
-        def chroma_sample_position_name_to_num(name: str) -> int:
-            """
-            ffprobe stream.chroma_location -> SVT-AV1 --chroma-sample-position number
-
-            SVT-AV1 options:
-            0: unknown/default
-            1: vertical/left
-            2: colocated/topleft
-            """
-            if name is None:
-                return 0
-
-            n = name.strip().lower()
-
-            mapping = {
-                "unspecified": 0,
-                "unknown": 0,
-
-                # ffprobe commonly returns these spellings
-                "left": 1,       # aka "vertical/left" in SVT docs
-                "topleft": 2,    # aka "colocated/topleft"
-
-                # Sometimes seen in other contexts; map conservatively
-                "center": 0,
-                "top": 0,
-                "bottom": 0,
-                "bottomleft": 0,
-            }
-            return mapping.get(n, 0)
+        SVT-AV1 options:
+        0: unknown/default
+        1: vertical/left
+        2: colocated/topleft
+        """
+        if name is None:
+            return 0
+
+        n = name.strip().lower()
+
+        mapping = {
+            "unspecified": 0,
+            "unknown": 0,
+
+            # ffprobe commonly returns these spellings
+            "left": 1,       # aka "vertical/left" in SVT docs
+            "topleft": 2,    # aka "colocated/topleft"
+
+            # Sometimes seen in other contexts; map conservatively
+            "center": 0,
+            "top": 0,
+            "bottom": 0,
+            "bottomleft": 0,
+        }
+        return mapping.get(n, 0)
+
+    svt_part = (
+        f"SvtAv1EncApp -i {input_name} " # Read from pipe
+        "--input-depth 10 "           # Explicit 10-bit depth
+        f"--crf {str(VPC.output_cq)} "                     
+        f"--color-primaries {primaries_name_to_num(VPC.VUI["color_primaries"])} "
+        f"--transfer-characteristics {transfer_name_to_num(VPC.VUI["color_transfer"])} "
+        f"--matrix-coefficients {matrix_name_to_num(VPC.VUI["color_space"])} "
+        "--color-range 0 "
+        f"--chroma-sample-position {chroma_sample_position_name_to_num(VPC.VUI["chroma_location"])} "
+        f"-b {target_path}"    # Output IVF file
+    )
+
+    video_profile = VPC.profile["video"].copy()
+    video_profile_str = ' '.join(video_profile)
+    svt_part = svt_part + " " + video_profile_str
+
+    if VPC.HDR_type in ("HDR10", "DoVi"):
+
+        if VPC.HDR_type == "HDR10":
+            svt_hdr_dynamic = (f"--hdr10plus-json {VPC.HDR10_metadata_file}") 
+
+        elif VPC.HDR_type == "DoVi":
+            svt_hdr_dynamic = (f"--dolby-vision-rpu {VPC.dovi_metadata_file}") 
         
+        svt_part = svt_part + " " + svt_hdr_dynamic
+
+    if VPC.SideDTA["Cll_exists"] == True:
+        svt_part = svt_part + f" --content-light {VPC.SideDTA["max_content"]},{VPC.SideDTA["max_average"]}"
+
+    if VPC.SideDTA["Mastering_display_exists"] == True:
+        svt_part += (
+            f" --mastering-display "
+            f"'G({VPC.SideDTA['green_x']},{VPC.SideDTA['green_y']})"
+            f"B({VPC.SideDTA['blue_x']},{VPC.SideDTA['blue_y']})"
+            f"R({VPC.SideDTA['red_x']},{VPC.SideDTA['red_y']})"
+            f"WP({VPC.SideDTA['white_point_x']},{VPC.SideDTA['white_point_y']})"
+            f"L({VPC.SideDTA['max_luminance']},{VPC.SideDTA['min_luminance']})'"
+)
+
+    return svt_part
+
+def video_ffmpeg_AV1(VPC: VideoProcessingConfig) -> bool:
+
+    def SvtAv1EncApp_encode(VPC: VideoProcessingConfig) -> bool:
+        """
+        Encode video files using SVT-AV1 encoder with cropping, scaling, and quality control.
+
+        This function performs video encoding using SVT-AV1 with support for cropping,
+        resolution scaling, and constant quality encoding. It handles video filter
+        chain construction and integrates with profile-based encoding settings.
+
+        Args:
+            VPC (VideoProcessingConfig): Video processing configuration
+
+        Returns:
+            bool: True if encoding succeeded and output is valid, False otherwise
+            
+        Note:
+            The function strips audio (-an) and subtitle (-sn) streams, focusing on
+            video-only encoding for HDR workflows.
+            
+        Raises:
+            ValueError: If crop parameters result in invalid dimensions
+            FileNotFoundError: If SVT-AV1 executable is not found
+        """
+
         logger.debug(f"[video_ffmpeg_AV1.SvtAv1EncApp_encode] Starting SVT-AV1 video encoding")
         logger.debug(f"[video_ffmpeg_AV1.SvtAv1EncApp_encode] Source: {VPC.source_path} -> Target: {VPC.target_path}")
         logger.debug(f"[video_ffmpeg_AV1.SvtAv1EncApp_encode] Encoding parameters - Target resolution: {VPC.output_res}, CQ: {VPC.output_cq}, Crop: {VPC.crop}")
@@ -897,44 +1620,7 @@ def video_ffmpeg_AV1(VPC: VideoProcessingConfig) -> bool:
             "-"                           # Output to stdout
         )
 
-        svt_part = (
-            "SvtAv1EncApp -i stdin "      # Read from pipe
-            "--input-depth 10 "           # Explicit 10-bit depth
-            f"--crf {str(VPC.output_cq)} "                     
-            f"--color-primaries {primaries_name_to_num(VPC.VUI["color_primaries"])} "
-            f"--transfer-characteristics {transfer_name_to_num(VPC.VUI["color_transfer"])} "
-            f"--matrix-coefficients {matrix_name_to_num(VPC.VUI["color_space"])} "
-            "--color-range 0 "
-            f"--chroma-sample-position {chroma_sample_position_name_to_num(VPC.VUI["chroma_location"])} "
-            f"-b {VPC.target_path}"    # Output IVF file
-        )
-
-        video_profile = VPC.profile["video"].copy()
-        video_profile_str = ' '.join(video_profile)
-        svt_part = svt_part + " " + video_profile_str
-
-        if VPC.HDR_type is not ("None" or "uninit"):
-
-            if VPC.HDR_type == "HDR10":
-                svt_hdr_dynamic = (f"--hdr10plus-json {VPC.HDR10_metadata_file}") 
-
-            elif VPC.HDR_type == "DoVi":
-                svt_hdr_dynamic = (f"--dolby-vision-rpu {VPC.dovi_metadata_file}") 
-            
-            svt_part = svt_part + " " + svt_hdr_dynamic
-
-        if VPC.SideDTA["Cll_exists"] == True:
-            svt_part = svt_part + f" --content-light {VPC.SideDTA["max_content"]},{VPC.SideDTA["max_average"]}"
-
-        if VPC.SideDTA["Mastering_display_exists"] == True:
-            svt_part += (
-                f" --mastering-display "
-                f"'G({VPC.SideDTA['green_x']},{VPC.SideDTA['green_y']})"
-                f"B({VPC.SideDTA['blue_x']},{VPC.SideDTA['blue_y']})"
-                f"R({VPC.SideDTA['red_x']},{VPC.SideDTA['red_y']})"
-                f"WP({VPC.SideDTA['white_point_x']},{VPC.SideDTA['white_point_y']})"
-                f"L({VPC.SideDTA['max_luminance']},{VPC.SideDTA['min_luminance']})'"
-)
+        svt_part = svtav1_command(VPC, VPC.target_path)
 
         # The final list calls /bin/sh to execute the pipe
         command = [
@@ -946,7 +1632,7 @@ def video_ffmpeg_AV1(VPC: VideoProcessingConfig) -> bool:
         logger.debug(f"[video_ffmpeg_AV1.SvtAv1EncApp_encode] Complete FFmpeg command: {' '.join(command)}")
         logger.debug("[video_ffmpeg_AV1.SvtAv1EncApp_encode] Starting FFmpeg encoding process")
 
-        if execute(command):
+        if execute(command, expected_frames(VPC)):
             if check_output(VPC.target_path):
                 logger.debug("[video_ffmpeg_AV1.SvtAv1EncApp_encode] FFmpeg encoding completed successfully")
                 return True
@@ -984,12 +1670,441 @@ def video_ffmpeg_AV1(VPC: VideoProcessingConfig) -> bool:
     logger.debug("[video_ffmpeg] FFmpeg encoding workflow completed successfully")
     return True
 
+def video_ffmpeg_h265_fanout(VPC: VideoProcessingConfig, variants: list) -> list:
+    """
+    Encode several HEVC variants of one source with a single FFmpeg process.
+
+    The source is decoded once and the filter graph is split into one crop/scale branch
+    per variant. HDR metadata is extracted once and injected into every variant.
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the shared source
+        variants (list): VideoProcessingConfig of each output
+
+    Returns:
+        list: True for every variant that was encoded successfully, False otherwise
+    """
+    logger.debug(f"[video_ffmpeg_h265_fanout] Starting FFmpeg fan-out encoding of {len(variants)} variants")
+
+    HDR = False
+    if VPC.profile["HDR_enable"][1]:
+        if video_HDR_extract(VPC) and VPC.HDR_type != "None":
+            HDR = True
+        else:
+            logger.error("[video_ffmpeg_h265_fanout] HDR metadata extraction failed")
+            VPC.DisableParentHDR()
+
+    # Every output uses the video options of its own profile (renditions may differ in
+    # encoder settings). A -vf filter shared by all profiles runs once before the split.
+    video_profiles = [_split_video_filter(variant.profile["video"]) for variant in variants]
+    video_filters = [video_filter for _, video_filter in video_profiles]
+    if len(set(video_filters)) == 1:
+        input_filter, branch_filters = video_filters[0], None
+    else:
+        input_filter, branch_filters = None, video_filters
+
+    command = [
+        "ffmpeg",  # Command to run FFmpeg
+        "-i", VPC.source_path,  # Input file
+        "-an",  # No audio
+        "-sn",  # No subtitles
+        "-filter_complex", _fanout_filter_graph(variants, input_filter, branch_filters)
+    ]
+
+    for i, variant in enumerate(variants):
+        video_profile = video_profiles[i][0]
+        variant.HDR_type = VPC.HDR_type
+        if HDR:
+            variant.setTargetPath(os.path.join(variant.workspace, variant.output_file_name + "_reencode.hevc"))
+        else:
+            variant.setTargetPath(variant.output_file_path)
+
+        command = command + ["-map", f"[v{i}]"] + video_profile + [
+            "-copy_unknown",  # Copy unknown streams
+            "-map_metadata", "0",  # Copy metadata from input
+            '-cq', str(variant.output_cq),  # Constant Quality mode
+            '-y',  # Overwrite output file
+            variant.target_path  # Output file
+        ]
+
+    logger.debug(f"[video_ffmpeg_h265_fanout] Complete FFmpeg command: {' '.join(command)}")
+
+    if not execute(command, expected_frames(VPC)):
+        logger.error("[video_ffmpeg_h265_fanout] FFmpeg fan-out encoding failed")
+        return [False] * len(variants)
+
+    passed = list()
+    for variant in variants:
+        if not check_output(variant.target_path):
+            logger.error(f"[video_ffmpeg_h265_fanout] Output file validation failed: {variant.target_path}")
+            passed.append(False)
+            continue
+
+        if not HDR:
+            passed.append(True)
+            continue
+
+        # Inject HDR metadata and containerize every variant
+        variant.setSourcePath(variant.target_path)
+        variant.setTargetPath(os.path.join(variant.workspace, variant.output_file_name + "_HDR_inject.hevc"))
+        if not video_HDR_inject(variant):
+            logger.error(f"[video_ffmpeg_h265_fanout] HDR metadata injection failed: {variant.output_file_name}")
+            passed.append(False)
+            continue
+        delete_file(variant, variant.source_path)
+
+        variant.setSourcePath(variant.target_path)
+        variant.setTargetPath(variant.output_file_path)
+        if not elementary_to_mkv(variant):
+            logger.error(f"[video_ffmpeg_h265_fanout] HEVC to MKV conversion failed: {variant.output_file_name}")
+            passed.append(False)
+            continue
+        delete_file(variant, variant.source_path)
+        passed.append(True)
+
+    return passed
+
+def video_ffmpeg_AV1_fanout(VPC: VideoProcessingConfig, variants: list) -> list:
+    """
+    Encode several AV1 variants of one source with a single FFmpeg decode.
+
+    FFmpeg decodes the source once, splits the filter graph and writes one Y4M stream
+    per variant into a named pipe. Every pipe feeds its own SvtAv1EncApp process.
+
+    Args:
+        VPC (VideoProcessingConfig): Configuration of the shared source
+        variants (list): VideoProcessingConfig of each output
+
+    Returns:
+        list: True for every variant that was encoded successfully, False otherwise
+    """
+    logger.debug(f"[video_ffmpeg_AV1_fanout] Starting SVT-AV1 fan-out encoding of {len(variants)} variants")
+
+    if VPC.profile["HDR_enable"][1]:
+        if not video_HDR_extract(VPC):
+            logger.error("[video_ffmpeg_AV1_fanout] HDR metadata extraction failed")
+            return [False] * len(variants)
+
+    fifos = list()
+    encoders = list()
+    ffmpeg_outputs = list()
+    for i, variant in enumerate(variants):
+        variant.HDR_type = VPC.HDR_type
+        variant.setTargetPath(os.path.join(variant.workspace, variant.output_file_name + "_reencode.ivf"))
+
+        fifo = os.path.join(VPC.workspace, variant.output_file_name + "_y4m.fifo")
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+        fifos.append(fifo)
+
+        encoders.append(f"{svtav1_command(variant, variant.target_path)} < {shlex.quote(fifo)} & pid{i}=$!")
+        ffmpeg_outputs.append(
+            f"-map '[v{i}]' "
+            "-pix_fmt yuv420p10le "       # 10-bit pixel format
+            "-f yuv4mpegpipe -strict -1 " # Y4M pipe (carries metadata)
+            f"{shlex.quote(fifo)}"
+        )
+
+    ffmpeg_part = (
+        f"ffmpeg -y -i {shlex.quote(VPC.source_path)} "
+        "-an -sn "                    # No audio/subs
+        f"-filter_complex {shlex.quote(_fanout_filter_graph(variants))} "
+        + " ".join(ffmpeg_outputs)
+    )
+
+    pids = " ".join(f"$pid{i}" for i in range(len(variants)))
+    script = "\n".join(
+        encoders + [
+            f"{ffmpeg_part}; rc=$?",
+            f"if [ $rc -ne 0 ]; then kill {pids} 2>/dev/null; fi",  # readers would wait on their pipes forever
+            f"for pid in {pids}; do wait $pid || rc=1; done",
+            "exit $rc"
+        ]
+    )
+
+    # The final list calls /bin/sh to run the encoders and the decoder
+    command = [
+        "/bin/sh",
+        "-c",
+        script
+    ]
+
+    logger.debug(f"[video_ffmpeg_AV1_fanout] Complete command: {' '.join(command)}")
+
+    success = execute(command, expected_frames(VPC))
+    for fifo in fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+
+    if not success:
+        logger.error("[video_ffmpeg_AV1_fanout] Fan-out encoding failed")
+        return [False] * len(variants)
+
+    passed = list()
+    for variant in variants:
+        if not check_output(variant.target_path):
+            logger.error(f"[video_ffmpeg_AV1_fanout] Output file validation failed: {variant.target_path}")
+            passed.append(False)
+            continue
+
+        variant.setSourcePath(variant.target_path)
+        variant.setTargetPath(variant.output_file_path)
+        if not elementary_to_mkv(variant):
+            logger.error(f"[video_ffmpeg_AV1_fanout] IVF to MKV conversion failed: {variant.output_file_name}")
+            passed.append(False)
+            continue
+        delete_file(variant, variant.source_path)
+        passed.append(True)
+
+    return passed
+
 #TODO
 #new ffmpeg + svt-av1-hdr function here
 #basic commands:
 #ffmpeg -i /input/DoVi.mkv -pix_fmt yuv420p10le -f rawvideo - | SvtAv1EncApp -i /workspace/input.yuv -w 3840 -h 2160 -b /workspace/video.ivf --dolby-vision-rpu /workspace/dovi_rpu.bin
 #ffmpeg -i video.ivf -c:v copy -an video.mkv
 
+def get_audio_streams(file_path: str) -> list:
+    """
+    List the audio streams of a file.
+
+    Args:
+        file_path (str): Path to the media file
+
+    Returns:
+        list: ffprobe stream dictionaries with "index", "codec_name", "channels" and "tags"
+    """
+    command = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "a",
+        "-show_entries", "stream=index,codec_name,channels:stream_tags=language,title",
+        "-of", "json",
+        file_path
+    ]
+    logger.debug(f"[get_audio_streams] FFprobe command: {' '.join(command)}")
+
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        return json.loads(result.stdout).get("streams", [])
+    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        logger.error(f"[get_audio_streams] FFprobe failed for {file_path}: {e}")
+        return list()
+
+def _is_ffmpeg_audio(options: list) -> bool:
+    """True if a profile section holds FFmpeg audio options (and e.g. not HandBrake --aencoder)."""
+    if not options or len(options) % 2:
+        return False
+    keys = options[::2]
+    if any(not key.startswith("-") or key.startswith("--") for key in keys):
+        return False
+    return any(key in ("-c:a", "-codec:a", "-acodec") for key in keys)
+
+def _audio_codec_args(VPC: VideoProcessingConfig, channels: int) -> list:
+    """
+    Codec options of the profile "stereo" (up to 2 channels) or "audio" section with the
+    channel count. A "ffmpeg_stereo"/"ffmpeg_audio" section takes precedence, for profiles
+    whose audio sections belong to another encoder. Sections that are not FFmpeg options
+    fall back to libopus.
+    """
+    section = "stereo" if channels <= 2 else "audio"
+    codec_args = VPC.profile.get(f"ffmpeg_{section}", VPC.profile.get(section))
+    if not _is_ffmpeg_audio(codec_args):
+        if codec_args:
+            logger.warning(f"[audio_encode_start] Profile {section} section is not FFmpeg syntax ({' '.join(map(str, codec_args))}), using libopus")
+        codec_args = ["-c:a", "libopus"]
+    codec_args = [str(option) for option in codec_args]
+    if "-ac" in codec_args:
+        index = codec_args.index("-ac")
+        del codec_args[index:index+2]
+    return codec_args + ["-ac", str(channels)]
+
+def _lower_priority(pid: int, niceness: int) -> None:
+    """
+    Lower the CPU priority of a started process by niceness. Set from the parent with
+    setpriority, preexec_fn is not safe in a process with threads.
+    """
+    if not hasattr(os, "setpriority"):
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, min(19, os.getpriority(os.PRIO_PROCESS, 0) + niceness))
+    except OSError as e:
+        logger.warning(f"[audio_encode_start] Failed to lower the priority of PID {pid}: {e}")
+
+def audio_encode_start(VPC: VideoProcessingConfig) -> bool:
+    """
+    Start transcoding the selected audio tracks of the original file in background processes.
+
+    Tracks are selected by Audio_encode.languages (all tracks if empty). Every track is
+    downmixed to at most VPC.channels channels (from getNumOfChannels) and encoded with the
+    profile "stereo" or "audio" section in its own low priority FFmpeg process. The jobs
+    are kept in the module level registry under the output file path and picked up by
+    elementary_to_mkv or audio_mux. Outputs of one title with the same audio settings
+    (e.g. the variants of a fan-out encode) share one transcode.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration of the full title
+
+    Returns:
+        bool: True if the output has audio jobs, False otherwise
+    """
+    settings = VPC.test_settings.get("Audio_encode", {})
+    if not settings.get("Enabled", False):
+        return False
+
+    languages = settings.get("languages") or []
+    streams = get_audio_streams(VPC.orig_file_path)
+    selected = [stream for stream in streams if not languages or stream.get("tags", {}).get("language", "und") in languages]
+    if not selected and streams:
+        logger.warning(f"[audio_encode_start] No audio track in {languages}, using the first track")
+        selected = streams[:1]
+
+    tracks = list()
+    for stream in selected:
+        channels = int(stream.get("channels", 2))
+        if VPC.channels:
+            channels = min(channels, VPC.channels)
+        language = stream.get("tags", {}).get("language", "und")
+        tracks.append((stream["index"], language, channels, _audio_codec_args(VPC, channels)))
+
+    key = json.dumps([VPC.orig_file_path, tracks])
+    if key in _audio_transcodes:
+        logger.debug(f"[audio_encode_start] Sharing the running audio transcode with {VPC.output_file_name}")
+        _audio_transcodes[key]["users"].add(VPC.output_file_path)
+        _audio_jobs[VPC.output_file_path] = {"transcode": key, "muxed": False}
+        return True
+
+    jobs = list()
+    for number, (index, language, channels, codec_args) in enumerate(tracks):
+        target = os.path.join(VPC.workspace, f"{VPC.output_file_name}_audio{number}.mka")
+
+        command = [
+            "ffmpeg", "-y", "-nostdin",
+            "-loglevel", "error",
+            "-i", VPC.orig_file_path,
+            "-map", f"0:{index}",
+            "-vn", "-sn", "-dn",
+            *codec_args,
+            "-metadata:s:a:0", f"language={language}",
+            target
+        ]
+        logger.debug(f"[audio_encode_start] FFmpeg command: {' '.join(command)}")
+
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        except OSError as e:
+            logger.error(f"[audio_encode_start] Failed to start audio transcode of stream {index}: {e}")
+            continue
+        _lower_priority(process.pid, settings.get("niceness", 19))
+        resource_monitor.watch(process, f"audio transcode of stream {index}")
+
+        logger.info(f"[audio_encode_start] Transcoding audio stream {index} ({language}, {channels} channels) in PID {process.pid}")
+        jobs.append((process, target))
+
+    if not jobs:
+        return False
+
+    _audio_transcodes[key] = {"jobs": jobs, "files": None, "users": {VPC.output_file_path}}
+    _audio_jobs[VPC.output_file_path] = {"transcode": key, "muxed": False}
+    return True
+
+def audio_encode_wait(VPC: VideoProcessingConfig) -> Union[list, None]:
+    """
+    Wait for the audio jobs of an output file.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration of the full title
+
+    Returns:
+        list: Paths of the transcoded audio tracks, or None if any of them failed
+    """
+    transcode = _audio_transcodes[_audio_jobs[VPC.output_file_path]["transcode"]]
+    if transcode["files"] is None:
+        audio_files = list()
+        for process, target in transcode["jobs"]:
+            _, stderr = process.communicate()
+            if process.returncode != 0 or not check_output(target):
+                logger.error(f"[audio_encode_wait] Audio transcode to {target} failed with exit code {process.returncode}")
+                logger.error(stderr.strip())
+                # The output cannot get its audio, the other tracks are not needed
+                _audio_stop(transcode["jobs"])
+                audio_files = False
+                break
+            audio_files.append(target)
+        transcode["files"] = audio_files
+
+    if transcode["files"] is False:
+        return None
+
+    logger.debug(f"[audio_encode_wait] Audio tracks ready: {transcode['files']}")
+    return list(transcode["files"])
+
+def _audio_release(VPC: VideoProcessingConfig) -> None:
+    """
+    Detach an output file from its audio transcode. The last output stops the jobs that
+    are still running and deletes the audio files.
+    """
+    key = _audio_jobs.pop(VPC.output_file_path, {}).get("transcode")
+    if key not in _audio_transcodes:
+        return
+    transcode = _audio_transcodes[key]
+    transcode["users"].discard(VPC.output_file_path)
+    if transcode["users"]:
+        return
+
+    del _audio_transcodes[key]
+    _audio_stop(transcode["jobs"])
+    for _, target in transcode["jobs"]:
+        if os.path.exists(target):
+            delete_file(VPC, target)
+
+def _audio_stop(jobs: list) -> None:
+    """Kill the audio transcodes of a job list that are still running."""
+    for process, target in jobs:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+            logger.debug(f"[audio_encode_cancel] Killed audio transcode to {target}")
+
+def audio_encode_cancel(VPC: VideoProcessingConfig) -> None:
+    """Forget the audio jobs of an output file, stopping them unless other outputs share them."""
+    _audio_release(VPC)
+
+def audio_mux(VPC: VideoProcessingConfig) -> bool:
+    """
+    Add the transcoded audio tracks to the finished output file.
+
+    Outputs built by elementary_to_mkv already contain them; other outputs are remuxed
+    with mkvmerge.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration of the full title
+
+    Returns:
+        bool: True if the output has its audio tracks, False otherwise
+    """
+    if _audio_jobs[VPC.output_file_path]["muxed"]:
+        audio_files = _audio_transcodes[_audio_jobs[VPC.output_file_path]["transcode"]]["files"]
+    else:
+        audio_files = audio_encode_wait(VPC)
+        if audio_files is None:
+            _audio_release(VPC)
+            return False
+
+        muxed_path = os.path.join(VPC.workspace, VPC.output_file_name + "_audio_mux.mkv")
+        command = ['mkvmerge', '-o', muxed_path, VPC.output_file_path] + audio_files
+        logger.debug(f"[audio_mux] mkvmerge command: {' '.join(command)}")
+
+        if not execute(command) or not check_output(muxed_path):
+            logger.error("[audio_mux] Adding audio tracks failed")
+            _audio_release(VPC)
+            return False
+        os.replace(muxed_path, VPC.output_file_path)
+
+    logger.info(f"[audio_mux] Output has {len(audio_files)} audio tracks")
+    _audio_release(VPC)
+    return True
+
 def delete_file(VPC, file: str) -> None:
     if VPC.test_settings["Enable_delete"]["Enabled"]:
         logger.debug(f"[delete_file] Deleting: {file}")
@@ -998,10 +2113,17 @@ def delete_file(VPC, file: str) -> None:
             os.remove(file)
             logger.debug(f"[delete_file] Deleted file: {file}")
         elif os.path.isdir(file):
-            shutil.rmtree(file)
-            logger.debug(f"[delete_file] Deleted directory: {file}")
+            if workspace_manager.schedule_cleanup(file):
+                logger.debug(f"[delete_file] Directory queued for cleanup: {file}")
+            else:
+                shutil.rmtree(file)
+                workspace_manager.release(file)
+                logger.debug(f"[delete_file] Deleted directory: {file}")
         else:
             logger.warning(f"[delete_file] Path does not exist: {file}")
+    else:
+        # Files are kept, stop counting them against the workspace quota
+        workspace_manager.release(file)
 
 if __name__ == '__main__':
 
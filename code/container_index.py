@@ -0,0 +1,387 @@
+import struct
+import io
+import os
+import logging
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+# Matroska EBML element IDs (marker bits included)
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+SEEKHEAD_ID = 0x114D9B74
+SEEK_ID = 0x4DBB
+SEEK_ID_ID = 0x53AB
+SEEK_POSITION_ID = 0x53AC
+INFO_ID = 0x1549A966
+TIMECODE_SCALE_ID = 0x2AD7B1
+TRACKS_ID = 0x1654AE6B
+TRACK_ENTRY_ID = 0xAE
+TRACK_NUMBER_ID = 0xD7
+TRACK_TYPE_ID = 0x83
+CUES_ID = 0x1C53BB6B
+CUE_POINT_ID = 0xBB
+CUE_TIME_ID = 0xB3
+CUE_TRACK_POSITIONS_ID = 0xB7
+CUE_TRACK_ID = 0xF7
+CUE_CLUSTER_POSITION_ID = 0xF1
+CLUSTER_ID = 0x1F43B675
+
+MP4_TOP_LEVEL_BOXES = (b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pdin", b"styp")
+
+# Largest index element/box that is read into memory
+MAX_INDEX_SIZE = 256 * 1024 * 1024
+
+
+def read_index(file_path: str) -> dict:
+    """
+    Locate and parse the seek index of a Matroska or MP4 file with a few targeted reads.
+
+    Matroska Cues are found either before the first Cluster or through the SeekHead
+    (usually at the end of the file). For MP4 the sample tables of the first video
+    track inside "moov" are used, wherever the box is placed.
+
+    Args:
+        file_path (str): Path to the media file
+
+    Returns:
+        dict: {"container": "matroska" or "mp4", "index_offset": byte offset of the index,
+               "index_before_data": bool, "keyframes": [[time in seconds, byte position], ...]},
+              or None if the container is not supported or has no index
+    """
+    try:
+        file_size = os.path.getsize(file_path)
+        with open(file_path, "rb") as f:
+            magic = f.read(8)
+            if magic[:4] == EBML_ID.to_bytes(4, "big"):
+                index = _read_matroska_index(f, file_size)
+            elif magic[4:8] in MP4_TOP_LEVEL_BOXES:
+                index = _read_mp4_index(f, file_size)
+            else:
+                logger.debug(f"[read_index] Unsupported container: {file_path}")
+                return None
+    except (OSError, EOFError, ValueError, struct.error) as e:
+        logger.warning(f"[read_index] Failed to parse index of {file_path}: {e}")
+        return None
+
+    if index is None:
+        logger.debug(f"[read_index] No index found in: {file_path}")
+    else:
+        logger.debug(f"[read_index] {index['container']} index at byte {index['index_offset']} with {len(index['keyframes'])} entries")
+    return index
+
+
+# ---------------------------------------------------------------------------
+# Matroska
+# ---------------------------------------------------------------------------
+
+def _read_vint(f, keep_marker: bool = False) -> tuple:
+    """Read an EBML variable size integer, returns (value, unknown size flag)."""
+    first = f.read(1)
+    if not first:
+        raise EOFError("Unexpected end of EBML data")
+
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first[0] & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML variable size integer")
+
+    value = first[0] if keep_marker else first[0] & (mask - 1)
+    rest = f.read(length - 1)
+    if len(rest) != length - 1:
+        raise EOFError("Unexpected end of EBML data")
+    for byte in rest:
+        value = (value << 8) | byte
+
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, unknown
+
+
+def _iter_elements(f, start: int, end: int):
+    """Yield (element id, header offset, data offset, data size or None) of sibling elements."""
+    offset = start
+    while offset < end:
+        f.seek(offset)
+        try:
+            element_id, _ = _read_vint(f, keep_marker=True)
+            size, unknown = _read_vint(f)
+        except EOFError:
+            return
+        data_start = f.tell()
+        yield element_id, offset, data_start, None if unknown else size
+        if unknown:
+            return
+        offset = data_start + size
+
+
+def _read_uint(f, offset: int, size: int) -> int:
+    f.seek(offset)
+    return int.from_bytes(f.read(size), "big")
+
+
+def _read_element(f, offset: int, expected_id: int):
+    """Read a whole element at offset into memory, returns a BytesIO of its body or None."""
+    f.seek(offset)
+    element_id, _ = _read_vint(f, keep_marker=True)
+    size, unknown = _read_vint(f)
+    if element_id != expected_id or unknown or size > MAX_INDEX_SIZE:
+        return None
+    return io.BytesIO(f.read(size))
+
+
+def _parse_seekhead(body, segment_start: int) -> dict:
+    positions = dict()
+    end = len(body.getbuffer())
+    for element_id, _, data_start, size in _iter_elements(body, 0, end):
+        if element_id != SEEK_ID or size is None:
+            continue
+        seek_id = seek_position = None
+        for child_id, _, child_start, child_size in _iter_elements(body, data_start, data_start + size):
+            if child_id == SEEK_ID_ID:
+                seek_id = _read_uint(body, child_start, child_size)
+            elif child_id == SEEK_POSITION_ID:
+                seek_position = _read_uint(body, child_start, child_size)
+        if seek_id is not None and seek_position is not None:
+            positions.setdefault(seek_id, list()).append(segment_start + seek_position)
+    return positions
+
+
+def _read_matroska_index(f, file_size: int) -> dict:
+    # EBML header followed by the Segment
+    elements = _iter_elements(f, 0, file_size)
+    element_id, _, _, _ = next(elements, (None, 0, 0, 0))
+    if element_id != EBML_ID:
+        return None
+    element_id, _, segment_start, segment_size = next(elements, (None, 0, 0, 0))
+    if element_id != SEGMENT_ID:
+        return None
+    segment_end = file_size if segment_size is None else min(file_size, segment_start + segment_size)
+
+    # Top level elements up to the first Cluster, SeekHead entries point to the rest
+    found = {SEEKHEAD_ID: list(), INFO_ID: list(), TRACKS_ID: list(), CUES_ID: list()}
+    first_cluster = None
+    for element_id, offset, _, size in _iter_elements(f, segment_start, segment_end):
+        if element_id == CLUSTER_ID or size is None:
+            first_cluster = offset
+            break
+        if element_id in found:
+            found[element_id].append(offset)
+
+    parsed_seekheads = set()
+    while True:
+        pending = [offset for offset in found[SEEKHEAD_ID] if offset not in parsed_seekheads]
+        if not pending:
+            break
+        for offset in pending:
+            parsed_seekheads.add(offset)
+            body = _read_element(f, offset, SEEKHEAD_ID)
+            if body is None:
+                continue
+            for seek_id, offsets in _parse_seekhead(body, segment_start).items():
+                if seek_id in found:
+                    found[seek_id].extend(o for o in offsets if o not in found[seek_id])
+                elif seek_id == CLUSTER_ID and first_cluster is None:
+                    first_cluster = min(offsets)
+
+    timecode_scale = 1_000_000
+    for offset in found[INFO_ID][:1]:
+        body = _read_element(f, offset, INFO_ID)
+        if body is not None:
+            for element_id, _, data_start, size in _iter_elements(body, 0, len(body.getbuffer())):
+                if element_id == TIMECODE_SCALE_ID:
+                    timecode_scale = _read_uint(body, data_start, size)
+
+    video_track = None
+    for offset in found[TRACKS_ID][:1]:
+        body = _read_element(f, offset, TRACKS_ID)
+        if body is None:
+            continue
+        for element_id, _, data_start, size in _iter_elements(body, 0, len(body.getbuffer())):
+            if element_id != TRACK_ENTRY_ID or size is None:
+                continue
+            track = dict()
+            for child_id, _, child_start, child_size in _iter_elements(body, data_start, data_start + size):
+                if child_id in (TRACK_NUMBER_ID, TRACK_TYPE_ID):
+                    track[child_id] = _read_uint(body, child_start, child_size)
+            if track.get(TRACK_TYPE_ID) == 1:
+                video_track = track.get(TRACK_NUMBER_ID)
+                break
+
+    for cues_offset in found[CUES_ID]:
+        body = _read_element(f, cues_offset, CUES_ID)
+        if body is None:
+            continue
+        keyframes = _parse_cues(body, segment_start, timecode_scale, video_track)
+        if keyframes:
+            return {
+                "container": "matroska",
+                "index_offset": cues_offset,
+                "index_before_data": first_cluster is None or cues_offset < first_cluster,
+                "keyframes": keyframes
+            }
+    return None
+
+
+def _parse_cues(body, segment_start: int, timecode_scale: int, video_track: int) -> list:
+    keyframes = list()
+    for element_id, _, data_start, size in _iter_elements(body, 0, len(body.getbuffer())):
+        if element_id != CUE_POINT_ID or size is None:
+            continue
+        cue_time = None
+        positions = list()
+        for child_id, _, child_start, child_size in _iter_elements(body, data_start, data_start + size):
+            if child_id == CUE_TIME_ID:
+                cue_time = _read_uint(body, child_start, child_size)
+            elif child_id == CUE_TRACK_POSITIONS_ID and child_size is not None:
+                track = cluster = None
+                for pos_id, _, pos_start, pos_size in _iter_elements(body, child_start, child_start + child_size):
+                    if pos_id == CUE_TRACK_ID:
+                        track = _read_uint(body, pos_start, pos_size)
+                    elif pos_id == CUE_CLUSTER_POSITION_ID:
+                        cluster = _read_uint(body, pos_start, pos_size)
+                if cluster is not None and (video_track is None or track == video_track):
+                    positions.append(cluster)
+        if cue_time is not None and positions:
+            keyframes.append([cue_time * timecode_scale / 1e9, segment_start + positions[0]])
+
+    keyframes.sort()
+    return keyframes
+
+
+# ---------------------------------------------------------------------------
+# ISO-BMFF (MP4/MOV)
+# ---------------------------------------------------------------------------
+
+def _iter_boxes(f, start: int, end: int):
+    """Yield (box type, box offset, header size, box size) of sibling boxes."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type, offset, header_size, size
+        offset += size
+
+
+def _find_box(f, start: int, end: int, box_type: bytes) -> tuple:
+    """Return (body offset, body end) of the first child box of a type, or None."""
+    for child_type, offset, header_size, size in _iter_boxes(f, start, end):
+        if child_type == box_type:
+            return offset + header_size, offset + size
+    return None
+
+
+def _read_table(f, box: tuple, entry_format: str, skip: int = 4) -> list:
+    """Read a full-box table: version/flags, skip - 4 extra bytes, entry count, entries."""
+    f.seek(box[0] + skip)
+    count = struct.unpack(">I", f.read(4))[0]
+    entry_size = struct.calcsize(">" + entry_format)
+    data = f.read(count * entry_size)
+    return list(struct.iter_unpack(">" + entry_format, data[:len(data) - len(data) % entry_size]))
+
+
+def _read_mp4_index(f, file_size: int) -> dict:
+    moov = None
+    first_mdat = None
+    for box_type, offset, header_size, size in _iter_boxes(f, 0, file_size):
+        if box_type == b"moov" and moov is None:
+            moov = (offset, header_size, size)
+        elif box_type == b"mdat" and first_mdat is None:
+            first_mdat = offset
+
+    if moov is None or moov[2] > MAX_INDEX_SIZE:
+        return None
+
+    moov_offset, header_size, size = moov
+    f.seek(moov_offset + header_size)
+    body = io.BytesIO(f.read(size - header_size))
+    end = size - header_size
+
+    for box_type, offset, trak_header, trak_size in _iter_boxes(body, 0, end):
+        if box_type != b"trak":
+            continue
+        mdia = _find_box(body, offset + trak_header, offset + trak_size, b"mdia")
+        if mdia is None:
+            continue
+        hdlr = _find_box(body, *mdia, b"hdlr")
+        if hdlr is None:
+            continue
+        body.seek(hdlr[0] + 8)
+        if body.read(4) != b"vide":
+            continue
+
+        keyframes = _mp4_track_keyframes(body, mdia)
+        if keyframes:
+            return {
+                "container": "mp4",
+                "index_offset": moov_offset,
+                "index_before_data": first_mdat is None or moov_offset < first_mdat,
+                "keyframes": keyframes
+            }
+        # Fragmented files keep their samples in moof boxes
+        return None
+    return None
+
+
+def _mp4_track_keyframes(body, mdia: tuple) -> list:
+    mdhd = _find_box(body, *mdia, b"mdhd")
+    minf = _find_box(body, *mdia, b"minf")
+    stbl = _find_box(body, *minf, b"stbl") if minf else None
+    if mdhd is None or stbl is None:
+        return list()
+
+    body.seek(mdhd[0])
+    version = body.read(1)[0]
+    body.seek(mdhd[0] + (20 if version == 1 else 12))
+    timescale = struct.unpack(">I", body.read(4))[0] or 1
+
+    stts = _find_box(body, *stbl, b"stts")
+    stsc = _find_box(body, *stbl, b"stsc")
+    stsz = _find_box(body, *stbl, b"stsz")
+    stss = _find_box(body, *stbl, b"stss")
+    stco = _find_box(body, *stbl, b"stco")
+    co64 = _find_box(body, *stbl, b"co64")
+    if None in (stts, stsc, stsz) or (stco is None and co64 is None):
+        return list()
+
+    time_to_sample = _read_table(body, stts, "II")
+    sample_to_chunk = _read_table(body, stsc, "III")
+    chunk_offsets = [entry[0] for entry in (_read_table(body, stco, "I") if stco else _read_table(body, co64, "Q"))]
+    # A missing stss means every sample is a sync sample
+    sync_samples = set(entry[0] for entry in _read_table(body, stss, "I")) if stss else None
+
+    body.seek(stsz[0] + 4)
+    sample_size, sample_count = struct.unpack(">II", body.read(8))
+    sample_sizes = None if sample_size else [entry[0] for entry in _read_table(body, stsz, "I", skip=8)]
+
+    deltas = (delta for count, delta in time_to_sample for _ in range(count))
+    chunk_runs = sample_to_chunk + [(len(chunk_offsets) + 1, 0, 0)]
+
+    keyframes = list()
+    sample = 1
+    time = 0
+    for run, (first_chunk, samples_per_chunk, _) in enumerate(sample_to_chunk):
+        for chunk in range(first_chunk, min(chunk_runs[run + 1][0], len(chunk_offsets) + 1)):
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(samples_per_chunk):
+                if sample > sample_count:
+                    return keyframes
+                if sync_samples is None or sample in sync_samples:
+                    keyframes.append([time / timescale, offset])
+                offset += sample_size or sample_sizes[sample - 1]
+                time += next(deltas, 0)
+                sample += 1
+    return keyframes
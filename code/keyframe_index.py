@@ -0,0 +1,166 @@
+import subprocess
+import bisect
+import json
+import os
+import logging
+import container_index
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+# Containers that can be read from any packet boundary without the file header
+BYTE_SEEK_FORMATS = ("mpegts", "mpeg", "hevc", "h264", "mpegvideo")
+
+
+def _probe_format(file_path: str) -> tuple:
+    """Return (container name, start time in seconds) of a media file, or None if probing failed."""
+    format_command = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=format_name,start_time",
+        "-of", "json",
+        file_path
+    ]
+    try:
+        result = subprocess.run(format_command, capture_output=True, text=True, check=True)
+        probed = json.loads(result.stdout)["format"]
+    except subprocess.CalledProcessError as e:
+        logger.error(f"[build_index] FFprobe failed for {file_path}: {e.stderr.strip()}")
+        return None
+    except (json.JSONDecodeError, KeyError) as e:
+        logger.error(f"[build_index] Unreadable FFprobe output for {file_path}: {e}")
+        return None
+
+    try:
+        start_time = float(probed.get("start_time", 0))
+    except ValueError:
+        start_time = 0.0
+    return probed.get("format_name", "").split(",")[0], start_time
+
+
+def build_index(file_path: str) -> dict:
+    """
+    Build a keyframe index of the first video stream from the container index or,
+    when there is none, from ffprobe packet flags (no decoding).
+
+    Keyframe times are presentation timestamps, start_time is the container start
+    time they are offset by (non-zero mostly in MPEG-TS).
+
+    Args:
+        file_path (str): Path to the media file
+
+    Returns:
+        dict: {"format": container name, "byte_seek": bool, "start_time": seconds,
+               "keyframes": [[time, byte position], ...]}, or None if probing failed
+    """
+    logger.info(f"[build_index] Building keyframe index for: {file_path}")
+
+    probed = _probe_format(file_path)
+    if probed is None:
+        return None
+    format_name, start_time = probed
+
+    # Use the container's own index when there is one, it needs only a few reads
+    container = container_index.read_index(file_path)
+    if container is not None:
+        logger.info(f"[build_index] Using {container['container']} index with {len(container['keyframes'])} keyframes")
+        return {
+            "format": container["container"],
+            "byte_seek": False,
+            "start_time": start_time,
+            "keyframes": container["keyframes"]
+        }
+
+    packet_command = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,dts_time,pos,flags",
+        "-of", "compact=p=0",
+        file_path
+    ]
+    logger.debug(f"[build_index] FFprobe command: {' '.join(packet_command)}")
+
+    try:
+        packet_result = subprocess.run(packet_command, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"[build_index] FFprobe failed for {file_path}: {e.stderr.strip()}")
+        return None
+
+    keyframes = list()
+    for line in packet_result.stdout.splitlines():
+        fields = dict(field.split("=", 1) for field in line.split("|") if "=" in field)
+        if "K" not in fields.get("flags", ""):
+            continue
+
+        time = fields.get("pts_time", "N/A")
+        if time == "N/A":
+            time = fields.get("dts_time", "N/A")
+        if time == "N/A":
+            continue
+
+        position = fields.get("pos", "N/A")
+        keyframes.append([float(time), int(position) if position != "N/A" else -1])
+
+    keyframes.sort()
+    logger.info(f"[build_index] Indexed {len(keyframes)} keyframes ({format_name})")
+
+    return {
+        "format": format_name,
+        "byte_seek": format_name in BYTE_SEEK_FORMATS,
+        "start_time": start_time,
+        "keyframes": keyframes
+    }
+
+
+def load_index(file_path: str, workspace: str) -> dict:
+    """
+    Return the keyframe index of a file, building it only if the cached copy in the
+    workspace is missing or belongs to a different version of the file.
+
+    Args:
+        file_path (str): Path to the media file
+        workspace (str): Directory holding the cached index
+
+    Returns:
+        dict: Keyframe index as returned by build_index, or None if it cannot be built
+    """
+    stat = os.stat(file_path)
+    fingerprint = [os.path.abspath(file_path), stat.st_size, int(stat.st_mtime)]
+    index_file = os.path.join(workspace, "keyframes.json")
+
+    if os.path.isfile(index_file):
+        try:
+            with open(index_file, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            # Indexes written before start_time was recorded are rebuilt
+            if cached.get("fingerprint") == fingerprint and "start_time" in cached["index"]:
+                logger.debug(f"[load_index] Using cached keyframe index: {index_file}")
+                return cached["index"]
+        except (OSError, json.JSONDecodeError, KeyError) as e:
+            logger.warning(f"[load_index] Ignoring unreadable keyframe index {index_file}: {e}")
+
+    index = build_index(file_path)
+    if index is None or not index["keyframes"]:
+        return None
+
+    with open(index_file, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "index": index}, f)
+    logger.debug(f"[load_index] Keyframe index written to: {index_file}")
+    return index
+
+
+def preceding_keyframe(index: dict, time: float) -> tuple:
+    """
+    Find the last keyframe at or before a timestamp.
+
+    Args:
+        index (dict): Keyframe index
+        time (float): Timestamp in seconds from the start of the title (like VPC.start)
+
+    Returns:
+        tuple: (keyframe time in seconds from the start of the title, byte position or -1 if unknown)
+    """
+    start_time = index.get("start_time", 0.0)
+    keyframes = index["keyframes"]
+    position = bisect.bisect_right(keyframes, [time + start_time, float("inf")]) - 1
+    keyframe_time, keyframe_pos = keyframes[max(position, 0)]
+    return max(keyframe_time - start_time, 0.0), keyframe_pos
@@ -0,0 +1,180 @@
+import contextlib
+import threading
+import time
+import os
+import logging
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+# Module level state, VideoProcessingConfig copies are deepcopies and cannot share threads or locks
+_settings = dict()
+_limits = dict()        # job kind -> {"min", "max", "current", "changed"}
+_active = dict()        # job kind -> running jobs
+_condition = threading.Condition()
+_controller = None
+
+
+def configure(VPC) -> None:
+    """
+    Set up the job limits from the Load_control test settings and start the controller thread.
+
+    Every job kind gets a limit between its configured min and max, starting at start
+    (default max): "vqa" limits the running VQA processes, "encode" the encoders of one
+    fan-out process and "vmaf" the libvmaf threads. The controller lowers the limits while
+    the host is overloaded and raises them while it is idle, see _adjust.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration with test settings loaded
+    """
+    global _controller
+
+    settings = VPC.test_settings.get("Load_control", {})
+    if not settings.get("Enabled", False):
+        return
+
+    _settings.update(settings)
+    with _condition:
+        for kind, bounds in settings.get("limits", {}).items():
+            low = max(1, int(bounds.get("min", 1)))
+            high = max(low, int(bounds.get("max", low)))
+            start = min(max(int(bounds.get("start", high)), low), high)
+            _limits[kind] = {"min": low, "max": high, "current": start, "changed": 0.0}
+            _active.setdefault(kind, 0)
+            logger.info(f"[configure] Load control of {kind} jobs: {low}-{high}, starting at {start}")
+
+    if _controller is None:
+        _controller = threading.Thread(target=_controller_loop, name="LoadController", daemon=True)
+        _controller.start()
+
+
+def limit(kind: str, default: int) -> int:
+    """Current limit of a job kind, default if the kind is not load controlled."""
+    with _condition:
+        if kind not in _limits:
+            return default
+        return _limits[kind]["current"]
+
+
+def bound(kind: str, default: int) -> int:
+    """Largest limit a job kind can reach (e.g. the size of a pool), default if not load controlled."""
+    with _condition:
+        if kind not in _limits:
+            return default
+        return _limits[kind]["max"]
+
+
+def acquire(kind: str) -> None:
+    """Wait until fewer jobs of the kind run than its current limit and count a new one."""
+    with _condition:
+        if kind not in _limits:
+            return
+        while _active[kind] >= _limits[kind]["current"]:
+            _condition.wait()
+        _active[kind] += 1
+
+
+def release(kind: str) -> None:
+    """Count a finished job and wake up the waiting ones."""
+    with _condition:
+        if kind not in _limits:
+            return
+        _active[kind] = max(0, _active[kind] - 1)
+        _condition.notify_all()
+
+
+@contextlib.contextmanager
+def slot(kind: str):
+    """Run the block as one job of the kind, see acquire."""
+    acquire(kind)
+    try:
+        yield
+    finally:
+        release(kind)
+
+
+def read_load() -> dict:
+    """
+    Sample the host load.
+
+    Returns:
+        dict: "load" (1 minute load average per core), "cpu_pressure" (PSI some avg10 in %,
+              None without PSI support) and "memory" (MemAvailable / MemTotal, None if unknown)
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+
+    sample = {"load": os.getloadavg()[0] / cores, "cpu_pressure": None, "memory": None}
+
+    try:
+        with open("/proc/pressure/cpu", "r") as f:
+            for line in f:
+                if line.startswith("some"):
+                    fields = dict(field.split("=") for field in line.split()[1:])
+                    sample["cpu_pressure"] = float(fields["avg10"])
+    except (OSError, KeyError, ValueError):
+        pass
+
+    try:
+        meminfo = dict()
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                meminfo[key] = int(value.split()[0])
+        sample["memory"] = meminfo["MemAvailable"] / meminfo["MemTotal"]
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        pass
+
+    return sample
+
+
+def _adjust(sample: dict) -> None:
+    """
+    Move every limit one step with hysteresis.
+
+    Limits go down when any signal is above its high threshold and up only when all
+    signals are below their low thresholds; in between they stay. A limit changes at most
+    once per hold seconds.
+    """
+    high_pressure = _settings.get("high_cpu_pressure", 40)
+    low_pressure = _settings.get("low_cpu_pressure", 10)
+    min_memory = _settings.get("min_available_memory", 0.1)
+
+    overloaded = (
+        sample["load"] > _settings.get("high_load", 1.0)
+        or (sample["cpu_pressure"] is not None and sample["cpu_pressure"] > high_pressure)
+        or (sample["memory"] is not None and sample["memory"] < min_memory)
+    )
+    idle = (
+        sample["load"] < _settings.get("low_load", 0.7)
+        and (sample["cpu_pressure"] is None or sample["cpu_pressure"] < low_pressure)
+        and (sample["memory"] is None or sample["memory"] > 2 * min_memory)
+    )
+    if not overloaded and not idle:
+        return
+
+    now = time.monotonic()
+    with _condition:
+        for kind, state in _limits.items():
+            if now - state["changed"] < _settings.get("hold", 30):
+                continue
+            new = state["current"] - 1 if overloaded else state["current"] + 1
+            new = min(max(new, state["min"]), state["max"])
+            if new == state["current"]:
+                continue
+            logger.info(f"[load_controller] {'Lowering' if overloaded else 'Raising'} {kind} limit to {new} "
+                        f"(load {sample['load']:.2f}/core, CPU pressure {sample['cpu_pressure']}, memory available {sample['memory']})")
+            state["current"] = new
+            state["changed"] = now
+        _condition.notify_all()
+
+
+def _controller_loop() -> None:
+    while True:
+        time.sleep(_settings.get("interval", 5))
+        try:
+            _adjust(read_load())
+        except OSError as e:
+            logger.warning(f"[load_controller] Failed to read the host load: {e}")
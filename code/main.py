@@ -1,8 +1,11 @@
-from AVTest import runTests
+from AVTest import runTests, auditVMAF
 import logging
 import logger_setup
 import os
 import compressor2
+import workspace_manager
+import resource_monitor
+import load_controller
 import argparse
 from VideoClass import VideoProcessingConfig
 
@@ -34,7 +37,22 @@ def compressAV(VPC: VideoProcessingConfig) -> bool:
 
     VPC.export_to_txt()
     
-    if VPC.test_settings["Export_output"]["Enabled"]:
+    renditions = VPC.test_settings.get("Renditions", {})
+    if VPC.test_settings["Export_output"]["Enabled"] and renditions.get("Enabled", False):
+        resource_monitor.set_stage("export")
+        outputs = compressor2.rendition_configs(VPC, renditions.get("outputs", []))
+        if not compressor2.compress_ladder(VPC, outputs):
+            logger.info(f"Conversion failed")
+            return False
+
+        if VPC.test_settings.get("Quality_audit", {}).get("Enabled", False):
+            resource_monitor.set_stage("audit")
+            for output in outputs:
+                if not auditVMAF(output):
+                    logger.warning(f"VMAF audit of {output.output_file_name} failed")
+
+    elif VPC.test_settings["Export_output"]["Enabled"]:
+        resource_monitor.set_stage("export")
         result = compressor2.compress(VPC)
         if not result:
             logger.info(f"Conversion failed")
@@ -44,6 +62,11 @@ def compressAV(VPC: VideoProcessingConfig) -> bool:
         logger.info(f"Output file is {output_file_size_GB:.3f}GB")
         logger.info(f"Output file is {(orig_file_size_GB/output_file_size_GB):.3f}x size of original")
 
+        if VPC.test_settings.get("Quality_audit", {}).get("Enabled", False):
+            resource_monitor.set_stage("audit")
+            if not auditVMAF(VPC):
+                logger.warning("VMAF audit of the output failed")
+
     else:
         logger.info(f"Export output is disabled")
 
@@ -66,6 +89,10 @@ def init(file, file_name, profile_path, settings_path, workspaces, tools_path) -
 
     VPC = VideoProcessingConfig(file, file_name, workspace)
     VPC.readProfiles(profile_path, settings_path, tools_path)
+    workspace_manager.configure(VPC)
+    resource_monitor.configure(VPC)
+    load_controller.configure(VPC)
+    compressor2.configure_execute(VPC)
     VPC.analyzeOriginal()
 
     VPC.setSourcePath(VPC.orig_file_path)
@@ -99,12 +126,13 @@ if __name__ == '__main__':
 
     VPC, logger, stream_logger = init(args.input_file, args.movie_name, args.profile, args.settings, args.workspace, args.tools)
     passed = compressAV(VPC)
+    resource_monitor.write_report(VPC)
+    workspace_manager.shutdown()
 
     print(passed)
 
     """TODO:
 
-        audio
         subtitles
 
         Edit log messages
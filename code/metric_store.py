@@ -0,0 +1,122 @@
+import contextlib
+import hashlib
+import sqlite3
+import json
+import time
+import os
+import logging
+from typing import Union
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    clip    TEXT NOT NULL,
+    metric  TEXT NOT NULL,
+    model   TEXT NOT NULL,
+    params  TEXT NOT NULL,
+    sample  INTEGER NOT NULL,
+    value   REAL NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (clip, metric, model, params, sample)
+)
+"""
+
+
+def database(VPC) -> Union[str, None]:
+    """
+    Path of the metric database from the Metric_memo test settings.
+
+    Without a configured path the database lives next to the title workspaces, so scores
+    are shared by all titles and survive deleted workspaces.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration
+
+    Returns:
+        str: Path of the SQLite database, or None if the memo store is disabled
+    """
+    settings = VPC.test_settings.get("Metric_memo", {})
+    if not settings.get("Enabled", False):
+        return None
+    path = settings.get("path")
+    if not path:
+        path = os.path.join(os.path.dirname(os.path.normpath(VPC.workspace)), "metrics.sqlite")
+    return path
+
+
+@contextlib.contextmanager
+def _connect(db_path: str):
+    connection = sqlite3.connect(db_path, timeout=60)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def content_hash(file_path: str) -> str:
+    """
+    SHA-256 of the file content, the identity of a clip in the store.
+
+    Args:
+        file_path (str): Path to the clip
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _params_text(params: dict) -> str:
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+def lookup(db_path: str, clip: str, metric: str, model: str, params: dict, sample: int = 0) -> Union[float, None]:
+    """
+    Return a stored score.
+
+    Args:
+        db_path (str): Path of the metric database
+        clip (str): Content hash of the scored clip
+        metric (str): Metric name, e.g. "vmaf" or "vqa"
+        model (str): Metric model, e.g. "vmaf_v0.6.1" or "FasterVQA"
+        params (dict): Every other parameter the score depends on (reference, subsampling, ...)
+        sample (int, optional): Index of the repeated measurement for non-deterministic metrics
+
+    Returns:
+        float: Stored score, or None if the clip was not scored with these parameters
+    """
+    try:
+        with _connect(db_path) as connection:
+            row = connection.execute(
+                "SELECT value FROM metrics WHERE clip=? AND metric=? AND model=? AND params=? AND sample=?",
+                (clip, metric, model, _params_text(params), sample)
+            ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"[lookup] Metric store {db_path} unavailable: {e}")
+        return None
+    return None if row is None else row[0]
+
+
+def record(db_path: str, clip: str, metric: str, model: str, params: dict, value: float, sample: int = 0) -> None:
+    """
+    Store a score, see lookup for the arguments. Missing scores (None) are not stored.
+    """
+    if value is None:
+        return
+    try:
+        with _connect(db_path) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO metrics (clip, metric, model, params, sample, value, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (clip, metric, model, _params_text(params), sample, float(value), time.time())
+            )
+    except sqlite3.Error as e:
+        logger.warning(f"[record] Failed to store {metric} score in {db_path}: {e}")
@@ -0,0 +1,184 @@
+import threading
+import time
+import re
+import os
+import logging
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+# Seconds between progress lines written to the application log
+LOG_INTERVAL = 60
+
+# ffmpeg stats line: "frame= 1234 fps= 45 q=28.0 size= 1024kB time=00:00:51.42 bitrate= 163.1kbits/s speed=1.8x"
+FFMPEG_STATS = re.compile(r"frame=\s*(\d+)\s+fps=\s*([\d.]+).*?time=\s*(-?[\d:.]+).*?bitrate=\s*([\d.]+|N/A)")
+# SvtAv1EncApp: "Encoding frame  123 12.34 kbps 4.56 fps"
+SVT_FRAME = re.compile(r"Encoding frame\s+(\d+)\s+([\d.]+)\s*kbps\s+([\d.]+)\s*fps")
+# mkvmerge "Progress: 45%", dovi_tool/hdr10plus_tool progress bars "... 45%"
+PERCENT = re.compile(r"(\d{1,3}(?:\.\d+)?)\s*%")
+
+_listeners = list()
+_active = dict()    # job id -> last progress event
+_lock = threading.Lock()
+_job_ids = iter(range(1, 1 << 62))
+
+
+def add_listener(callback) -> None:
+    """
+    Register a callable that receives every progress event.
+
+    An event is a dict with "job", "tool", "command", "frames", "fps", "bitrate" (kbit/s),
+    "percent", "elapsed" and "eta" (seconds, None if unknown) and "state"
+    ("running", "finished" or "failed"). Listeners are called from the stream reader
+    threads of execute and must not block.
+    """
+    with _lock:
+        _listeners.append(callback)
+
+
+def remove_listener(callback) -> None:
+    with _lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+
+def snapshot() -> dict:
+    """Return the last event of every running job (job id -> event), for monitoring."""
+    with _lock:
+        return {job: dict(event) for job, event in _active.items()}
+
+
+def _detect_tool(command: list) -> str:
+    text = " ".join(command)
+    for tool in ("SvtAv1EncApp", "mkvmerge", "dovi_tool", "hdr10plus_tool", "HandBrakeCLI", "ffmpeg"):
+        if tool in text:
+            return tool
+    return os.path.basename(command[0])
+
+
+class ProgressTracker:
+    """
+    Turns the output lines of one external command into progress events.
+
+    Args:
+        command (list): The executed command
+        total_frames (float, optional): Expected number of output frames, used for percent and ETA
+    """
+
+    def __init__(self, command: list, total_frames: float = None):
+        self.tool = _detect_tool(command)
+        self.total_frames = total_frames
+        self.start = time.monotonic()
+        self.last_emit = 0.0
+        self.last_log = self.start
+        self.event = {
+            "job": next(_job_ids),
+            "tool": self.tool,
+            "command": os.path.basename(command[0]),
+            "frames": None,
+            "fps": None,
+            "bitrate": None,
+            "percent": None,
+            "elapsed": 0.0,
+            "eta": None,
+            "state": "running",
+        }
+        with _lock:
+            _active[self.event["job"]] = dict(self.event)
+
+    def feed(self, line: str) -> bool:
+        """Parse one output line and emit an event if it carried progress. Returns True if it did."""
+        update = self._parse(line)
+        if update:
+            self.event.update(update)
+            self._emit()
+            return True
+        return False
+
+    def finish(self, returncode: int) -> None:
+        """Emit the final event of the job."""
+        self.event["state"] = "finished" if returncode == 0 else "failed"
+        if returncode == 0:
+            self.event["percent"] = 100.0
+            self.event["eta"] = 0.0
+        with _lock:
+            _active.pop(self.event["job"], None)
+        self._emit(force=True)
+
+    def _parse(self, line: str) -> dict:
+        match = SVT_FRAME.search(line)
+        if match:
+            return {"frames": int(match.group(1)), "bitrate": float(match.group(2)), "fps": float(match.group(3))}
+
+        match = FFMPEG_STATS.search(line)
+        if match:
+            bitrate = match.group(4)
+            return {"frames": int(match.group(1)), "fps": float(match.group(2)),
+                    "bitrate": None if bitrate == "N/A" else float(bitrate)}
+
+        if self.tool in ("mkvmerge", "dovi_tool", "hdr10plus_tool", "HandBrakeCLI"):
+            match = PERCENT.search(line)
+            if match:
+                return {"percent": min(100.0, float(match.group(1)))}
+
+        return None
+
+    def _emit(self, force: bool = False) -> None:
+        now = time.monotonic()
+        # Events are rate limited, encoders print several lines per second
+        if not force and now - self.last_emit < 1.0:
+            return
+        self.last_emit = now
+
+        elapsed = now - self.start
+        self.event["elapsed"] = elapsed
+        if self.event["state"] == "running":
+            eta = None
+            if self.event["frames"] is not None and self.total_frames:
+                self.event["percent"] = min(100.0, 100.0 * self.event["frames"] / self.total_frames)
+                if self.event["fps"]:
+                    eta = max(0.0, (self.total_frames - self.event["frames"]) / self.event["fps"])
+            if eta is None and self.event["percent"]:
+                eta = elapsed * (100.0 - self.event["percent"]) / self.event["percent"]
+            self.event["eta"] = eta
+
+        event = dict(self.event)
+        with _lock:
+            if event["state"] == "running":
+                _active[event["job"]] = event
+            listeners = list(_listeners)
+
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.warning(f"[progress] Listener {listener} failed: {e}")
+
+        if now - self.last_log >= LOG_INTERVAL:
+            self.last_log = now
+            logger.info(f"[progress] {format_event(event)}")
+        elif force:
+            # Short commands only leave their final event in the debug log
+            logger.log(logging.INFO if elapsed >= LOG_INTERVAL else logging.DEBUG, f"[progress] {format_event(event)}")
+
+
+def format_event(event: dict) -> str:
+    """One line summary of a progress event."""
+    parts = [f"{event['tool']} {event['state']}"]
+    if event["percent"] is not None:
+        parts.append(f"{event['percent']:.1f}%")
+    if event["frames"] is not None:
+        parts.append(f"frame {event['frames']}")
+    if event["fps"] is not None:
+        parts.append(f"{event['fps']:.2f} fps")
+    if event["bitrate"] is not None:
+        parts.append(f"{event['bitrate']:.1f} kbit/s")
+    parts.append(f"elapsed {_hms(event['elapsed'])}")
+    if event["eta"] is not None and event["state"] == "running":
+        parts.append(f"ETA {_hms(event['eta'])}")
+    return ", ".join(parts)
+
+
+def _hms(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
@@ -0,0 +1,401 @@
+import contextlib
+import subprocess
+import threading
+import json
+import time
+import os
+import logging
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+# Module level state, VideoProcessingConfig copies are deepcopies and cannot share threads or locks
+_enabled = False
+_interval = 1.0
+_stage = "init"
+_records = list()
+_lock = threading.Lock()
+_watchdog = {"timeout": 0, "grace": 10}    # stall watchdog of run and watch, see configure_watchdog
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def configure(VPC) -> None:
+    """
+    Enable resource accounting from the Resource_accounting test settings.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration with test settings loaded
+    """
+    global _enabled, _interval
+
+    settings = VPC.test_settings.get("Resource_accounting", {})
+    _enabled = settings.get("Enabled", False) and os.path.isdir("/proc")
+    _interval = settings.get("interval", 1.0)
+    if _enabled:
+        logger.info(f"[configure] Resource accounting enabled, sampling every {_interval}s")
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def configure_watchdog(timeout: float, grace: float) -> None:
+    """
+    Enable the stall watchdog of run and watch (set by compressor2.configure_execute
+    from the Stall_watchdog test settings).
+
+    Args:
+        timeout (float): Seconds without CPU use of the process tree before it is killed
+        grace (float): Seconds between SIGTERM and SIGKILL
+    """
+    _watchdog["timeout"] = timeout
+    _watchdog["grace"] = grace
+
+
+def set_stage(name: str) -> None:
+    """Attribute the processes started from now on to a stage (e.g. "res", "cq", "export")."""
+    global _stage
+    _stage = name
+
+
+def _read_proc(pid: int) -> dict:
+    """
+    Read the counters of one process. Missing files (process gone, /proc/<pid>/io of
+    another user) leave the corresponding values out.
+    """
+    values = dict()
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+        # The command name may contain spaces, the fields start after its closing parenthesis
+        fields = stat[stat.rfind(")") + 2:].split()
+        values["ppid"] = int(fields[1])
+        values["cpu_user"] = int(fields[11]) / _CLOCK_TICKS
+        values["cpu_system"] = int(fields[12]) / _CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return values
+
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "VmRSS":
+                    values["rss"] = int(value.split()[0]) * 1024
+                elif key == "voluntary_ctxt_switches":
+                    values["voluntary_ctx"] = int(value)
+                elif key == "nonvoluntary_ctxt_switches":
+                    values["involuntary_ctx"] = int(value)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("read_bytes", "write_bytes"):
+                    values[key] = int(value)
+    except (OSError, ValueError):
+        pass
+
+    return values
+
+
+def _descendants(root: int, exclude: frozenset = frozenset()) -> list:
+    """Return the pids of all processes below root, leaving out the subtrees of exclude."""
+    children = dict()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+            ppid = int(stat[stat.rfind(")") + 2:].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, list()).append(int(entry))
+
+    pids = list()
+    pending = [root]
+    while pending:
+        pid = pending.pop()
+        for child in children.get(pid, []):
+            if child in exclude:
+                continue
+            pids.append(child)
+            pending.append(child)
+    return pids
+
+
+def tree_cpu(root: int) -> float:
+    """CPU seconds (user and system) of a process and its descendants."""
+    total = 0.0
+    for pid in [root] + _descendants(root):
+        values = _read_proc(pid)
+        total += values.get("cpu_user", 0) + values.get("cpu_system", 0)
+    return total
+
+
+def watch(process: subprocess.Popen, tool: str) -> None:
+    """
+    Stop a started process when its tree uses no CPU for the stall timeout.
+
+    Output of captured commands is only seen once they exit, so CPU time is the sign of
+    progress: a deadlocked tool (e.g. libvmaf waiting on a filter graph input or a FIFO
+    consumer) uses none. The process is terminated and killed after the grace period,
+    its caller sees a failed exit code. Does nothing without the watchdog or /proc.
+
+    Args:
+        process (subprocess.Popen): Process to watch
+        tool (str): Name of the tool for the log
+    """
+    timeout = _watchdog["timeout"]
+    if timeout <= 0 or not os.path.isdir("/proc"):
+        return
+
+    def loop():
+        cpu = None
+        active = time.monotonic()
+        while process.poll() is None:
+            time.sleep(min(5, timeout))
+            used = tree_cpu(process.pid)
+            if used != cpu:
+                cpu, active = used, time.monotonic()
+                continue
+
+            idle = time.monotonic() - active
+            if idle >= timeout and process.poll() is None:
+                logger.error(f"[watch] {tool} used no CPU for {idle:.0f}s, stopping PID {process.pid}")
+                process.terminate()
+                try:
+                    process.wait(_watchdog["grace"])
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                return
+
+    threading.Thread(target=loop, name=f"StallWatchdog-{tool}", daemon=True).start()
+
+
+class Sampler:
+    """
+    Samples a process tree through /proc until stopped.
+
+    Counters of every process are kept at their last sampled value, so processes that
+    exit before the root still count. The RSS peak is the largest sum of the resident
+    sets of the tree at one sample.
+
+    Args:
+        root (int): Pid of the tree root
+        tool (str): Name of the sampled tool
+        include_root (bool, optional): Count the root itself, False to account only the
+                                       children of this Python process
+        exclude (frozenset, optional): Pids whose subtrees are not counted
+    """
+
+    def __init__(self, root: int, tool: str, include_root: bool = True, exclude: frozenset = frozenset()):
+        self.root = root
+        self.tool = tool
+        self.include_root = include_root
+        self.exclude = exclude
+        self.stage = _stage
+        self.last = dict()      # pid -> last counters
+        self.rss_peak = 0
+        self.start_time = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=f"ResourceSampler-{tool}", daemon=True)
+
+    def start(self) -> "Sampler":
+        self._sample()
+        self._thread.start()
+        return self
+
+    def _loop(self) -> None:
+        while not self._stop.wait(_interval):
+            self._sample()
+
+    def _sample(self) -> None:
+        pids = _descendants(self.root, self.exclude)
+        if self.include_root:
+            pids.append(self.root)
+
+        rss = 0
+        for pid in pids:
+            values = _read_proc(pid)
+            if not values:
+                continue
+            self.last[pid] = values
+            rss += values.get("rss", 0)
+        self.rss_peak = max(self.rss_peak, rss)
+
+    def stop(self, returncode: int = None, usage=None) -> dict:
+        """
+        Stop sampling and record the usage of the tree.
+
+        Args:
+            returncode (int, optional): Exit code of the root process
+            usage (resource.struct_rusage, optional): Exact usage of the reaped root and its
+                                                      waited children, preferred over the samples
+
+        Returns:
+            dict: The recorded usage
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+        totals = {key: sum(values.get(key, 0) for values in self.last.values())
+                  for key in ("cpu_user", "cpu_system", "read_bytes", "write_bytes", "voluntary_ctx", "involuntary_ctx")}
+        rss_peak = self.rss_peak
+
+        if usage is not None:
+            # Samples miss the last interval, the rusage of the reaped root does not
+            totals["cpu_user"] = max(totals["cpu_user"], usage.ru_utime)
+            totals["cpu_system"] = max(totals["cpu_system"], usage.ru_stime)
+            totals["voluntary_ctx"] = max(totals["voluntary_ctx"], usage.ru_nvcsw)
+            totals["involuntary_ctx"] = max(totals["involuntary_ctx"], usage.ru_nivcsw)
+            totals["read_bytes"] = max(totals["read_bytes"], usage.ru_inblock * 512)
+            totals["write_bytes"] = max(totals["write_bytes"], usage.ru_oublock * 512)
+            rss_peak = max(rss_peak, usage.ru_maxrss * 1024)
+
+        record = {
+            "stage": self.stage,
+            "tool": self.tool,
+            "wall": time.monotonic() - self.start_time,
+            **totals,
+            "rss_peak": rss_peak,
+            "processes": len(self.last),
+            "returncode": returncode,
+        }
+        with _lock:
+            _records.append(record)
+
+        logger.debug(f"[Sampler.stop] {self.tool} ({self.stage}): wall {record['wall']:.1f}s, "
+                     f"CPU {record['cpu_user'] + record['cpu_system']:.1f}s, RSS peak {rss_peak / 1024 ** 2:.0f}MB, "
+                     f"read {record['read_bytes'] / 1024 ** 2:.0f}MB, written {record['write_bytes'] / 1024 ** 2:.0f}MB")
+        return record
+
+
+def wait(process: subprocess.Popen):
+    """
+    Wait for a process like Popen.wait and return its resource usage.
+
+    Returns:
+        resource.struct_rusage: Usage of the process and its waited children, None where
+                                os.wait4 is not available
+    """
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return None
+
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage
+
+
+def run(command: list, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run with resource accounting of the command and its children and the
+    stall watchdog (see watch).
+
+    Takes the same arguments as subprocess.run (except check and input).
+    """
+    if not _enabled and _watchdog["timeout"] <= 0:
+        return subprocess.run(command, **kwargs)
+
+    timeout = kwargs.pop("timeout", None)
+    if kwargs.pop("capture_output", False):
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+
+    with subprocess.Popen(command, **kwargs) as process:
+        sampler = Sampler(process.pid, os.path.basename(command[0])).start() if _enabled else None
+        watch(process, os.path.basename(command[0]))
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            if sampler is not None:
+                sampler.stop(process.returncode)
+            raise
+        if sampler is not None:
+            sampler.stop(process.returncode)
+
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+
+@contextlib.contextmanager
+def track_children(tool: str):
+    """
+    Account every child process of this Python process started inside the block, e.g.
+    the workers of a multiprocessing pool and the tools they run. Processes that exist
+    when the block starts (a multiprocessing Manager, tools of other threads) and their
+    children are not counted.
+    """
+    if not _enabled:
+        yield
+        return
+
+    existing = frozenset(_descendants(os.getpid()))
+    sampler = Sampler(os.getpid(), tool, include_root=False, exclude=existing).start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+
+
+def summary() -> dict:
+    """
+    Aggregate the recorded usage per stage and for the whole title.
+
+    Returns:
+        dict: {"stages": {stage: totals}, "title": totals}; totals hold the summed counters,
+              the largest RSS peak, the number of processes and the CPU utilization
+              (CPU seconds per wall second, 1.0 = one fully busy core)
+    """
+    with _lock:
+        records = list(_records)
+
+    def aggregate(selected: list) -> dict:
+        totals = {key: sum(record[key] for record in selected)
+                  for key in ("wall", "cpu_user", "cpu_system", "read_bytes", "write_bytes", "voluntary_ctx", "involuntary_ctx")}
+        totals["rss_peak"] = max((record["rss_peak"] for record in selected), default=0)
+        totals["commands"] = len(selected)
+        totals["cpu_utilization"] = (totals["cpu_user"] + totals["cpu_system"]) / totals["wall"] if totals["wall"] else 0.0
+        return totals
+
+    stages = dict()
+    for record in records:
+        stages.setdefault(record["stage"], list()).append(record)
+
+    return {
+        "stages": {stage: aggregate(selected) for stage, selected in stages.items()},
+        "title": aggregate(records),
+    }
+
+
+def write_report(VPC) -> None:
+    """
+    Log the per stage usage and write it, with every recorded command, to
+    {output_file_name}_resources.json in the workspace.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration of the title
+    """
+    if not _enabled:
+        return
+
+    report = summary()
+    with _lock:
+        report["commands"] = list(_records)
+
+    for stage, totals in report["stages"].items():
+        logger.info(f"[write_report] {stage}: {totals['commands']} commands, wall {totals['wall']:.0f}s, "
+                    f"CPU {totals['cpu_user'] + totals['cpu_system']:.0f}s ({totals['cpu_utilization']:.1f} cores), "
+                    f"RSS peak {totals['rss_peak'] / 1024 ** 2:.0f}MB, read {totals['read_bytes'] / 1024 ** 3:.2f}GB, "
+                    f"written {totals['write_bytes'] / 1024 ** 3:.2f}GB, "
+                    f"ctx switches {totals['voluntary_ctx']}/{totals['involuntary_ctx']} (voluntary/involuntary)")
+
+    report_file = os.path.join(VPC.workspace, f"{VPC.output_file_name}_resources.json")
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    logger.info(f"[write_report] Resource report written to: {report_file}")
@@ -0,0 +1,259 @@
+import subprocess
+import re
+import json
+import os
+import logging
+import resource_monitor
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+
+def read_gray_frames(input_path: str, width: int, height: int, input_args: list = None, filters: str = None) -> tuple:
+    """
+    Decode a video into small grayscale frames piped from FFmpeg as raw video.
+
+    Args:
+        input_path (str): Path to the video file
+        width (int): Width of the decoded frames
+        height (int): Height of the decoded frames
+        input_args (list, optional): Extra FFmpeg input options (e.g. ["-skip_frame", "nokey"])
+        filters (str, optional): Filters applied before scaling (e.g. crop or fps)
+
+    Returns:
+        tuple: (list of frame timestamps in seconds, numpy array of shape (frames, height, width)),
+               or (None, None) if decoding failed
+    """
+    import numpy as np  # Only loaded when scene analysis runs
+
+    video_filter = f"scale={width}:{height},format=gray,showinfo"
+    if filters:
+        video_filter = f"{filters},{video_filter}"
+
+    command = [
+        "ffmpeg", "-hide_banner", "-nostats",
+        *(input_args or []),
+        "-i", input_path,
+        "-an", "-sn", "-dn",
+        "-vf", video_filter,
+        "-fps_mode", "passthrough",
+        "-f", "rawvideo", "-"
+    ]
+    logger.debug(f"[read_gray_frames] FFmpeg command: {' '.join(command)}")
+
+    try:
+        process = resource_monitor.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
+    except Exception as e:
+        logger.error(f"[read_gray_frames] Unexpected error while decoding {input_path}: {e}")
+        return None, None
+
+    if process.returncode != 0:
+        logger.error(f"[read_gray_frames] FFmpeg finished with errors. Exit code: {process.returncode}")
+        logger.debug(process.stderr.decode("utf-8", errors="replace").strip())
+        return None, None
+
+    frame_size = width * height
+    count = len(process.stdout) // frame_size
+    frames = np.frombuffer(process.stdout[:count * frame_size], dtype=np.uint8).reshape(count, height, width)
+
+    # showinfo prints one line per frame on stderr
+    timestamps = [float(match) for match in re.findall(r"pts_time:\s*(-?[\d.]+)", process.stderr.decode("utf-8", errors="replace"))]
+    if len(timestamps) != count:
+        logger.warning(f"[read_gray_frames] Got {count} frames but {len(timestamps)} timestamps")
+        timestamps = (timestamps + [timestamps[-1] if timestamps else 0.0] * count)[:count]
+
+    return timestamps, frames
+
+
+def analyze_scenes(VPC) -> list:
+    """
+    Build a scene list of the original file from a downscaled, keyframe-only decode.
+
+    Consecutive keyframes belong to one scene until the mean absolute difference between
+    them exceeds cut_threshold. Every scene gets its mean luma and a simple complexity
+    score (mean gradient plus mean keyframe-to-keyframe difference).
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration
+
+    Returns:
+        list: Scene dictionaries with "start", "end", "luma" and "complexity", or an empty list on failure
+    """
+    import numpy as np
+
+    settings = VPC.test_settings["Scene_analysis"]
+    width = settings.get("width", 64)
+    height = settings.get("height", 36)
+    cut_threshold = settings.get("cut_threshold", 30)
+
+    logger.info(f"[analyze_scenes] Analyzing scenes of: {VPC.orig_file_path}")
+    timestamps, frames = read_gray_frames(VPC.orig_file_path, width, height, input_args=["-skip_frame", "nokey"])
+    if frames is None or len(frames) == 0:
+        logger.error("[analyze_scenes] No keyframes decoded")
+        return list()
+
+    frames = frames.astype(np.int16)
+    luma = frames.mean(axis=(1, 2))
+    spatial = np.abs(np.diff(frames, axis=2)).mean(axis=(1, 2)) + np.abs(np.diff(frames, axis=1)).mean(axis=(1, 2))
+    temporal = np.concatenate(([0.0], np.abs(np.diff(frames, axis=0)).mean(axis=(1, 2))))
+
+    # Split keyframes into scenes at large keyframe-to-keyframe differences
+    boundaries = [0] + [i for i in range(1, len(frames)) if temporal[i] > cut_threshold] + [len(frames)]
+
+    scenes = list()
+    for first, last in zip(boundaries[:-1], boundaries[1:]):
+        end = timestamps[last] if last < len(frames) else VPC.orig_duration
+        inner_temporal = temporal[first+1:last]
+        scenes.append({
+            "start": timestamps[first],
+            "end": end,
+            "luma": float(luma[first:last].mean()),
+            "complexity": float(spatial[first:last].mean() + (inner_temporal.mean() if len(inner_temporal) else 0.0)),
+        })
+
+    logger.info(f"[analyze_scenes] Found {len(scenes)} scenes in {len(frames)} keyframes")
+
+    scene_file = os.path.join(VPC.workspace, "scenes.json")
+    with open(scene_file, "w", encoding="utf-8") as f:
+        json.dump(scenes, f, indent=1)
+    logger.debug(f"[analyze_scenes] Scene list written to: {scene_file}")
+
+    return scenes
+
+
+def select_scenes(VPC, number_of_scenes: int, scene_length: float = 0) -> list:
+    """
+    Pick representative test scenes stratified by complexity.
+
+    Dark scenes (fades, black frames), scenes shorter than scene_length and scenes in
+    the skipped edges of the title (logos, credits) are discarded. The rest is sorted by
+    complexity and split into number_of_scenes strata; from each stratum the scene with
+    the median complexity is used and sampled around its middle.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration with scene_list
+        number_of_scenes (int): Number of scenes to pick
+        scene_length (float, optional): Length of the test segment in seconds
+
+    Returns:
+        list: (scene id, start time in seconds) tuples ordered by time,
+              or None if there are not enough usable scenes
+    """
+    settings = VPC.test_settings["Scene_analysis"]
+    black_luma = settings.get("black_luma", 24)
+    edge = VPC.orig_duration * settings.get("skip_edges", 0.05)
+
+    candidates = [
+        scene for scene in VPC.scene_list
+        if scene["luma"] >= black_luma
+        and scene["end"] - scene["start"] >= scene_length
+        and scene["start"] >= edge
+        and scene["end"] <= VPC.orig_duration - edge
+    ]
+
+    if len(candidates) < number_of_scenes:
+        logger.warning(f"[select_scenes] Only {len(candidates)} usable scenes for {number_of_scenes} samples")
+        return None
+
+    candidates = sorted(candidates, key=lambda scene: scene["complexity"])
+    selected = list()
+    for stratum in range(number_of_scenes):
+        first = stratum * len(candidates) // number_of_scenes
+        last = (stratum + 1) * len(candidates) // number_of_scenes
+        selected.append(candidates[(first + last - 1) // 2])
+
+    starts = sorted(int((scene["start"] + scene["end"] - scene_length) / 2) for scene in selected)
+    logger.debug(f"[select_scenes] Selected scene starts: {starts}")
+    return [(timestamp + 1, start) for timestamp, start in enumerate(starts)]
+
+
+def analyze_complexity(VPC) -> dict:
+    """
+    Measure the spatial and temporal information (SI/TI, ITU-T P.910) of the original
+    file and adapt the test settings of this title to it.
+
+    Short windows evenly spaced through the title are decoded as small grayscale frames.
+    SI is the standard deviation of the Sobel gradient magnitude of a frame, TI the
+    standard deviation of the difference of consecutive frames. The title is classified
+    as "simple" when both means are below the simple thresholds (animation, static talk
+    shows), "complex" when either mean is above the complex thresholds and "normal"
+    otherwise. The overrides of the class are merged into VPC.test_settings, so they can
+    narrow testing_resolutions/cq_values or disable tests. The profile is written to
+    complexity.json in the workspace.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration
+
+    Returns:
+        dict: Complexity profile, or None if no frames could be decoded
+    """
+    import numpy as np
+
+    settings = VPC.test_settings["Complexity_analysis"]
+    width = settings.get("width", 320)
+    height = settings.get("height", 180)
+    number_of_samples = settings.get("number_of_samples", 12)
+    sample_length = settings.get("sample_length", 1)
+    edge = VPC.orig_duration * settings.get("skip_edges", 0.05)
+
+    logger.info(f"[analyze_complexity] Measuring SI/TI of: {VPC.orig_file_path}")
+    timestep = (VPC.orig_duration - 2 * edge - sample_length) / max(number_of_samples - 1, 1)
+
+    si_values = list()
+    ti_values = list()
+    for sample in range(number_of_samples):
+        start = max(0.0, edge + sample * timestep)
+        _, frames = read_gray_frames(VPC.orig_file_path, width, height, input_args=["-ss", str(start), "-t", str(sample_length)])
+        if frames is None or len(frames) == 0:
+            logger.warning(f"[analyze_complexity] No frames decoded at {start:.1f}s")
+            continue
+
+        frames = frames.astype(np.float32)
+        # Sobel gradients of the inner pixels
+        gx = (frames[:, :-2, 2:] + 2 * frames[:, 1:-1, 2:] + frames[:, 2:, 2:]) - (frames[:, :-2, :-2] + 2 * frames[:, 1:-1, :-2] + frames[:, 2:, :-2])
+        gy = (frames[:, 2:, :-2] + 2 * frames[:, 2:, 1:-1] + frames[:, 2:, 2:]) - (frames[:, :-2, :-2] + 2 * frames[:, :-2, 1:-1] + frames[:, :-2, 2:])
+        si_values.extend(np.sqrt(gx ** 2 + gy ** 2).std(axis=(1, 2)).tolist())
+        if len(frames) > 1:
+            ti_values.extend(np.diff(frames, axis=0).std(axis=(1, 2)).tolist())
+
+    if not si_values:
+        logger.error("[analyze_complexity] No frames decoded")
+        return None
+
+    si = np.array(si_values)
+    ti = np.array(ti_values) if ti_values else np.zeros(1)
+    profile = {
+        "width": width,
+        "height": height,
+        "frames": len(si_values),
+        "si_mean": float(si.mean()),
+        "si_max": float(si.max()),
+        "ti_mean": float(ti.mean()),
+        "ti_max": float(ti.max()),
+        "static_fraction": float((ti < settings.get("static_ti", 1.0)).mean()),
+    }
+
+    if profile["si_mean"] <= settings.get("simple_si", 25) and profile["ti_mean"] <= settings.get("simple_ti", 5):
+        profile["class"] = "simple"
+    elif profile["si_mean"] >= settings.get("complex_si", 70) or profile["ti_mean"] >= settings.get("complex_ti", 25):
+        profile["class"] = "complex"
+    else:
+        profile["class"] = "normal"
+
+    logger.info(f"[analyze_complexity] SI {profile['si_mean']:.1f} (max {profile['si_max']:.1f}), "
+                f"TI {profile['ti_mean']:.1f} (max {profile['ti_max']:.1f}), "
+                f"{profile['static_fraction'] * 100:.0f}% static, class {profile['class']}")
+
+    # Merge the overrides of the class into the test settings of this title
+    overrides = (settings.get("overrides") or {}).get(profile["class"]) or {}
+    for section, values in overrides.items():
+        logger.info(f"[analyze_complexity] {section} overridden for {profile['class']} content: {values}")
+        VPC.test_settings.setdefault(section, {}).update(values)
+    profile["overrides"] = overrides
+
+    complexity_file = os.path.join(VPC.workspace, "complexity.json")
+    with open(complexity_file, "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=1)
+    logger.debug(f"[analyze_complexity] Complexity profile written to: {complexity_file}")
+
+    return profile
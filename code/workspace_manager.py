@@ -0,0 +1,189 @@
+import contextlib
+import threading
+import shutil
+import queue
+import time
+import os
+import logging
+
+# Retrieve the logger once at the module level
+logger = logging.getLogger("AppLogger")
+
+# Module level state, VideoProcessingConfig copies are deepcopies and cannot share threads or locks
+_tiers = dict()             # tier name -> {"path": tier directory of this job, "quota": bytes}
+_stages = dict()            # stage name -> tier name
+_reservations = dict()      # stage directory -> (tier name, reserved bytes)
+_scheduled = set()          # stage directories queued for the janitor, it releases them
+_admission_timeout = 0
+_condition = threading.Condition()
+_cleanup_queue = queue.Queue()
+_janitor = None
+
+
+def configure(VPC) -> None:
+    """
+    Set up the workspace tiers of this job from the Workspace_tiers test settings and
+    start the background janitor.
+
+    Each tier is a directory (e.g. tmpfs for small test clips, a scratch disk for large
+    intermediates) with a byte quota for this job. A tier without a path uses the title
+    workspace. Stages that are not mapped to a tier stay in the title workspace.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration with test settings loaded
+    """
+    global _admission_timeout, _janitor
+
+    settings = VPC.test_settings.get("Workspace_tiers", {})
+    if not settings.get("Enabled", False):
+        return
+
+    title = os.path.basename(os.path.normpath(VPC.workspace))
+    for name, tier in settings.get("tiers", {}).items():
+        path = os.path.join(tier["path"], title) if tier.get("path") else VPC.workspace
+        os.makedirs(path, exist_ok=True)
+        _tiers[name] = {"path": path, "quota": int(tier.get("quota_GB", 0) * 1024 ** 3)}
+        logger.info(f"[configure] Workspace tier {name}: {path}, quota {tier.get('quota_GB', 0)}GB")
+
+    _stages.update({stage: tier for stage, tier in settings.get("stages", {}).items() if tier in _tiers})
+    _admission_timeout = settings.get("admission_timeout", 1800)
+
+    if _janitor is None:
+        _janitor = threading.Thread(target=_janitor_loop, name="WorkspaceJanitor", daemon=True)
+        _janitor.start()
+
+
+def acquire(VPC, stage: str, name: str, size: int = 0) -> str:
+    """
+    Return the directory for a stage, waiting until its tier has room for it.
+
+    The stage is admitted once the tier's outstanding reservations plus size fit into the
+    quota and the file system has size bytes free. A stage that is larger than the quota
+    is admitted alone. When the file system is short of space and the tier has no
+    reservations that could be released, or after admission_timeout seconds, the stage
+    goes ahead anyway.
+    The reservation is released when the directory is removed by delete_file; use
+    reserve to release it on every other way out of the stage as well.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration of the title
+        stage (str): Stage name used for the tier mapping (e.g. "res", "cq")
+        name (str): Directory name of the stage
+        size (int, optional): Expected peak size of the stage in bytes
+
+    Returns:
+        str: Path of the stage directory
+    """
+    tier = _stages.get(stage)
+    if tier is None:
+        return os.path.join(VPC.workspace, name)
+
+    path = os.path.join(_tiers[tier]["path"], name)
+    quota = _tiers[tier]["quota"]
+    deadline = time.monotonic() + _admission_timeout
+
+    with _condition:
+        while True:
+            reserved = sum(bytes_ for tier_, bytes_ in _reservations.values() if tier_ == tier)
+            free = shutil.disk_usage(_tiers[tier]["path"]).free
+            fits_quota = quota <= 0 or reserved + size <= quota or reserved == 0
+            if fits_quota and free >= size:
+                break
+            if reserved == 0:
+                # No reservation could be released to make room, waiting would not help
+                logger.warning(f"[acquire] Only {free / 1024 ** 2:.0f}MB free for {name} ({size / 1024 ** 2:.0f}MB) in tier {tier} and nothing to wait for, continuing anyway")
+                break
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"[acquire] No room for {name} in tier {tier} after {_admission_timeout}s, continuing anyway")
+                break
+            logger.info(f"[acquire] Waiting for space in tier {tier}: {reserved / 1024 ** 2:.0f}MB reserved, {size / 1024 ** 2:.0f}MB requested, {free / 1024 ** 2:.0f}MB free")
+            _condition.wait(timeout=min(remaining, 30))
+
+        _reservations[path] = (tier, size)
+
+    logger.debug(f"[acquire] Stage {stage} admitted to tier {tier}: {path} ({size / 1024 ** 2:.0f}MB)")
+    return path
+
+
+@contextlib.contextmanager
+def reserve(VPC, stage: str, name: str, size: int = 0):
+    """
+    acquire as a context manager, yields the stage directory.
+
+    The reservation is released when the block exits, also on early returns and
+    exceptions, unless the directory was handed to the janitor, which releases it
+    once the directory is removed.
+    """
+    path = acquire(VPC, stage, name, size)
+    try:
+        yield path
+    finally:
+        with _condition:
+            scheduled = path in _scheduled
+        if not scheduled:
+            release(path)
+
+
+def release(path: str) -> None:
+    """Drop the reservation of a stage directory and wake up waiting stages."""
+    with _condition:
+        if _reservations.pop(path, None) is not None:
+            _condition.notify_all()
+
+
+def schedule_cleanup(path: str) -> bool:
+    """
+    Hand a directory over to the background janitor.
+
+    Args:
+        path (str): Directory to remove
+
+    Returns:
+        bool: True if the janitor took the directory, False if it is not running
+    """
+    if _janitor is None:
+        return False
+    with _condition:
+        _scheduled.add(path)
+    _cleanup_queue.put(path)
+    return True
+
+
+def shutdown() -> None:
+    """Wait until the janitor has removed every scheduled directory."""
+    if _janitor is not None:
+        _cleanup_queue.join()
+
+
+def estimate_bytes(VPC, seconds: float, factor: float = 1.0) -> int:
+    """
+    Estimate the size of clips with the source bitrate.
+
+    Args:
+        VPC (VideoProcessingConfig): Video processing configuration
+        seconds (float): Total length of the clips in seconds
+        factor (float, optional): Size of the clips relative to the source bitrate
+
+    Returns:
+        int: Estimated size in bytes
+    """
+    if not VPC.orig_duration:
+        return 0
+    return int(os.path.getsize(VPC.orig_file_path) / VPC.orig_duration * seconds * factor)
+
+
+def _janitor_loop() -> None:
+    while True:
+        path = _cleanup_queue.get()
+        try:
+            shutil.rmtree(path)
+            logger.debug(f"[janitor] Deleted directory: {path}")
+        except OSError as e:
+            logger.warning(f"[janitor] Failed to delete {path}: {e}")
+        finally:
+            with _condition:
+                _scheduled.discard(path)
+            release(path)
+            _cleanup_queue.task_done()